@@ -28,6 +28,8 @@ setuptools.setup(
             "sns_va = virtaccl.site.SNS_Linac.virtual_SNS_linac:main",
             "idmp_va = virtaccl.site.SNS_IDmp.IDmp_virtual_accelerator:main",
             "btf_va = virtaccl.site.BTF.btf_virtual_accelerator:main",
+            "va_supervisor = virtaccl.supervisor:main",
+            "va_replica = virtaccl.EPICS_Server.ca_replica:main",
         ]},
 
     packages=setuptools.find_packages(),
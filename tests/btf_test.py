@@ -1,10 +1,10 @@
-from time import sleep
-
 import pytest
 import subprocess
 
 from epics import caget, caput
 
+from virtaccl.EPICS_Server.va_status import wait_for_start, wait_for_update
+
 
 @pytest.fixture(scope="module")
 def va_process():
@@ -12,14 +12,14 @@ def va_process():
     proc = subprocess.Popen(["btf_va"])
 
     # Wait for the VA to start serving PVs
-    sleep(4.0)
-    print('BTF VA should be ready by now')
+    wait_for_start(proc)
+    print('BTF VA is ready')
     yield proc
 
-    # Tear down: stop the background process when tests are done
+    # Tear down: stop the background process when tests are done. The VA stops its server and exits on SIGTERM.
     print('BTF VA will terminate.')
     proc.terminate()
-    proc.wait()
+    proc.wait(timeout=10.0)
 
 
 def test_pv_connection(va_process):
@@ -50,8 +50,8 @@ def test_corrector(va_process):
 
     for i_set, bpm, b_field in settings:
 
-        caput(corrector_set, i_set)
-        sleep(1.5)
+        caput(corrector_set, i_set, wait=True)
+        wait_for_update()
         b_reading = caget(corrector)
         bpm_reading = caget(bpm_device)
 
@@ -0,0 +1,57 @@
+import pytest
+
+pytest.importorskip('orbit')
+
+from orbit.py_linac.lattice.LinacAccLatticeLib import LinacAccLattice
+from orbit.py_linac.lattice.LinacAccNodes import Drift
+
+from virtaccl.PyORBIT_Model.pyorbit_lattice_controller import OrbitModel
+from virtaccl.PyORBIT_Model.pyorbit_va_nodes import BPMclass, FCclass
+from virtaccl.site.BTF.orbit_model.btf_child_nodes import BTF_Screenclass
+from virtaccl.site.SNS_IDmp.IDmp_maker import get_IDMP_lattice_and_bunch
+
+
+@pytest.fixture
+def fc_model():
+    # A BPM on each side of a Faraday cup that starts out of the beam.
+    drift1 = Drift("Drift1")
+    drift1.setLength(1.0)
+    fc = FCclass("FC")
+    fc.setParam('state', 0)
+    drift2 = Drift("Drift2")
+    drift2.setLength(1.0)
+    list_of_nodes = [drift1, BPMclass("BPM_Up"), fc, drift2, BPMclass("BPM_Down")]
+
+    lattice = LinacAccLattice('FC Lattice')
+    lattice.setNodes(list_of_nodes)
+    lattice.initialize()
+
+    _, bunch = get_IDMP_lattice_and_bunch(particle_number=200)
+    model = OrbitModel(input_bunch=bunch)
+    model.define_custom_node(BPMclass.node_type, BPMclass.parameter_list, diagnostic=True)
+    model.define_custom_node(FCclass.node_type, FCclass.parameter_list, optic=True, diagnostic=True)
+    model.set_beam_current(38.0e-3)
+    model.initialize_lattice(lattice)
+    return model
+
+
+def test_fc_stops_beam_in_envelope_mode(fc_model):
+    model = fc_model
+    model.set_fidelity('envelope')
+    assert model.get_measurements(['BPM_Down'])['BPM_Down']['amp_avg'] > 0
+
+    model.update_optics({'FC': {'state': 1}})
+    assert model.beam_intercepted()
+    assert not model.use_envelope()
+    model.track()
+
+    measurements = model.get_measurements(['BPM_Up', 'BPM_Down'])
+    assert measurements['BPM_Up']['amp_avg'] > 0
+    assert measurements['BPM_Down']['amp_avg'] == 0.0
+
+
+def test_screen_intercepts_beam():
+    screen = BTF_Screenclass("Screen", screen_axis=0, screen_polarity=1)
+    assert not screen.intercepts_beam()
+    screen.setParam('position', 0.0)
+    assert screen.intercepts_beam()
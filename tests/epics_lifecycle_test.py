@@ -0,0 +1,33 @@
+from time import monotonic
+
+import pytest
+
+pytest.importorskip('pcaspy')
+
+from virtaccl.EPICS_Server.ca_server import EPICS_Server
+
+
+def test_stop_and_restart():
+    server = EPICS_Server(prefix='Test:Lifecycle:', process_delay=0.5)
+    server.add_parameters({'Mag:B_Set': {'type': 'float', 'prec': 3, 'value': 0.0},
+                           'Mag:B': {'type': 'float', 'prec': 3, 'value': 0.0}})
+    server.start()
+    assert server.start_flag
+    server.set_parameter('Mag:B', 0.5)
+    server.update()
+    assert server.get_parameter('Mag:B') == pytest.approx(0.5)
+
+    # Stopping joins the CA thread instead of sleeping.
+    start_time = monotonic()
+    server.stop()
+    assert monotonic() - start_time < 1.0
+    assert not server.ca_thread.is_alive()
+
+    # Values set while stopped are served after the restart, which reuses the PVs.
+    server.set_parameter('Mag:B', 0.75)
+    ca_server = server.ca_server
+    server.start()
+    assert server.ca_server is ca_server
+    assert server.ca_thread.is_alive()
+    assert server.get_parameter('Mag:B') == pytest.approx(0.75)
+    server.stop()
@@ -0,0 +1,152 @@
+import os
+import json
+import socket
+import base64
+import struct
+from typing import Any, Dict
+from urllib.request import Request, urlopen
+
+import numpy as np
+import pytest
+
+from virtaccl.beam_line import BeamLine, Device
+from virtaccl.model import Model
+from virtaccl.server import Server
+from virtaccl.virtual_accelerator import VirtualAccelerator
+from virtaccl.HTTP_Gateway.http_gateway import HTTP_Gateway
+from virtaccl.Socket_Server.socket_protocol import decode_message, frame_format, frame_size
+
+
+class Magnet(Device):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.register_setting('B_Set', default=0.0)
+        self.register_readback('B', 'B_Set')
+        self.register_measurement('Profile', definition={'count': 5})
+
+    def get_model_optics(self) -> Dict[str, Dict[str, Any]]:
+        return {self.name: {'field': self.get_parameter_value('B_Set')}}
+
+
+class ProfileModel(Model):
+    # The profile of the magnet is five copies of its field.
+    def __init__(self):
+        super().__init__()
+        self.field = 0.0
+
+    def update_optics(self, changed_optics: Dict[str, Dict[str, Any]]) -> None:
+        self.field = changed_optics['Test:Mag']['field']
+
+    def get_measurements(self) -> Dict[str, Dict[str, Any]]:
+        return {'Test:Mag': {'Profile': np.full(5, self.field)}}
+
+
+@pytest.fixture
+def va_gateway():
+    server = Server()
+    beam_line = BeamLine()
+    beam_line.add_device(Magnet('Test:Mag'))
+    options = {'print_settings': False, 'print_server_keys': False, 'sync_time': False, 'refresh_rate': 10.0,
+               'debug': False}
+    va = VirtualAccelerator(ProfileModel(), beam_line, server, **options)
+    gateway = HTTP_Gateway(server, 'localhost:0', poll_period=0.01)
+    gateway.start()
+    yield va, gateway
+    gateway.stop()
+
+
+def url(gateway: HTTP_Gateway, path: str) -> str:
+    return f'http://{gateway.host}:{gateway.port}{path}'
+
+
+def open_websocket(gateway: HTTP_Gateway) -> socket.socket:
+    connection = socket.create_connection((gateway.host, gateway.port), timeout=5.0)
+    key = base64.b64encode(os.urandom(16)).decode()
+    connection.sendall(f'GET /ws HTTP/1.1\r\nHost: {gateway.host}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                       f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n'.encode())
+    reply = b''
+    while not reply.endswith(b'\r\n\r\n'):
+        reply += connection.recv(1)
+    assert reply.startswith(b'HTTP/1.1 101')
+    return connection
+
+
+def send_frame(connection: socket.socket, message: Dict[str, Any]):
+    # Clients mask their frames.
+    payload = json.dumps(message).encode()
+    mask = os.urandom(4)
+    masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+    connection.sendall(struct.pack('!BB', 0x81, 0x80 | len(payload)) + mask + masked)
+
+
+def receive_exactly(connection: socket.socket, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        data += connection.recv(size - len(data))
+    return data
+
+
+def receive_frame(connection: socket.socket) -> Dict[str, Any]:
+    first, second = receive_exactly(connection, 2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', receive_exactly(connection, 2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', receive_exactly(connection, 8))[0]
+    message = receive_exactly(connection, length)
+    header_length, payload_length = struct.unpack(frame_format, message[:frame_size])
+    header_end = frame_size + header_length
+    return decode_message(message[frame_size:header_end], message[header_end:header_end + payload_length])
+
+
+def test_get_and_post_values(va_gateway):
+    va, gateway = va_gateway
+    with urlopen(url(gateway, '/values?keys=Test:Mag:B_Set,Test:Mag:Profile'), timeout=5.0) as reply:
+        values = json.loads(reply.read())
+    assert values['Test:Mag:B_Set'] == 0.0
+    assert values['Test:Mag:Profile'] == [0.0] * 5
+
+    request = Request(url(gateway, '/values'), data=json.dumps({'Test:Mag:B_Set': 0.5}).encode(), method='POST')
+    with urlopen(request, timeout=5.0) as reply:
+        generation = json.loads(reply.read())['generation']
+    assert generation == va.server.settings_generation
+    va.track()
+    with urlopen(url(gateway, '/values?keys=Test:Mag:B'), timeout=5.0) as reply:
+        assert json.loads(reply.read())['Test:Mag:B'] == pytest.approx(0.5)
+
+
+def test_websocket_subscribe(va_gateway):
+    va, gateway = va_gateway
+    connection = open_websocket(gateway)
+    send_frame(connection, {'op': 'subscribe', 'keys': ['Test:Mag:B', 'Test:Mag:Profile']})
+    # The first update holds the current values of the new keys.
+    update = receive_frame(connection)
+    assert update['op'] == 'update'
+    assert update['values']['Test:Mag:B'] == 0.0
+
+    va.set_values({'Test:Mag:B_Set': 0.25})
+    # The gateway may catch the track between the two values, so they can come in separate updates.
+    values = {}
+    while len(values) < 2:
+        update = receive_frame(connection)
+        assert set(update['values']) <= {'Test:Mag:B', 'Test:Mag:Profile'}
+        values |= update['values']
+    assert values['Test:Mag:B'] == pytest.approx(0.25)
+    assert np.allclose(values['Test:Mag:Profile'], 0.25)
+    connection.close()
+
+
+def test_websocket_without_key(va_gateway):
+    va, gateway = va_gateway
+    connection = socket.create_connection((gateway.host, gateway.port), timeout=5.0)
+    connection.sendall(b'GET /ws HTTP/1.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n\r\n')
+    assert connection.recv(1024).startswith(b'HTTP/1.1 400')
+    connection.close()
+
+
+def test_stop_frees_port(va_gateway):
+    va, gateway = va_gateway
+    port = gateway.port
+    gateway.stop()
+    with socket.socket() as listener:
+        listener.bind((gateway.host, port))
@@ -0,0 +1,63 @@
+import pytest
+
+pytest.importorskip('orbit')
+
+from orbit.core.bunch import Bunch
+
+from virtaccl.PyORBIT_Model.pyorbit_lattice_controller import OrbitModel
+from virtaccl.PyORBIT_Model.pyorbit_va_nodes import BPMclass, WSclass, ScreenClass
+from virtaccl.site.SNS_IDmp.IDmp_maker import get_IDMP_lattice_and_bunch
+
+
+def build_model(input_bunch: Bunch) -> OrbitModel:
+    # Every model gets its own lattice and a copy of the same input bunch, so their measurements can be compared.
+    lattice, _ = get_IDMP_lattice_and_bunch(particle_number=10)
+    bunch = Bunch()
+    input_bunch.copyBunchTo(bunch)
+    model = OrbitModel(input_bunch=bunch)
+    model.define_custom_node(BPMclass.node_type, BPMclass.parameter_list, diagnostic=True)
+    model.define_custom_node(WSclass.node_type, WSclass.parameter_list, diagnostic=True)
+    model.define_custom_node(ScreenClass.node_type, ScreenClass.parameter_list, diagnostic=True)
+    model.set_beam_current(38.0e-3)
+    model.initialize_lattice(lattice)
+    return model
+
+
+@pytest.fixture(scope="module")
+def input_bunch():
+    _, bunch = get_IDMP_lattice_and_bunch(particle_number=1000, x_off=2, xp_off=0.3)
+    return bunch
+
+
+def test_upstream_change_during_coarse_track(input_bunch):
+    model = build_model(input_bunch)
+    model.set_progressive(100)
+    model.force_track()
+    model.refine()
+
+    # The downstream quad starts a coarse track, and the callback changes the upstream quad while the bunch is past it.
+    upstream_change = {'Quad1': {'dB/dr': -0.6}}
+    downstream_change = {'Quad2': {'dB/dr': 0.4}}
+    applied = []
+
+    def apply_upstream_change():
+        if not applied:
+            applied.append(True)
+            model.update_optics(upstream_change)
+
+    model.set_tracking_callback(apply_upstream_change, callback_period=0.0)
+    model.update_optics(downstream_change)
+    model.track()
+    assert applied
+    assert model.refinement_pending()
+    model.set_tracking_callback(None)
+    assert model.refine()
+
+    reference = build_model(input_bunch)
+    reference.update_optics(upstream_change | downstream_change)
+    reference.track()
+
+    refined = model.get_measurements(['BPM03'])['BPM03']
+    expected = reference.get_measurements(['BPM03'])['BPM03']
+    assert refined['x_avg'] == pytest.approx(expected['x_avg'])
+    assert refined['y_avg'] == pytest.approx(expected['y_avg'])
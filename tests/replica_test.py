@@ -0,0 +1,74 @@
+from threading import Event
+from typing import Any, Dict
+
+import pytest
+
+from virtaccl.beam_line import BeamLine, Device
+from virtaccl.model import Model
+from virtaccl.server import Server
+from virtaccl.virtual_accelerator import VirtualAccelerator
+from virtaccl.EPICS_Server.ca_replica import Replica_Feed
+from virtaccl.Socket_Server.socket_client import Socket_Client
+
+
+class Magnet(Device):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.register_setting('B_Set', default=0.0, definition={'prec': 3})
+        self.register_readback('B', 'B_Set')
+
+    def get_model_optics(self) -> Dict[str, Dict[str, Any]]:
+        return {self.name: {'field': self.get_parameter_value('B_Set')}}
+
+
+class EmptyModel(Model):
+    def update_optics(self, changed_optics: Dict[str, Dict[str, Any]]) -> None:
+        pass
+
+    def get_measurements(self) -> Dict[str, Dict[str, Any]]:
+        return {}
+
+
+@pytest.fixture
+def va_feed():
+    server = Server()
+    beam_line = BeamLine()
+    beam_line.add_device(Magnet('Test:Mag'))
+    options = {'print_settings': False, 'print_server_keys': False, 'sync_time': False, 'refresh_rate': 10.0,
+               'debug': False}
+    va = VirtualAccelerator(EmptyModel(), beam_line, server, **options)
+    feed = Replica_Feed(server, 'localhost:0', poll_period=0.01)
+    feed.start()
+    yield va, feed
+    feed.stop()
+
+
+def test_definitions(va_feed):
+    va, feed = va_feed
+    client = Socket_Client(feed.address)
+    reply = client.request({'op': 'definitions'})
+    assert reply['definitions']['Test:Mag:B_Set']['prec'] == 3
+    assert 'value' not in reply['definitions']['Test:Mag:B_Set']
+    assert reply['values']['Test:Mag:B'] == 0.0
+    client.close()
+
+
+def test_updates_and_forwarded_writes(va_feed):
+    va, feed = va_feed
+    client = Socket_Client(feed.address)
+    received = Event()
+
+    def on_update(values):
+        if 'Test:Mag:B' in values:
+            received.set()
+
+    client.subscribe(['Test:Mag:B_Set', 'Test:Mag:B'], callback=on_update)
+    generation = client.set('Test:Mag:B_Set', 0.5)
+    assert generation == va.server.settings_generation
+
+    va.track()
+    assert received.wait(timeout=5.0)
+    assert client.subscribed_values['Test:Mag:B'] == pytest.approx(0.5)
+    with pytest.raises(RuntimeError):
+        client.set('BAD:Key', 1.0)
+    client.close()
@@ -0,0 +1,98 @@
+import os
+from time import monotonic, sleep
+from typing import Any, Dict
+
+import numpy as np
+import pytest
+
+from virtaccl.beam_line import BeamLine, Device
+from virtaccl.model import Model
+from virtaccl.virtual_accelerator import VirtualAccelerator
+from virtaccl.SHM_Server.shm_server import SHM_Server
+from virtaccl.SHM_Server.shm_client import SHM_Client
+
+
+class Magnet(Device):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.register_setting('B_Set', default=0.0)
+        self.register_readback('B', 'B_Set')
+        self.register_measurement('Profile', definition={'count': 5})
+
+    def get_model_optics(self) -> Dict[str, Dict[str, Any]]:
+        return {self.name: {'field': self.get_parameter_value('B_Set')}}
+
+
+class ProfileModel(Model):
+    # The profile of the magnet is five copies of its field.
+    def __init__(self):
+        super().__init__()
+        self.field = 0.0
+
+    def update_optics(self, changed_optics: Dict[str, Dict[str, Any]]) -> None:
+        self.field = changed_optics['Test:Mag']['field']
+
+    def get_measurements(self) -> Dict[str, Dict[str, Any]]:
+        return {'Test:Mag': {'Profile': np.full(5, self.field)}}
+
+
+@pytest.fixture
+def va_server():
+    server = SHM_Server(f'virac_test_{os.getpid()}', client_slots=2, ring_capacity=16)
+    beam_line = BeamLine()
+    beam_line.add_device(Magnet('Test:Mag'))
+    options = {'print_settings': False, 'print_server_keys': False, 'sync_time': False, 'refresh_rate': 10.0,
+               'debug': False}
+    va = VirtualAccelerator(ProfileModel(), beam_line, server, **options)
+    server.start()
+    yield va, server
+    server.stop()
+
+
+def wait_for_value(client: SHM_Client, key: str, value, timeout: float = 5.0) -> bool:
+    end_time = monotonic() + timeout
+    while monotonic() < end_time:
+        if client.get(key) == value:
+            return True
+        sleep(0.01)
+    return False
+
+
+def test_get_values(va_server):
+    va, server = va_server
+    client = SHM_Client(server.name)
+    values = client.get_values(['Test:Mag:B_Set', 'Test:Mag:B', 'Test:Mag:Profile'])
+    assert values['Test:Mag:B_Set'] == 0.0
+    assert values['Test:Mag:B'] == 0.0
+    assert np.allclose(values['Test:Mag:Profile'], 0.0)
+    assert 'Test:Mag:B_Set' in client.get_keys()
+    client.close()
+
+
+def test_set_and_track(va_server):
+    va, server = va_server
+    client = SHM_Client(server.name, slot=1)
+    client.set_values({'Test:Mag:B_Set': 0.5})
+
+    # The write is counted and published before the virtual accelerator takes it.
+    assert wait_for_value(client, 'Virac:Status:Settings_Generation', 1)
+    assert client.get('Test:Mag:B_Set') == pytest.approx(0.5)
+    assert server.settings_generation == 1
+
+    va.track()
+    server.update()
+    values = client.get_values(['Test:Mag:B', 'Test:Mag:Profile', 'Virac:Status:Applied_Generation'])
+    assert values['Test:Mag:B'] == pytest.approx(0.5)
+    assert np.allclose(values['Test:Mag:Profile'], 0.5)
+    assert values['Virac:Status:Applied_Generation'] == 1
+    client.close()
+
+
+def test_bad_key_and_slot(va_server):
+    va, server = va_server
+    client = SHM_Client(server.name)
+    with pytest.raises(KeyError):
+        client.set('BAD:Key', 1.0)
+    client.close()
+    with pytest.raises(ValueError):
+        SHM_Client(server.name, slot=2)
@@ -1,10 +1,12 @@
-from time import sleep
+from time import sleep, monotonic
 
 import pytest
 import subprocess
 
 from epics import caget, caput
 
+from virtaccl.EPICS_Server.va_status import wait_for_start, wait_for_update
+
 
 @pytest.fixture(scope="module")
 def va_process():
@@ -12,14 +14,14 @@ def va_process():
     proc = subprocess.Popen(["sns_va"])
 
     # Wait for the VA to start serving PVs
-    sleep(4.0)
-    print('SNS VA should be ready by now')
+    wait_for_start(proc)
+    print('SNS VA is ready')
     yield proc
 
-    # Tear down: stop the background process when tests are done
+    # Tear down: stop the background process when tests are done. The VA stops its server and exits on SIGTERM.
     print('SNS VA will terminate.')
     proc.terminate()
-    proc.wait()
+    proc.wait(timeout=10.0)
 
 
 def test_pv_connection(va_process):
@@ -50,8 +52,8 @@ def test_corrector(va_process):
 
     for b_set, bpm in settings:
 
-        caput(corrector_set, b_set)
-        sleep(1.5)
+        caput(corrector_set, b_set, wait=True)
+        wait_for_update()
         b_reading = caget(corrector)
         bpm_reading = caget(bpm_device)
 
@@ -63,3 +65,21 @@ def test_corrector(va_process):
 
     caput(corrector_set, original_val)
 
+
+def test_status(va_process):
+    corrector_set = "SCL_Mag:PS_DCH00:B_Set"
+    bpm_device = "SCL_Diag:BPM04:xAvg"
+
+    cycle = caget('Virac:Status:Cycle')
+    start_time = monotonic()
+    while caget('Virac:Status:Cycle') <= cycle:
+        assert monotonic() - start_time < 5.0
+        sleep(0.05)
+
+    original_val = caget(corrector_set)
+    caput(corrector_set, 0.04, wait=True)
+    wait_for_update()
+    assert caget(bpm_device) == pytest.approx(5.0, abs=0.1)
+
+    caput(corrector_set, original_val, wait=True)
+    wait_for_update()
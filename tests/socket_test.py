@@ -0,0 +1,119 @@
+from threading import Event
+from typing import Any, Dict
+
+import numpy as np
+import pytest
+
+from virtaccl.beam_line import BeamLine, Device
+from virtaccl.model import Model
+from virtaccl.virtual_accelerator import VirtualAccelerator
+from virtaccl.Socket_Server.socket_server import Socket_Server
+from virtaccl.Socket_Server.socket_client import Socket_Client
+
+
+class Magnet(Device):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.register_setting('B_Set', default=0.0)
+        self.register_readback('B', 'B_Set')
+        self.register_measurement('Profile', definition={'count': 5})
+
+    def get_model_optics(self) -> Dict[str, Dict[str, Any]]:
+        return {self.name: {'field': self.get_parameter_value('B_Set')}}
+
+
+class ProfileModel(Model):
+    # The profile of the magnet is five copies of its field.
+    def __init__(self):
+        super().__init__()
+        self.field = 0.0
+
+    def update_optics(self, changed_optics: Dict[str, Dict[str, Any]]) -> None:
+        self.field = changed_optics['Test:Mag']['field']
+
+    def get_measurements(self) -> Dict[str, Dict[str, Any]]:
+        return {'Test:Mag': {'Profile': np.full(5, self.field)}}
+
+
+@pytest.fixture(params=['tcp', 'unix'])
+def va_server(request, tmp_path):
+    if request.param == 'tcp':
+        server = Socket_Server('localhost:0')
+    else:
+        server = Socket_Server(str(tmp_path / 'va.sock'))
+    beam_line = BeamLine()
+    beam_line.add_device(Magnet('Test:Mag'))
+    options = {'print_settings': False, 'print_server_keys': False, 'sync_time': False, 'refresh_rate': 10.0,
+               'debug': False}
+    va = VirtualAccelerator(ProfileModel(), beam_line, server, **options)
+    server.start()
+    yield va, server
+    server.stop()
+
+
+def test_bulk_get(va_server):
+    va, server = va_server
+    client = Socket_Client(server.get_address())
+    values = client.get_values(['Test:Mag:B_Set', 'Test:Mag:B', 'Test:Mag:Profile'])
+    assert values['Test:Mag:B_Set'] == 0.0
+    assert values['Test:Mag:B'] == 0.0
+    assert isinstance(values['Test:Mag:Profile'], np.ndarray)
+    assert 'Test:Mag:B_Set' in client.get_keys()
+    client.close()
+
+
+def test_set_and_track(va_server):
+    va, server = va_server
+    client = Socket_Client(server.get_address())
+    generation = client.set_values({'Test:Mag:B_Set': 0.5})
+    assert generation == 1
+    va.track()
+    server.update()
+
+    values = client.get_values(['Test:Mag:B', 'Test:Mag:Profile', 'Virac:Status:Applied_Generation'])
+    assert values['Test:Mag:B'] == pytest.approx(0.5)
+    assert np.allclose(values['Test:Mag:Profile'], 0.5)
+    assert values['Virac:Status:Applied_Generation'] == generation
+    client.close()
+
+
+def test_bad_key(va_server):
+    va, server = va_server
+    client = Socket_Client(server.get_address())
+    with pytest.raises(RuntimeError):
+        client.get('BAD:Key')
+    with pytest.raises(RuntimeError):
+        client.set('BAD:Key', 1.0)
+    # Only settings can be written.
+    with pytest.raises(RuntimeError):
+        client.set_values({'Test:Mag:B_Set': 0.5, 'Test:Mag:B': 0.5})
+    with pytest.raises(RuntimeError):
+        client.set('Virac:Status:Cycle', 10)
+    assert server.get_parameter('Test:Mag:B_Set') == 0.0
+    client.close()
+
+
+def test_subscription(va_server):
+    va, server = va_server
+    client = Socket_Client(server.get_address())
+    updates = []
+    received = Event()
+
+    def on_update(values):
+        updates.append(values)
+        if values.get('Test:Mag:B') == pytest.approx(0.25):
+            received.set()
+
+    initial = client.subscribe(['Test:Mag:B', 'Test:Mag:Profile'], callback=on_update)
+    assert initial['Test:Mag:B'] == 0.0
+    assert server.get_subscribed_keys() >= {'Test:Mag:B', 'Test:Mag:Profile'}
+
+    client.set('Test:Mag:B_Set', 0.25)
+    va.track()
+    server.update()
+    assert received.wait(timeout=5.0)
+    assert client.subscribed_values['Test:Mag:B'] == pytest.approx(0.25)
+    assert np.allclose(client.subscribed_values['Test:Mag:Profile'], 0.25)
+    # Only subscribed keys are sent.
+    assert all(set(values) <= {'Test:Mag:B', 'Test:Mag:Profile'} for values in updates)
+    client.close()
@@ -0,0 +1,90 @@
+from typing import Any, Dict
+
+import pytest
+
+from virtaccl.beam_line import BeamLine, Device
+from virtaccl.model import Model
+from virtaccl.server import Server
+from virtaccl.supervisor import Shared_Server, VA_Scheduler
+from virtaccl.virtual_accelerator import VirtualAccelerator
+
+
+class Magnet(Device):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.register_setting('B_Set', default=0.0)
+        self.register_readback('B', 'B_Set')
+
+    def get_model_optics(self) -> Dict[str, Dict[str, Any]]:
+        return {self.name: {'field': self.get_parameter_value('B_Set')}}
+
+
+class CountingModel(Model):
+    # Counts its tracks.
+    def __init__(self):
+        super().__init__()
+        self.track_count = 0
+
+    def update_optics(self, changed_optics: Dict[str, Dict[str, Any]]) -> None:
+        pass
+
+    def track(self) -> None:
+        self.track_count += 1
+
+    def get_measurements(self) -> Dict[str, Dict[str, Any]]:
+        return {}
+
+
+def build_va(shared_server: Shared_Server, prefix: str, refresh_rate: float) -> VirtualAccelerator:
+    beam_line = BeamLine()
+    beam_line.add_device(Magnet('Test:Mag'))
+    options = {'print_settings': False, 'print_server_keys': False, 'sync_time': False, 'refresh_rate': refresh_rate,
+               'debug': False}
+    return VirtualAccelerator(CountingModel(), beam_line, shared_server.create_view(prefix), **options)
+
+
+@pytest.fixture
+def shared_vas():
+    shared_server = Shared_Server(Server())
+    va_a = build_va(shared_server, 'A:', 100.0)
+    va_b = build_va(shared_server, 'B:', 50.0)
+    return shared_server, va_a, va_b
+
+
+def test_prefixed_keys(shared_vas):
+    shared_server, va_a, va_b = shared_vas
+    keys = shared_server.server.get_parameter_keys()
+    assert 'A:Test:Mag:B_Set' in keys and 'B:Test:Mag:B_Set' in keys
+    assert 'A:Virac:Status:Cycle' in keys and 'B:Virac:Status:Cycle' in keys
+    assert 'Test:Mag:B_Set' in va_a.server.parameter_db
+
+
+def test_writes_go_to_their_va(shared_vas):
+    shared_server, va_a, va_b = shared_vas
+    shared_server.server.apply_transaction({'A:Test:Mag:B_Set': 0.5})
+    va_a.track()
+    va_b.track()
+    assert va_a.get_value('Test:Mag:B') == pytest.approx(0.5)
+    assert va_b.get_value('Test:Mag:B') == pytest.approx(0.0)
+    assert shared_server.server.get_parameter('A:Test:Mag:B') == pytest.approx(0.5)
+
+    va_b.set_value('Test:Mag:B_Set', 0.25)
+    assert shared_server.server.get_parameter('B:Test:Mag:B') == pytest.approx(0.25)
+    assert va_a.get_value('Test:Mag:B') == pytest.approx(0.5)
+
+
+def test_scheduler_tracks_at_each_rate(shared_vas):
+    shared_server, va_a, va_b = shared_vas
+    scheduler = VA_Scheduler()
+    scheduler.add_instance('A', va_a)
+    scheduler.add_instance('B', va_b)
+    count_a, count_b = va_a.model.track_count, va_b.model.track_count
+
+    passes = iter(range(30))
+    scheduler.run(keep_running=lambda: next(passes, None) is not None)
+
+    tracks_a = va_a.model.track_count - count_a
+    tracks_b = va_b.model.track_count - count_b
+    assert tracks_a + tracks_b == 30
+    # A updates twice as often as B.
+    assert tracks_a == pytest.approx(2 * tracks_b, abs=2)
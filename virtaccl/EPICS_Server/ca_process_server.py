@@ -0,0 +1,260 @@
+import time
+import multiprocessing as mp
+from queue import Empty
+from threading import Thread
+from datetime import datetime
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from virtaccl.EPICS_Server.ca_server import EPICS_Server, parse_transaction
+from virtaccl.SHM_Server.shm_layout import SharedValues
+
+
+class EPICS_Process_Server(EPICS_Server):
+    """
+    EPICS server that runs the pcaspy server in its own process, so answering CA clients does not compete with tracking
+    for the GIL. Numeric values go to the CA process through shared memory (see SharedValues), other values through a
+    command queue. Client writes come back through a message queue, which a thread in this process moves into the write
+    queue of the server.
+
+    Since the CA process answers writes without waiting for the virtual accelerator, the write validator is applied
+    when a write arrives in this process. Clamped values are published back, and rejected writes are replaced by the
+    previous value. For the same reason, a read that asks for a track (measure on read mode) returns the current value
+    instead of waiting for the track.
+    """
+
+    def __init__(self, prefix='', process_delay=0.1, read_window=10.0, transaction_key='Virac:Transaction',
+                 max_transaction_size=1000000, replicas=0, replica_port=5066, replica_feed='localhost:7790'):
+        super().__init__(prefix, process_delay, read_window, transaction_key, max_transaction_size, replicas,
+                         replica_port, replica_feed)
+        self.shared_memory: Optional[SharedMemory] = None
+        self.shared_values: Optional[SharedValues] = None
+        self.process = None
+        self.commands = None
+        self.messages = None
+        # Values posted since the last update, written to the shared memory together.
+        self.pending_values: Dict[str, Tuple[np.ndarray, Optional[datetime]]] = {}
+
+    def _send(self, reason: str, value: Any, timestamp: datetime = None):
+        array = self.shared_values.fits(reason, value)
+        if array is None:
+            self.commands.put(('set', reason, value, timestamp))
+        else:
+            self.pending_values[reason] = (array, timestamp)
+
+    def get_parameter(self, reason: str) -> Any:
+        return self.parameter_db[reason]['value']
+
+    def get_subscribed_keys(self) -> Optional[Set[str]]:
+        if not self.start_flag:
+            return None
+        shared_values = self.shared_values
+        recently_read = shared_values.read_times > time.time() - self.read_window
+        watched = np.nonzero(shared_values.interest.astype(bool) | recently_read)[0]
+        return {shared_values.keys[i] for i in watched}
+
+    def update(self):
+        if self.start_flag:
+            self.flush_held_values()
+            new_values, self.pending_values = self.pending_values, {}
+            if new_values:
+                self.shared_values.write(new_values)
+
+    def receive_messages(self):
+        while True:
+            messages = [self.messages.get()]
+            while True:
+                try:
+                    messages.append(self.messages.get_nowait())
+                except Empty:
+                    break
+            # Reads that arrived together are passed on once per PV after the writes. The read callback does not wait
+            # (see wait_on_read), so a burst of reads makes a single track request.
+            read_reasons = set()
+            for message in messages:
+                if message[0] == 'stop':
+                    return
+                elif message[0] == 'read':
+                    read_reasons.add(message[1])
+                elif message[0] == 'write':
+                    self.receive_writes(message[1], message[2])
+            if self.read_callback is not None:
+                for reason in read_reasons:
+                    self.read_callback(reason)
+
+    def receive_writes(self, generation: int, writes: List[Tuple[str, Any, datetime]]):
+        with self.settings_lock:
+            for reason, value, write_time in writes:
+                # The value on the CA server is now the client's, so whatever is published next has to be posted.
+                self.posted_signatures.pop(reason, None)
+                try:
+                    new_value = self.validate_write(reason, value)
+                except ValueError as e:
+                    print(f'Warning: Write to {reason} rejected. {e}')
+                    self.set_parameter(reason, self.parameter_db[reason]['value'])
+                    continue
+                if new_value is value:
+                    self.parameter_db[reason]['value'] = new_value
+                else:
+                    self.set_parameter(reason, new_value)
+                self.queue_write(reason, new_value, write_time)
+            self.settings_generation = max(self.settings_generation, generation)
+
+    def start(self):
+        layout = []
+        pv_db = {}
+        for key, definitions in self.parameter_db.items():
+            pv_db[key] = {name: value for name, value in definitions.items() if name != 'publish_policy'}
+            if definitions.get('type') != 'string':
+                layout.append((key, definitions.get('count', 1)))
+
+        self.shared_memory = SharedMemory(create=True, size=SharedValues.size(layout))
+        self.shared_values = SharedValues(layout, self.shared_memory.buf)
+
+        context = mp.get_context('spawn')
+        self.commands = context.Queue()
+        self.messages = context.Queue()
+        transaction_keys = (self.commit_key, self.transaction_generation_key, self.transaction_error_key)
+        self.process = context.Process(target=run_ca_process, daemon=True,
+                                       args=(self.prefix, pv_db, layout, self.shared_memory.name, self.commands,
+                                             self.messages, self.process_delay, self.generation_key, transaction_keys,
+                                             self.max_transaction_size, self.read_callback is not None))
+        self.process.start()
+        Thread(target=self.receive_messages, daemon=True).start()
+        self.start_flag = True
+        self.start_replicas()
+
+    def stop(self):
+        if not self.start_flag:
+            return
+        self.stop_replicas()
+        # The last values, including those held back by rate limits, go to the CA process before it stops.
+        self.flush_held_values(everything=True)
+        self.update()
+        self.start_flag = False
+        self.commands.put(('stop',))
+        self.process.join(timeout=5)
+        self.messages.put(('stop',))
+        self.shared_values = None
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+
+def run_ca_process(prefix: str, pv_db: Dict[str, Dict[str, Any]], layout: List[Tuple[str, int]], shared_name: str,
+                   commands, messages, process_delay: float, generation_key: Optional[str],
+                   transaction_keys: Tuple[str, str, str], max_transaction_size: int, notify_reads: bool):
+    """Runs the pcaspy server of an EPICS_Process_Server until it is told to stop."""
+
+    from pcaspy import Driver, SimpleServer
+    from pcaspy.cas import epicsTimeStamp
+    from pcaspy.driver import manager
+
+    shared_memory = SharedMemory(name=shared_name)
+    shared_values = SharedValues(layout, shared_memory.buf)
+    commit_key, transaction_generation_key, transaction_error_key = transaction_keys
+    state = {'generation': 0}
+
+    def to_epics_timestamp(t: float):
+        tst = epicsTimeStamp()
+        epics_tst = t - 631152000.0
+        tst.secPastEpoch = int(np.floor(epics_tst))
+        tst.nsec = int((epics_tst % 1) * 1_000_000_000)
+        return tst
+
+    class ProcessDriver(Driver):
+        def __init__(self):
+            Driver.__init__(self)
+
+        def read(self, reason):
+            if reason in shared_values.indexes:
+                shared_values.read_times[shared_values.indexes[reason]] = time.time()
+            if notify_reads:
+                messages.put(('read', reason))
+            return super().read(reason)
+
+        def write(self, reason, value):
+            if reason == commit_key:
+                return self.commit_transaction(value)
+            state['generation'] += 1
+            accepted = super().write(reason, value)
+            if accepted:
+                messages.put(('write', state['generation'], [(reason, value, datetime.now())]))
+            self.post_generation()
+            self.updatePVs()
+            return accepted
+
+        def commit_transaction(self, value) -> bool:
+            try:
+                new_settings = parse_transaction(value)
+                unknown_keys = [key for key in new_settings.keys() if key not in pv_db]
+                if unknown_keys:
+                    raise KeyError(f'Unknown parameters: {", ".join(unknown_keys)}')
+            except (ValueError, KeyError) as e:
+                self.setParam(transaction_error_key, str(e))
+                self.updatePVs()
+                print(f'Warning: Transaction rejected. {e}')
+                return False
+
+            state['generation'] += 1
+            write_time = datetime.now()
+            for key, new_value in new_settings.items():
+                self.setParam(key, new_value)
+            messages.put(('write', state['generation'], [(key, new_value, write_time)
+                                                         for key, new_value in new_settings.items()]))
+            self.post_generation()
+            self.setParam(transaction_generation_key, state['generation'])
+            self.setParam(transaction_error_key, '')
+            self.updatePVs()
+            return True
+
+        def post_generation(self):
+            if generation_key is not None:
+                self.setParam(generation_key, max(state['generation'], self.getParam(generation_key)))
+
+        def post(self, reason, value, timestamp: Optional[float]):
+            if reason == generation_key:
+                value = max(state['generation'], int(value))
+            self.setParam(reason, value)
+            if timestamp is not None and not np.isnan(timestamp):
+                self.pvDB[reason].time = to_epics_timestamp(timestamp)
+
+    transaction_db = {commit_key: {'type': 'char', 'count': max_transaction_size},
+                      transaction_generation_key: {'type': 'int'},
+                      transaction_error_key: {'type': 'char', 'count': 1000}}
+
+    server = SimpleServer()
+    server.createPV(prefix, pv_db | transaction_db)
+    driver = ProcessDriver()
+    pvs = manager.pvs[driver.port]
+    seen_versions = shared_values.versions.copy()
+
+    while True:
+        server.process(process_delay)
+
+        for reason, (array, timestamp) in shared_values.read_changes(seen_versions).items():
+            definitions = pv_db[reason]
+            if definitions.get('type') in ('int', 'enum', 'char'):
+                array = array.astype(np.int64)
+            value = array[0] if definitions.get('count', 1) == 1 and array.size == 1 else array
+            driver.post(reason, value, timestamp)
+
+        while True:
+            try:
+                command = commands.get_nowait()
+            except Empty:
+                break
+            if command[0] == 'stop':
+                driver.updatePVs()
+                server.process(process_delay)
+                shared_values = None
+                shared_memory.close()
+                return
+            elif command[0] == 'set':
+                reason, value, timestamp = command[1:]
+                driver.post(reason, value, None if timestamp is None else timestamp.timestamp())
+
+        for i, key in enumerate(shared_values.keys):
+            shared_values.interest[i] = pvs[key].interest if key in pvs else 0
+        driver.updatePVs()
@@ -0,0 +1,263 @@
+import os
+import socket
+import argparse
+from queue import SimpleQueue, Empty
+from threading import Thread, Lock
+from time import sleep
+from importlib.metadata import version
+from typing import Any, Dict, List, Optional
+
+from virtaccl.server import Server
+from virtaccl.EPICS_Server.ca_server import parse_transaction
+from virtaccl.Socket_Server.socket_server import Connection
+from virtaccl.Socket_Server.socket_client import Socket_Client
+from virtaccl.Socket_Server.socket_protocol import receive_message, parse_address
+
+
+class Replica_Feed:
+    """
+    Stream of every parameter of a server to read replicas (see run_replica). Like the HTTP gateway, it follows the
+    change journal of the server, so it works with any server. Each replica is sent the definitions and values of all
+    parameters when it connects, then the values that changed, at most once per poll period. Writes from the replicas
+    are applied to the server as transactions, so they are checked the same way as writes to the server itself.
+
+    Requests use the messages of socket_protocol and are answered like the Socket_Server does:
+        {'op': 'definitions'} -> {'definitions': {...}, 'values': {...}}
+        {'op': 'subscribe', 'keys': [...], 'period': float} -> {'values': {...}}, then {'op': 'update', 'values': {...}}
+        {'op': 'set', 'values': {...}} -> {'generation': int} or {'error': str}
+
+        Parameters
+        ----------
+        server : Server
+            Server of the primary virtual accelerator.
+        address : str, optional
+            'host:port' for TCP or a file path for a Unix domain socket. The default is 'localhost:7790'.
+        poll_period : float, optional
+            Time (in seconds) between checks of the change journal. The default is 0.05 s.
+    """
+
+    def __init__(self, server: Server, address: str = 'localhost:7790', poll_period: float = 0.05):
+        self.server = server
+        self.address = address
+        self.poll_period = poll_period
+        self.start_flag = False
+        self.listen_socket: Optional[socket.socket] = None
+        self.connections: List[Connection] = []
+        self.connections_lock = Lock()
+        self.journal_position = 0
+
+    def get_definitions(self) -> Dict[str, Dict[str, Any]]:
+        # Everything pcaspy needs to create the PVs, without the values and the server side publish policies.
+        return {key: {name: value for name, value in definitions.items() if name not in ('value', 'publish_policy')}
+                for key, definitions in self.server.parameter_db.items()}
+
+    def get_values(self, keys) -> Dict[str, Any]:
+        with self.server.settings_lock:
+            return {key: self.server.get_parameter(key) for key in keys}
+
+    def handle_request(self, connection: Connection, request: Dict[str, Any]) -> Dict[str, Any]:
+        op = request.get('op')
+        if op == 'definitions':
+            return {'definitions': self.get_definitions(), 'values': self.get_values(self.server.parameter_db.keys())}
+
+        elif op == 'subscribe':
+            keys = set(request['keys']) & self.server.parameter_db.keys()
+            connection.subscriptions |= keys
+            connection.period = request.get('period', 0.0)
+            return {'values': self.get_values(keys)}
+
+        elif op == 'set':
+            try:
+                return {'generation': self.server.apply_transaction(request['values'])}
+            except (ValueError, KeyError) as e:
+                return {'error': str(e)}
+
+        return {'error': f'Unknown operation: {op}'}
+
+    def publish_changes(self):
+        while self.start_flag:
+            sleep(self.poll_period)
+            changed_keys, self.journal_position = self.server.get_changes(self.journal_position)
+            if not changed_keys:
+                continue
+            with self.connections_lock:
+                connections = list(self.connections)
+            values = None
+            for connection in connections:
+                keys = changed_keys & connection.subscriptions
+                if not keys:
+                    continue
+                if values is None:
+                    # Every replica subscribes to every key, so the values are read once for all of them.
+                    values = self.get_values(changed_keys)
+                self.send(connection, {'op': 'update', 'values': {key: values[key] for key in keys}})
+
+    def send(self, connection: Connection, message: Dict[str, Any]):
+        try:
+            connection.send(message)
+        except OSError:
+            self.remove_connection(connection)
+
+    def remove_connection(self, connection: Connection):
+        with self.connections_lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+        connection.socket.close()
+
+    def serve_connection(self, connection: Connection):
+        while self.start_flag:
+            try:
+                request = receive_message(connection.socket)
+            except OSError:
+                request = None
+            if request is None:
+                break
+            reply = self.handle_request(connection, request)
+            reply['id'] = request.get('id')
+            self.send(connection, reply)
+        self.remove_connection(connection)
+
+    def accept_connections(self):
+        while self.start_flag:
+            try:
+                client_socket, client_address = self.listen_socket.accept()
+            except OSError:
+                break
+            connection = Connection(client_socket)
+            with self.connections_lock:
+                self.connections.append(connection)
+            Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+
+    def start(self):
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+        self.listen_socket = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind(address)
+        self.listen_socket.listen()
+        if family == socket.AF_INET:
+            # Port 0 picks a free port, which the replicas need to know.
+            host, port = self.listen_socket.getsockname()
+            self.address = f'{host}:{port}'
+        self.start_flag = True
+        Thread(target=self.accept_connections, daemon=True).start()
+        Thread(target=self.publish_changes, daemon=True).start()
+
+    def stop(self):
+        if not self.start_flag:
+            return
+        self.start_flag = False
+        try:
+            # Wakes up the thread waiting for connections.
+            self.listen_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listen_socket.close()
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.socket.close()
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+
+
+def run_replica(feed_address: str, port: int = None, interface: str = None, process_delay: float = 0.1,
+                prefix: str = '', transaction_key: str = 'Virac:Transaction', max_transaction_size: int = 1000000):
+    """Serves the parameters of a Replica_Feed over CA under the same names until the feed closes. Writes are sent to
+    the primary and only accepted if the primary accepts them. Clients choose the replica with the port (and the
+    interface) it listens on, since the primary serves the same PVs."""
+
+    # pcaspy reads the port and interfaces of the server from the environment when the server is created.
+    if port is not None:
+        os.environ['EPICS_CAS_SERVER_PORT'] = str(port)
+    if interface is not None:
+        os.environ['EPICS_CAS_INTF_ADDR_LIST'] = interface
+    os.environ['EPICS_CA_MAX_ARRAY_BYTES'] = '10000000'
+
+    from pcaspy import Driver, SimpleServer
+
+    client = Socket_Client(feed_address)
+    reply = client.request({'op': 'definitions'})
+    pv_db = reply['definitions']
+    for key, value in reply['values'].items():
+        pv_db[key]['value'] = value
+
+    commit_key = transaction_key + ':Commit'
+    transaction_generation_key = transaction_key + ':Generation'
+    transaction_error_key = transaction_key + ':Error'
+    transaction_db = {commit_key: {'type': 'char', 'count': max_transaction_size},
+                      transaction_generation_key: {'type': 'int'},
+                      transaction_error_key: {'type': 'char', 'count': 1000}}
+
+    class ReplicaDriver(Driver):
+        def __init__(self):
+            Driver.__init__(self)
+
+        def write(self, reason, value):
+            if reason == commit_key:
+                return self.commit_transaction(value)
+            try:
+                client.set(reason, value)
+            except (RuntimeError, OSError) as e:
+                print(f'Warning: Write to {reason} rejected. {e}')
+                return False
+            # The primary publishes the value it uses (for example clamped to limits), which replaces this one.
+            return super().write(reason, value)
+
+        def commit_transaction(self, value) -> bool:
+            try:
+                generation = client.set_values(parse_transaction(value))
+            except (ValueError, RuntimeError, OSError) as e:
+                self.setParam(transaction_error_key, str(e))
+                self.updatePVs()
+                print(f'Warning: Transaction rejected. {e}')
+                return False
+            self.setParam(transaction_generation_key, generation)
+            self.setParam(transaction_error_key, '')
+            self.updatePVs()
+            return True
+
+    server = SimpleServer()
+    server.createPV(prefix, pv_db | transaction_db)
+    driver = ReplicaDriver()
+
+    # Updates arrive on the thread of the client and are posted by the thread running the CA server.
+    updates = SimpleQueue()
+    client.subscribe(list(pv_db.keys()), callback=updates.put)
+
+    while client.connected:
+        server.process(process_delay)
+        while True:
+            try:
+                new_values = updates.get_nowait()
+            except Empty:
+                break
+            for reason, value in new_values.items():
+                driver.setParam(reason, value)
+        driver.updatePVs()
+    client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve the PVs of a virtual accelerator from a read replica. Version ' + version('virtaccl'),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--feed', default='localhost:7790', type=str,
+                        help="Address ('host:port' or a Unix socket path) of the replica feed of the virtual "
+                             "accelerator.")
+    parser.add_argument('--port', default=5066, type=int,
+                        help='CA server port of the replica.')
+    parser.add_argument('--interface', default=None, type=str,
+                        help='Address of the network interface the replica serves on. None means all interfaces.')
+    parser.add_argument('--ca_proc', default=0.1, type=float,
+                        help='Number (in seconds) that determine some delay parameter in the server. Not exactly '
+                             'sure how it works, so use at your own risk.')
+    args = parser.parse_args()
+    run_replica(args.feed, args.port, args.interface, args.ca_proc)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,16 @@
 import os
 import sys
-from threading import Thread
+import json
+import zlib
+from threading import Thread, Event
 from datetime import datetime
-from time import sleep
+from time import monotonic
 from math import floor
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Set
 
-from virtaccl.server import Server
+import numpy as np
+
+from virtaccl.server import Server, PublishPolicy
 from virtaccl.virtual_accelerator import VA_Parser
 
 
@@ -21,32 +25,169 @@ def add_epics_arguments(va_parser: VA_Parser) -> VA_Parser:
                                   help='Number (in seconds) that determine some delay parameter in the server. Not '
                                        'exactly sure how it works, so use at your own risk.')
 
+    # Runs the CA server in a separate process, so it answers clients quickly even while the model is tracking.
+    va_parser.add_server_argument('--ca_process', action='store_true',
+                                  help='Run the CA server in its own process, exchanging values through shared '
+                                       'memory.')
+
+    # Serves the PVs over PV Access (p4p) instead of Channel Access.
+    va_parser.add_server_argument('--pva', action='store_true',
+                                  help='Serve the PVs over PV Access (p4p) instead of Channel Access.')
+
+    # Publishes the values in shared memory for fast clients on the same host (see SHM_Client).
+    va_parser.add_server_argument('--shm', default=None, type=str,
+                                  help='Name of a shared memory block to serve the values in, for clients on this '
+                                       'host (see SHM_Client), instead of EPICS. None means EPICS.')
+
+    # Read replicas serve the same PVs from other processes, so many displays don't slow down the virtual accelerator.
+    va_parser.add_server_argument('--replicas', default=0, type=int,
+                                  help='Number of read replica processes serving the same PVs over CA, each on its '
+                                       'own port starting at --replica_port. Writes to a replica are forwarded here.')
+    va_parser.add_server_argument('--replica_port', default=5066, type=int,
+                                  help='CA server port of the first read replica.')
+    va_parser.add_server_argument('--replica_feed', default='localhost:7790', type=str,
+                                  help="Address ('host:port' or a Unix socket path) the replicas get their values "
+                                       "from.")
+
     va_parser.remove_argument('--print_server_keys')
     va_parser.add_va_argument('--print_pvs', dest='print_server_keys', action='store_true',
                               help="Will print all server PVs. Will NOT run the virtual accelerator.")
     return va_parser
 
 
+def build_epics_server(**kwargs) -> Server:
+    """Returns the EPICS server selected by the arguments from add_epics_arguments, or the shared memory server."""
+
+    if kwargs.get('shm'):
+        from virtaccl.SHM_Server.shm_server import SHM_Server
+        return SHM_Server(kwargs['shm'])
+    if kwargs.get('pva'):
+        from virtaccl.EPICS_Server.pva_server import PVA_Server
+        return PVA_Server()
+    replica_options = {'replicas': kwargs.get('replicas', 0), 'replica_port': kwargs.get('replica_port', 5066),
+                       'replica_feed': kwargs.get('replica_feed', 'localhost:7790')}
+    if kwargs.get('ca_process'):
+        from virtaccl.EPICS_Server.ca_process_server import EPICS_Process_Server
+        return EPICS_Process_Server(process_delay=kwargs['ca_proc'], **replica_options)
+    return EPICS_Server(process_delay=kwargs['ca_proc'], **replica_options)
+
+
 class EPICS_Server(Server):
-    def __init__(self, prefix='', process_delay=0.1):
+    def __init__(self, prefix='', process_delay=0.1, read_window=10.0, transaction_key='Virac:Transaction',
+                 max_transaction_size=1000000, replicas=0, replica_port=5066, replica_feed='localhost:7790',
+                 min_process_delay=0.005):
         super().__init__()
         self.prefix = prefix
         self.driver = None
-        self.process_delay = process_delay
         self.start_flag = False
 
+        # The CA thread processes events for the minimum delay while clients or the virtual accelerator are active, and
+        # backs off to the process delay while idle. Stopping joins the thread, and the PVs are kept for a restart.
+        self.process_delay = process_delay
+        self.min_process_delay = min(min_process_delay, process_delay)
+        self.ca_server = None
+        self.ca_thread: Optional[Thread] = None
+        self.stop_event = Event()
+        self.activity = Event()
+
+        # Read replicas serve the same PVs from their own processes on the CA ports following the replica port, fed
+        # with the values of this server through the replica feed.
+        self.replicas = replicas
+        self.replica_port = replica_port
+        self.replica_feed = replica_feed
+        self.feed = None
+        self.replica_processes = []
+
+        # A client writes a json dictionary of PVs and values to the commit PV to change all of them at once. The
+        # generation PV then holds the settings generation of the transaction, and the error PV explains rejections.
+        self.transaction_key = transaction_key
+        self.commit_key = transaction_key + ':Commit'
+        self.transaction_generation_key = transaction_key + ':Generation'
+        self.transaction_error_key = transaction_key + ':Error'
+        self.max_transaction_size = max_transaction_size
+
+        # Publish policies of the PVs that have one, with the last value and time each of those PVs was published, and
+        # the latest value held back by a rate limit.
+        self.publish_policies: Dict[str, PublishPolicy] = {}
+        self.published_values: Dict[str, Any] = {}
+        self.published_times: Dict[str, float] = {}
+        self.held_values: Dict[str, tuple] = {}
+
+        # Time of the last client read of each PV. PVs read within the read window count as watched. Reads are
+        # answered by the CA thread, which can't wait for a track, so reads of out of date values get the current value
+        # and the new one follows as a monitor update.
+        self.read_times: Dict[str, float] = {}
+        self.read_window = read_window
+        self.wait_on_read = False
+
+        # Signature of the value last posted to each PV, so unchanged values are not passed to pcaspy again, and the
+        # counts of posted and suppressed updates.
+        self.posted_signatures: Dict[str, Any] = {}
+        self.posted_count = 0
+        self.suppressed_count = 0
+        self.pending_update = False
+
+        # The last timestamp converted to an EPICS timestamp. All PVs of a cycle share the same timestamp.
+        self.last_timestamp: Optional[datetime] = None
+        self.last_epics_timestamp = None
+
         os.environ['EPICS_CA_MAX_ARRAY_BYTES'] = '10000000'
 
     def _CA_events(self, server):
-        while True:
-            server.process(self.process_delay)
+        delay = self.min_process_delay
+        while not self.stop_event.is_set():
+            server.process(delay)
+            if self.activity.is_set():
+                self.activity.clear()
+                delay = self.min_process_delay
+            else:
+                delay = min(2 * delay, self.process_delay)
+        # Sends the values posted just before stopping.
+        server.process(self.min_process_delay)
+
+    def add_parameter(self, parameter_key: str, parameter_definitions: Dict[str, Any]):
+        super().add_parameter(parameter_key, parameter_definitions)
+        if parameter_definitions.get('publish_policy') is not None:
+            self.publish_policies[parameter_key] = parameter_definitions['publish_policy']
 
     def set_parameter(self, reason: str, value: Any, timestamp: datetime = None):
         super().set_parameter(reason, value, timestamp)
         if self.start_flag:
-            if timestamp is not None:
-                timestamp = self.driver.to_epics_timestamp(timestamp)
-            self.driver.setParam(reason, value, timestamp)
+            policy = self.publish_policies.get(reason)
+            if policy is not None:
+                if not policy.is_significant(self.published_values.get(reason), value):
+                    self.held_values.pop(reason, None)
+                    return
+                if not policy.is_due(self.published_times.get(reason), monotonic()):
+                    self.held_values[reason] = (value, timestamp)
+                    return
+            self._post(reason, value, timestamp)
+
+    def _post(self, reason: str, value: Any, timestamp: datetime = None):
+        if reason in self.publish_policies:
+            self.published_values[reason] = value
+            self.published_times[reason] = monotonic()
+            self.held_values.pop(reason, None)
+
+        signature = value_signature(value)
+        if reason in self.posted_signatures and self.posted_signatures[reason] == signature:
+            self.suppressed_count += 1
+            return
+        self.posted_signatures[reason] = signature
+        self.posted_count += 1
+        self.pending_update = True
+        self._send(reason, value, timestamp)
+
+    def _send(self, reason: str, value: Any, timestamp: datetime = None):
+        if timestamp is not None:
+            if timestamp != self.last_timestamp:
+                self.last_timestamp = timestamp
+                self.last_epics_timestamp = self.driver.to_epics_timestamp(timestamp)
+            timestamp = self.last_epics_timestamp
+        self.driver.setParam(reason, value, timestamp)
+
+    def get_update_counts(self) -> Dict[str, int]:
+        return {'posted': self.posted_count, 'suppressed': self.suppressed_count}
 
     def get_parameter(self, reason: str) -> Any:
         if self.start_flag:
@@ -55,20 +196,95 @@ class EPICS_Server(Server):
             value = super().get_parameter(reason)
         return value
 
+    def commit_transaction(self, value) -> bool:
+        try:
+            new_settings = parse_transaction(value)
+            generation = self.apply_transaction(new_settings)
+        except (ValueError, KeyError) as e:
+            self.driver.setParam(self.transaction_error_key, str(e))
+            self.driver.updatePVs()
+            print(f'Warning: Transaction rejected. {e}')
+            return False
+
+        self.driver.setParam(self.transaction_generation_key, generation)
+        self.driver.setParam(self.transaction_error_key, '')
+        self.driver.updatePVs()
+        return True
+
+    def get_subscribed_keys(self) -> Optional[Set[str]]:
+        if not self.start_flag:
+            return None
+        from pcaspy.driver import manager
+        monitored = {reason for reason, pv in manager.pvs[self.driver.port].items() if pv.interest}
+        now = monotonic()
+        recently_read = {reason for reason, read_time in list(self.read_times.items())
+                         if now - read_time < self.read_window}
+        return monitored | recently_read
+
+    def flush_held_values(self, everything: bool = False):
+        # Publish the values held back by rate limits once their time has come, or all of them when stopping.
+        now = monotonic()
+        for reason, (value, timestamp) in list(self.held_values.items()):
+            if everything or self.publish_policies[reason].is_due(self.published_times.get(reason), now):
+                self._post(reason, value, timestamp)
+
     def update(self):
         if self.driver is not None:
-            self.driver.updatePVs()
+            self.flush_held_values()
+            # All values posted since the last update are sent to the clients together.
+            if self.pending_update:
+                self.pending_update = False
+                self.driver.updatePVs()
+                self.activity.set()
 
     def start(self):
+        if self.start_flag:
+            return
+        if self.ca_server is not None:
+            self.restart()
+            return
         try:
             from pcaspy import Driver
             from pcaspy.cas import epicsTimeStamp
             from pcaspy import SimpleServer
 
+            epics_server = self
+
             class TDriver(Driver):
                 def __init__(self):
                     Driver.__init__(self)
 
+                def read(self, reason):
+                    epics_server.read_times[reason] = monotonic()
+                    epics_server.activity.set()
+                    if epics_server.read_callback is not None:
+                        epics_server.read_callback(reason)
+                    return super().read(reason)
+
+                def write(self, reason, value):
+                    if reason == epics_server.commit_key:
+                        return epics_server.commit_transaction(value)
+                    try:
+                        value = epics_server.validate_write(reason, value)
+                    except ValueError as e:
+                        print(f'Warning: Write to {reason} rejected. {e}')
+                        return False
+                    with epics_server.settings_lock:
+                        accepted = super().write(reason, value)
+                        # Only writes that were accepted count as a new settings generation.
+                        if accepted:
+                            epics_server.settings_generation += 1
+                            epics_server.queue_write(reason, value)
+                            # The client changed the value, so the next value from the model needs to be posted even
+                            # if it matches the last one posted.
+                            epics_server.posted_signatures.pop(reason, None)
+                            if epics_server.generation_key is not None:
+                                self.setParam(epics_server.generation_key, epics_server.settings_generation)
+                                epics_server.posted_signatures.pop(epics_server.generation_key, None)
+                    self.updatePVs()
+                    epics_server.activity.set()
+                    return accepted
+
                 def setParam(self, reason, value, timestamp=None):
                     super().setParam(reason, value)
                     if timestamp is not None:
@@ -83,27 +299,108 @@ class EPICS_Server(Server):
                     tst.nsec = int((epics_tst % 1) * 1_000_000_000)
                     return tst
 
-            server = SimpleServer()
-            server.createPV(self.prefix, self.parameter_db)
-            self.driver = TDriver()
-            tid = Thread(target=self._CA_events, args=(server,))
+            transaction_db = {self.commit_key: {'type': 'char', 'count': self.max_transaction_size},
+                              self.transaction_generation_key: {'type': 'int'},
+                              self.transaction_error_key: {'type': 'char', 'count': 1000}}
 
-            # So it will die after main thread is gone
-            tid.setDaemon(True)
-            tid.start()
+            self.ca_server = SimpleServer()
+            self.ca_server.createPV(self.prefix, self.parameter_db | transaction_db)
+            self.driver = TDriver()
+            self.start_ca_thread()
             self.run()
             self.start_flag = True
+            self.start_replicas()
         except Exception as e:
             print(f'Warning! CA communication is not available because of exception: {e}.')
             print(f'Check EPICS (pcaspy)  installation.')
 
+    def start_ca_thread(self):
+        self.stop_event.clear()
+        # Daemon thread, so it will die after main thread is gone.
+        self.ca_thread = Thread(target=self._CA_events, args=(self.ca_server,), daemon=True)
+        self.ca_thread.start()
+
+    def restart(self):
+        # The PVs of the first start are kept, so they only need the values set while the server was stopped.
+        self.posted_signatures.clear()
+        for reason, definitions in self.parameter_db.items():
+            if 'value' in definitions:
+                self.driver.setParam(reason, definitions['value'])
+        self.driver.updatePVs()
+        self.start_ca_thread()
+        self.start_flag = True
+        self.start_replicas()
+
+    def start_replicas(self):
+        if self.replicas < 1:
+            return
+        import multiprocessing as mp
+        from virtaccl.EPICS_Server.ca_replica import Replica_Feed, run_replica
+
+        self.feed = Replica_Feed(self, self.replica_feed)
+        self.feed.start()
+        context = mp.get_context('spawn')
+        for i in range(self.replicas):
+            process = context.Process(target=run_replica, daemon=True,
+                                      args=(self.feed.address, self.replica_port + i, None, self.process_delay,
+                                            self.prefix, self.transaction_key, self.max_transaction_size))
+            process.start()
+            self.replica_processes.append(process)
+        print(f'Started {self.replicas} read replicas on CA ports {self.replica_port} to '
+              f'{self.replica_port + self.replicas - 1}.')
+
+    def stop_replicas(self):
+        if self.feed is None:
+            return
+        # Replicas end once the feed closes their connections.
+        self.feed.stop()
+        for process in self.replica_processes:
+            process.join(timeout=5)
+        self.feed = None
+        self.replica_processes = []
+
     def stop(self):
-        # it's unclear how to gracefully stop the server
+        if not self.start_flag:
+            return
+        self.stop_replicas()
+        # The last values, including those held back by rate limits, are sent before the CA thread ends.
+        self.flush_held_values(everything=True)
+        self.update()
+        # Values written by clients are kept for a restart.
+        for reason, definitions in self.parameter_db.items():
+            definitions['value'] = self.driver.getParam(reason)
         self.start_flag = False
-        sleep(1)
+        self.stop_event.set()
+        self.ca_thread.join(timeout=self.process_delay + 1.0)
 
     def __str__(self):
         return 'Following PVs are registered:\n' + '\n'.join([f'{self.prefix}{k}' for k in self.parameter_db.keys()])
 
     def run(self):
         pass
+
+
+def parse_transaction(value) -> Dict[str, Any]:
+    """Returns the dictionary of PVs and values written to a transaction commit PV, either as a string or as the
+    characters of a char waveform."""
+
+    if isinstance(value, str):
+        transaction_text = value
+    else:
+        transaction_text = bytes(int(char) & 0xFF for char in value).decode(errors='replace')
+    transaction_text = transaction_text.rstrip('\x00')
+
+    new_settings = json.loads(transaction_text)
+    if not isinstance(new_settings, dict):
+        raise ValueError('The transaction needs to be a dictionary of PVs and values.')
+    return new_settings
+
+
+def value_signature(value: Any) -> Any:
+    """Returns a cheap signature of a value to compare with the last one posted. Scalars are their own signature, and
+    arrays are compared by shape, type, and a checksum of their data."""
+
+    if isinstance(value, (np.ndarray, list, tuple)):
+        array = np.ascontiguousarray(value)
+        return array.shape, array.dtype.str, zlib.crc32(array.tobytes())
+    return value
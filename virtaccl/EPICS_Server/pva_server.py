@@ -0,0 +1,192 @@
+from datetime import datetime
+from threading import RLock
+from typing import Any, Dict, Iterable, Optional, Set
+
+import numpy as np
+
+from virtaccl.EPICS_Server.ca_server import EPICS_Server, parse_transaction
+
+
+class PVA_Server(EPICS_Server):
+    """
+    EPICS server that serves the parameters over PV Access with p4p instead of Channel Access. Scalars and waveforms
+    are served as NTScalar, enums as NTEnum, and parameters whose definition has a 'shape' (screen images) as NTNDArray
+    built directly from the NumPy array. Every update carries its timestamp and the update cycle of the virtual
+    accelerator as pulse ID, in timeStamp.userTag (and uniqueId for NTNDArray).
+
+    Publish policies, skipping of unchanged values, transactions, and the write validator work as for EPICS_Server.
+    Clients connected to a PV count as watching it.
+    """
+
+    def __init__(self, prefix='', transaction_key='Virac:Transaction'):
+        super().__init__(prefix, transaction_key=transaction_key)
+        self.pva_server = None
+        self.pvs = {}
+        self.normative_types = {}
+        self.connected_keys: Set[str] = set()
+        # Values posted since the last update, sent to the clients together. Puts are handled on the threads of p4p,
+        # so the pending and held values are only changed while holding the post lock.
+        self.pending_values: Dict[str, tuple] = {}
+        self.post_lock = RLock()
+
+    def set_parameter(self, reason: str, value: Any, timestamp: datetime = None):
+        with self.post_lock:
+            super().set_parameter(reason, value, timestamp)
+
+    def _send(self, reason: str, value: Any, timestamp: datetime = None):
+        self.pending_values[reason] = (value, timestamp)
+
+    def post_pending(self, reasons: Iterable[str]):
+        # Sends the pending values of some PVs right away, leaving the others for the next update.
+        with self.post_lock:
+            new_values = {reason: self.pending_values.pop(reason) for reason in reasons
+                          if reason in self.pending_values}
+        for reason, (value, timestamp) in new_values.items():
+            self.pvs[reason].post(self.wrap(reason, value, timestamp))
+
+    def get_parameter(self, reason: str) -> Any:
+        return self.parameter_db[reason]['value']
+
+    def get_subscribed_keys(self) -> Optional[Set[str]]:
+        if not self.start_flag:
+            return None
+        return set(self.connected_keys)
+
+    def update(self):
+        if self.start_flag:
+            with self.post_lock:
+                self.flush_held_values()
+                new_values, self.pending_values = self.pending_values, {}
+            for reason, (value, timestamp) in new_values.items():
+                self.pvs[reason].post(self.wrap(reason, value, timestamp))
+
+    def wrap(self, reason: str, value: Any, timestamp: datetime = None):
+        """Returns the p4p Value of a parameter with its timestamp and the current cycle as pulse ID."""
+
+        definitions = self.parameter_db.get(reason, {})
+        nt = self.normative_types[reason]
+        if 'shape' in definitions:
+            dtype = np.uint8 if definitions.get('type') == 'char' else np.float64
+            wrapped = nt.wrap(np.asarray(value, dtype=dtype).reshape(definitions['shape']))
+            wrapped['uniqueId'] = self.cycle
+        elif definitions.get('type') == 'enum':
+            wrapped = nt.wrap({'index': int(value), 'choices': definitions.get('enums', [])})
+        else:
+            wrapped = nt.wrap(value)
+
+        seconds = (datetime.now() if timestamp is None else timestamp).timestamp()
+        wrapped['timeStamp.secondsPastEpoch'] = int(seconds)
+        wrapped['timeStamp.nanoseconds'] = int((seconds % 1) * 1_000_000_000)
+        wrapped['timeStamp.userTag'] = self.cycle
+        return wrapped
+
+    def receive_write(self, reason: str, value: Any):
+        """Handles a put by a client. Raises a ValueError if the value is rejected."""
+
+        if reason == self.commit_key:
+            self.commit_transaction(value)
+            return
+        new_value = self.validate_write(reason, value)
+        with self.settings_lock:
+            self.settings_generation += 1
+            # The client changed the value, so the next value from the model needs to be posted even if it matches
+            # the last one posted.
+            self.posted_signatures.pop(reason, None)
+            self.set_parameter(reason, new_value)
+            self.queue_write(reason, new_value)
+            if self.generation_key is not None:
+                self.set_parameter(self.generation_key, self.settings_generation)
+        # Only the written PV and the generation PV are sent. The values of the virtual accelerator wait for its update.
+        self.post_pending([reason, self.generation_key])
+
+    def commit_transaction(self, value) -> bool:
+        try:
+            new_settings = parse_transaction(value)
+            generation = self.apply_transaction(new_settings)
+        except (ValueError, KeyError) as e:
+            self.pvs[self.transaction_error_key].post(str(e))
+            raise ValueError(f'Transaction rejected. {e}')
+
+        self.post_pending(list(new_settings.keys()) + [self.generation_key])
+        self.pvs[self.transaction_generation_key].post(generation)
+        self.pvs[self.transaction_error_key].post('')
+        return True
+
+    def start(self):
+        try:
+            from p4p import Value
+            from p4p.nt import NTScalar, NTEnum, NTNDArray
+            from p4p.server import Server as P4PServer
+            from p4p.server.thread import SharedPV
+
+            pva_server = self
+
+            class Handler:
+                def __init__(self, reason: str):
+                    self.reason = reason
+
+                def put(self, pv, op):
+                    # NTScalar puts hold the value in the value field, and NTEnum puts in value.index.
+                    value = op.value()
+                    if isinstance(value, Value):
+                        value = value['value']
+                    if isinstance(value, Value):
+                        value = value['index']
+                    try:
+                        pva_server.receive_write(self.reason, value)
+                        op.done()
+                    except ValueError as e:
+                        print(f'Warning: Write to {self.reason} rejected. {e}')
+                        op.done(error=str(e))
+
+                def onFirstConnect(self, pv):
+                    pva_server.connected_keys.add(self.reason)
+
+                def onLastDisconnect(self, pv):
+                    pva_server.connected_keys.discard(self.reason)
+
+            def normative_type(definitions: Dict[str, Any]):
+                pv_type = definitions.get('type', 'float')
+                if 'shape' in definitions:
+                    return NTNDArray()
+                if pv_type == 'enum':
+                    return NTEnum()
+                if pv_type == 'string':
+                    return NTScalar('s')
+                type_code = {'int': 'i', 'char': 'B'}.get(pv_type, 'd')
+                if definitions.get('count', 1) > 1:
+                    type_code = 'a' + type_code
+                return NTScalar(type_code)
+
+            def initial_value(definitions: Dict[str, Any]):
+                value = definitions.get('value')
+                if definitions.get('type') == 'string':
+                    return '' if value is None else value
+                if definitions.get('count', 1) > 1 and np.ndim(value) == 0:
+                    return np.zeros(definitions['count'])
+                return 0 if value is None else value
+
+            transaction_db = {self.commit_key: {'type': 'string', 'value': ''},
+                              self.transaction_generation_key: {'type': 'int', 'value': 0},
+                              self.transaction_error_key: {'type': 'string', 'value': ''}}
+            all_definitions = self.parameter_db | transaction_db
+
+            for reason, definitions in all_definitions.items():
+                self.normative_types[reason] = normative_type(definitions)
+                self.pvs[reason] = SharedPV(nt=self.normative_types[reason], handler=Handler(reason))
+                self.pvs[reason].open(self.wrap(reason, initial_value(definitions)))
+
+            self.pva_server = P4PServer(providers=[{self.prefix + reason: pv for reason, pv in self.pvs.items()}])
+            self.start_flag = True
+        except Exception as e:
+            print(f'Warning! PVA communication is not available because of exception: {e}.')
+            print(f'Check p4p installation.')
+
+    def stop(self):
+        self.start_flag = False
+        if self.pva_server is not None:
+            self.pva_server.stop()
+            self.pva_server = None
+
+    def __str__(self):
+        return 'Following PVA PVs are registered:\n' + '\n'.join([f'{self.prefix}{k}' for k in self.parameter_db.keys()])
@@ -0,0 +1,40 @@
+from subprocess import Popen
+from time import sleep, monotonic
+from typing import Optional
+
+from epics import caget
+
+# Helpers for CA clients that step with the virtual accelerator through its Virac:Status PVs, instead of sleeping after
+# each caput.
+
+
+def wait_for_start(proc: Optional[Popen] = None, timeout: float = 60.0, prefix: str = ''):
+    """Waits until the virtual accelerator serves its PVs, which happens once it has tracked and started its server.
+    Raises a RuntimeError if the process of the virtual accelerator exits first, and a TimeoutError if the PVs are not
+    served within the timeout (in seconds)."""
+
+    start_time = monotonic()
+    while caget(prefix + 'Virac:Status:Cycle', connection_timeout=0.5) is None:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError('The virtual accelerator exited before serving PVs.')
+        if monotonic() - start_time > timeout:
+            raise TimeoutError(f'The virtual accelerator did not serve PVs within {timeout} s.')
+        sleep(0.1)
+
+
+def wait_for_update(timeout: float = 10.0, generation: Optional[int] = None, prefix: str = ''):
+    """Waits until the virtual accelerator has tracked with every setting written so far, or with the given settings
+    generation (for example the one of a transaction). Raises a TimeoutError if it has not within the timeout (in
+    seconds)."""
+
+    if generation is None:
+        generation = caget(prefix + 'Virac:Status:Settings_Generation')
+    start_time = monotonic()
+    while True:
+        applied_generation = caget(prefix + 'Virac:Status:Applied_Generation')
+        if generation is not None and applied_generation is not None and applied_generation >= generation:
+            return
+        if monotonic() - start_time > timeout:
+            raise TimeoutError(f'The virtual accelerator did not apply settings generation {generation} within '
+                               f'{timeout} s.')
+        sleep(0.05)
@@ -0,0 +1,313 @@
+import json
+import base64
+import struct
+import asyncio
+import hashlib
+from threading import Thread, Event
+from time import monotonic
+from urllib.parse import urlsplit, parse_qs
+from typing import Any, Dict, List, Optional, Set
+
+import numpy as np
+
+from virtaccl.server import Server
+from virtaccl.Socket_Server.socket_protocol import encode_message
+
+websocket_guid = '258EAFA5-E914-47A5-95CA-C5AB0DC85B11'
+
+
+class WebSocketClient:
+    """A connected WebSocket client with its subscriptions, the subscribed keys that changed since it was last sent,
+    and how it wants images."""
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.subscriptions: Set[str] = set()
+        self.changed_keys: Set[str] = set()
+        self.period = 0.0
+        self.last_sent = 0.0
+        self.image_rate = 1.0
+        self.image_binning = 1
+        self.last_image_sent = 0.0
+
+    async def send(self, payload: bytes, opcode: int = 2):
+        length = len(payload)
+        if length < 126:
+            frame_header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            frame_header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            frame_header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        self.writer.write(frame_header + payload)
+        await self.writer.drain()
+
+
+class HTTP_Gateway:
+    """
+    HTTP and WebSocket endpoint for GUIs and dashboards, running on its own asyncio loop next to the server of a
+    virtual accelerator. It follows the change journal of the server, so it works with any server.
+
+    HTTP:
+        GET /keys -> json list of keys
+        GET /values?keys=key1,key2 -> json dictionary of values (every key if none are given)
+        POST /values with a json dictionary of settings -> {"generation": int} or {"error": str}
+
+    WebSocket (/ws), requests are json text messages:
+        {"op": "subscribe", "keys": [...], "period": float, "image_rate": float, "image_binning": int}
+        {"op": "unsubscribe", "keys": [...] or null}
+        {"op": "set", "values": {...}, "id": any}
+        {"op": "get", "keys": [...], "id": any}
+    Replies and updates are binary messages in the format of socket_protocol (json header plus raw array bytes). An
+    update ({"op": "update", "values": {...}}) only holds the subscribed keys that changed since the last update to
+    that client, at most once per its period. Images (parameters with a 'shape') are sent at most at the client's image
+    rate, binned by its image binning. An image rate of 0 leaves images out of the updates.
+
+        Parameters
+        ----------
+        server : Server
+            Server of the virtual accelerator.
+        address : str, optional
+            'host:port' to listen on. Port 0 picks a free port. The default is 'localhost:8080'.
+        poll_period : float, optional
+            Time (in seconds) between checks of the change journal. The default is 0.05 s.
+    """
+
+    def __init__(self, server: Server, address: str = 'localhost:8080', poll_period: float = 0.05):
+        self.server = server
+        host, port = address.rsplit(':', 1)
+        self.host = host
+        self.port = int(port)
+        self.poll_period = poll_period
+        self.clients: List[WebSocketClient] = []
+        self.journal_position = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.listener: Optional[asyncio.AbstractServer] = None
+        self.thread: Optional[Thread] = None
+        self.started = Event()
+
+    def get_subscribed_keys(self) -> Set[str]:
+        return set().union(*[client.subscriptions for client in list(self.clients)])
+
+    def is_image(self, key: str) -> bool:
+        return 'shape' in self.server.parameter_db.get(key, {})
+
+    def get_values(self, keys, image_binning: int = 1) -> Dict[str, Any]:
+        values = {}
+        for key in keys:
+            value = self.server.get_parameter(key)
+            if self.is_image(key):
+                value = bin_image(np.asarray(value).reshape(self.server.parameter_db[key]['shape']), image_binning)
+            values[key] = value
+        return values
+
+    def start(self):
+        # Returns once the gateway listens, so the port is known.
+        self.started.clear()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    def stop(self):
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop = None
+
+    async def _close(self):
+        # Closing the listening socket frees the port. Connected clients are closed too.
+        self.listener.close()
+        for client in list(self.clients):
+            self.remove_client(client)
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.listener = self.loop.run_until_complete(
+                asyncio.start_server(self.handle_connection, self.host, self.port))
+            self.port = self.listener.sockets[0].getsockname()[1]
+        except OSError as e:
+            print(f'Warning: HTTP gateway could not listen on {self.host}:{self.port}. {e}')
+            self.loop.close()
+            self.loop = None
+            return
+        finally:
+            self.started.set()
+        publish_task = self.loop.create_task(self.publish_changes())
+        self.loop.run_forever()
+        publish_task.cancel()
+        self.loop.run_until_complete(asyncio.gather(publish_task, return_exceptions=True))
+        self.loop.close()
+
+    async def publish_changes(self):
+        while True:
+            await asyncio.sleep(self.poll_period)
+            changed_keys, self.journal_position = self.server.get_changes(self.journal_position)
+            now = monotonic()
+            for client in list(self.clients):
+                client.changed_keys |= changed_keys & client.subscriptions
+                if not client.changed_keys or now - client.last_sent < client.period:
+                    continue
+                keys = client.changed_keys
+                if client.image_rate <= 0 or now - client.last_image_sent < 1 / client.image_rate:
+                    # Images wait for the client's image rate.
+                    keys = {key for key in keys if not self.is_image(key)}
+                elif any(self.is_image(key) for key in keys):
+                    client.last_image_sent = now
+                if not keys:
+                    continue
+                client.changed_keys = client.changed_keys - keys
+                client.last_sent = now
+                message = {'op': 'update', 'values': self.get_values(keys, client.image_binning)}
+                try:
+                    await client.send(encode_message(message))
+                except (ConnectionError, OSError):
+                    self.remove_client(client)
+
+    def remove_client(self, client: WebSocketClient):
+        if client in self.clients:
+            self.clients.remove(client)
+        client.writer.close()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode().strip()
+            if not request_line:
+                writer.close()
+                return
+            method, target = request_line.split(' ')[:2]
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            url = urlsplit(target)
+            if url.path == '/ws' and headers.get('upgrade', '').lower() == 'websocket':
+                await self.serve_websocket(reader, writer, headers)
+                return
+            status, reply = self.handle_http(method, url.path, parse_qs(url.query), body)
+            reply_bytes = json.dumps(reply, default=json_default).encode()
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(reply_bytes)}\r\nAccess-Control-Allow-Origin: *\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + reply_bytes)
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        writer.close()
+
+    def handle_http(self, method: str, path: str, query: Dict[str, List[str]], body: bytes):
+        if method == 'GET' and path == '/keys':
+            return '200 OK', self.server.get_parameter_keys()
+        if path == '/values':
+            if method == 'GET':
+                keys = query['keys'][0].split(',') if 'keys' in query else self.server.get_parameter_keys()
+                unknown_keys = [key for key in keys if key not in self.server.parameter_db]
+                if unknown_keys:
+                    return '404 Not Found', {'error': f'Unknown parameters: {", ".join(unknown_keys)}'}
+                return '200 OK', self.get_values(keys)
+            if method == 'POST':
+                try:
+                    return '200 OK', {'generation': self.server.apply_transaction(json.loads(body))}
+                except (ValueError, KeyError) as e:
+                    return '400 Bad Request', {'error': str(e)}
+        return '404 Not Found', {'error': f'Unknown request: {method} {path}'}
+
+    async def serve_websocket(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                              headers: Dict[str, str]):
+        if 'sec-websocket-key' not in headers:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+            writer.close()
+            return
+        accept_key = base64.b64encode(hashlib.sha1((headers['sec-websocket-key'] + websocket_guid).encode()).digest())
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept_key + b'\r\n\r\n')
+        await writer.drain()
+
+        client = WebSocketClient(writer)
+        self.clients.append(client)
+        try:
+            while True:
+                opcode, payload = await read_frame(reader)
+                if opcode == 8:
+                    await client.send(payload[:2], opcode=8)
+                    break
+                elif opcode == 9:
+                    await client.send(payload, opcode=10)
+                elif opcode in (1, 2):
+                    reply = self.handle_websocket_request(client, json.loads(payload))
+                    if reply is not None:
+                        await client.send(encode_message(reply))
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        self.remove_client(client)
+
+    def handle_websocket_request(self, client: WebSocketClient, request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        op = request.get('op')
+        reply = {'op': op, 'id': request.get('id')}
+        if op == 'subscribe':
+            keys = set(request['keys']) & self.server.parameter_db.keys()
+            client.subscriptions |= keys
+            client.period = request.get('period', client.period)
+            client.image_rate = request.get('image_rate', client.image_rate)
+            client.image_binning = max(int(request.get('image_binning', client.image_binning)), 1)
+            # Start with the current values of the new keys.
+            client.changed_keys |= keys
+            return None
+        elif op == 'unsubscribe':
+            keys = request.get('keys')
+            client.subscriptions = set() if keys is None else client.subscriptions - set(keys)
+            return None
+        elif op == 'get':
+            keys = [key for key in request['keys'] if key in self.server.parameter_db]
+            return reply | {'values': self.get_values(keys, client.image_binning)}
+        elif op == 'set':
+            try:
+                return reply | {'generation': self.server.apply_transaction(request['values'])}
+            except (ValueError, KeyError) as e:
+                return reply | {'error': str(e)}
+        return reply | {'error': f'Unknown operation: {op}'}
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    """Returns the opcode and payload of the next WebSocket frame from a client, joining fragmented messages."""
+
+    payload = b''
+    message_opcode = 0
+    while True:
+        first, second = await reader.readexactly(2)
+        # Continuation frames have opcode 0 and keep the opcode of the first frame.
+        message_opcode = first & 0x0F or message_opcode
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', await reader.readexactly(8))[0]
+        mask = await reader.readexactly(4) if second & 0x80 else b'\x00\x00\x00\x00'
+        data = await reader.readexactly(length)
+        payload += bytes(byte ^ mask[i % 4] for i, byte in enumerate(data))
+        if first & 0x80:
+            return message_opcode, payload
+
+
+def bin_image(image: np.ndarray, binning: int) -> np.ndarray:
+    """Returns the image averaged over blocks of binning x binning pixels."""
+
+    if binning <= 1:
+        return image
+    rows, columns = image.shape[0] // binning, image.shape[1] // binning
+    blocks = image[:rows * binning, :columns * binning].reshape(rows, binning, columns, binning)
+    return blocks.mean(axis=(1, 3)).astype(image.dtype)
+
+
+def json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value)} is not JSON serializable')
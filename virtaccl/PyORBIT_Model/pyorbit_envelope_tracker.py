@@ -0,0 +1,233 @@
+import math
+from typing import Dict, List, Tuple, Optional, TYPE_CHECKING
+
+import numpy as np
+
+from orbit.core.bunch import Bunch
+
+from .pyorbit_va_nodes import BPMclass, PhysicsClass
+
+if TYPE_CHECKING:
+    from .pyorbit_lattice_controller import OrbitModel
+
+
+class EnvelopeTracker:
+    """
+    Propagates the centroid and the 6x6 sigma matrix of the input bunch through the lattice of an OrbitModel instead of
+    tracking every particle. The transfer map of each node on the lattice is found by tracking a small probe bunch
+    through that node (the centroid plus a positive and negative offset in each coordinate) and is cached using the
+    settings of the optics on the node and the incoming energy (and arrival time for RF gaps). Once the maps are cached,
+    propagating the envelope is only a few matrix products per node.
+
+    The BPM and physics nodes are filled from the envelope. Other diagnostics (like wire scanner profiles) need
+    particles and keep their values from the last particle track.
+
+        Parameters
+        ----------
+        model : OrbitModel
+            The model whose lattice and input bunch are used.
+        max_cache_size : int, optional
+            Number of transfer maps kept before the cache is cleared. The default is 100000.
+    """
+
+    # Offsets of the probe particles in (x[m], xp[rad], y[m], yp[rad], z[m], dE[GeV]).
+    probe_offsets = np.array([1e-6, 1e-6, 1e-6, 1e-6, 1e-5, 1e-7])
+    # Diagnostic node types the envelope can fill.
+    envelope_types = {BPMclass.node_type, PhysicsClass.node_type}
+
+    def __init__(self, model: 'OrbitModel', max_cache_size: int = 100000):
+        self.model = model
+        self.max_cache_size = max_cache_size
+
+        self.map_cache: Dict[tuple, Tuple[np.ndarray, np.ndarray, np.ndarray, float, float]] = {}
+        self.input_states: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+        self.lattice_nodes = []
+        self.rf_gap_indexes = set()
+        self.node_elements: Dict[int, List[str]] = {}
+        self.node_diagnostics: Dict[int, List[str]] = {}
+
+    def initialize(self):
+        """Finds the optics and diagnostics located at each node of the lattice. Needs to be called again if the
+        lattice of the model changes."""
+
+        model = self.model
+        lattice = model.accLattice
+        self.lattice_nodes = lattice.getNodes()
+        node_indexes = {id(node): index for index, node in enumerate(self.lattice_nodes)}
+        self.rf_gap_indexes = {node_indexes[id(gap)] for gap in lattice.getRF_Gaps() if id(gap) in node_indexes}
+
+        self.node_elements = {}
+        self.node_diagnostics = {}
+        for element_name, element_ref in model.get_element_dictionary().items():
+            element_type = element_ref.get_type()
+            if element_type in model.optic_classes:
+                if element_type == model.cavity_key:
+                    tracking_nodes = element_ref.get_element().getRF_GapNodes()
+                else:
+                    tracking_nodes = [element_ref.get_tracking_node()]
+                for node in tracking_nodes:
+                    self.node_elements.setdefault(node_indexes[id(node)], []).append(element_name)
+            elif element_type in EnvelopeTracker.envelope_types:
+                node_index = node_indexes[id(element_ref.get_tracking_node())]
+                self.node_diagnostics.setdefault(node_index, []).append(element_name)
+        self.map_cache.clear()
+
+    def reset(self):
+        """Forget the lattice layout and the cached maps, for example after nodes were added to the lattice."""
+
+        self.lattice_nodes = []
+        self.map_cache.clear()
+
+    def clear_input(self, beam_name: str):
+        """Forget the stored centroid and sigma matrix of an input beam after its bunch changed."""
+
+        self.input_states.pop(beam_name, None)
+
+    def get_input_state(self) -> Tuple[np.ndarray, np.ndarray]:
+        model = self.model
+        if model.active_beam not in self.input_states:
+            initial_bunch = model.bunch_dict['initial_bunch']
+            coordinates = bunch_coordinates(initial_bunch)
+            if len(coordinates) > 1:
+                centroid = np.mean(coordinates, axis=0)
+                sigma = np.cov(coordinates, rowvar=False, bias=True)
+            else:
+                centroid = np.zeros(6) if len(coordinates) == 0 else coordinates[0]
+                sigma = np.zeros((6, 6))
+            self.input_states[model.active_beam] = (centroid, sigma)
+        return self.input_states[model.active_beam]
+
+    def get_node_map(self, index: int, centroid: np.ndarray, energy: float,
+                     sync_time: float) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, float, float]]:
+        """Returns the affine transfer map (matrix, reference output, reference input, output energy, time of flight)
+        of a node for the given incoming state, or None if the probe bunch was lost in the node."""
+
+        model = self.model
+        settings = tuple((name, tuple(sorted(model.get_element_parameters(name).items())))
+                         for name in self.node_elements.get(index, []))
+        cache_key = (index, round(energy * 1e12), settings)
+        if index in self.rf_gap_indexes:
+            cache_key += (round(sync_time * 1e15),)
+        if cache_key in self.map_cache:
+            return self.map_cache[cache_key]
+
+        offsets = EnvelopeTracker.probe_offsets
+        probe = Bunch()
+        model.bunch_dict['initial_bunch'].copyEmptyBunchTo(probe)
+        probe.getSyncParticle().kinEnergy(energy)
+        probe.getSyncParticle().time(sync_time)
+        probe.addParticle(*centroid)
+        for i in range(6):
+            for sign in (1, -1):
+                particle = centroid.copy()
+                particle[i] += sign * offsets[i]
+                probe.addParticle(*particle)
+
+        model.accLattice.trackBunch(probe, paramsDict={'probe': True}, index_start=index, index_stop=index)
+        if probe.getSize() != 13:
+            return None
+
+        out = bunch_coordinates(probe)
+        transfer_matrix = np.column_stack([(out[2 * i + 1] - out[2 * i + 2]) / (2 * offsets[i]) for i in range(6)])
+        sync_part = probe.getSyncParticle()
+        node_map = (transfer_matrix, out[0], centroid.copy(), sync_part.kinEnergy(), sync_part.time() - sync_time)
+
+        if len(self.map_cache) >= self.max_cache_size:
+            self.map_cache.clear()
+        self.map_cache[cache_key] = node_map
+        return node_map
+
+    def sweep(self):
+        """Propagates the envelope through the lattice one node at a time. For each node, this yields the node index,
+        the centroid, sigma matrix, energy, and arrival time at the entrance of the node, and the node's transfer map.
+        The map is None if the probe bunch was lost in the node, which ends the sweep."""
+
+        model = self.model
+        if not self.lattice_nodes:
+            self.initialize()
+
+        initial_bunch = model.bunch_dict['initial_bunch']
+        sync_part = initial_bunch.getSyncParticle()
+        energy, sync_time = sync_part.kinEnergy(), sync_part.time()
+        centroid, sigma = self.get_input_state()
+
+        for index in range(len(self.lattice_nodes)):
+            node_map = self.get_node_map(index, centroid, energy, sync_time)
+            yield index, centroid, sigma, energy, sync_time, node_map
+            if node_map is None:
+                if model.debug:
+                    print(f'Probe bunch lost in "{self.lattice_nodes[index].getName()}".')
+                return
+            transfer_matrix, out_reference, in_reference, energy, time_of_flight = node_map
+            centroid = out_reference + transfer_matrix @ (centroid - in_reference)
+            sigma = transfer_matrix @ sigma @ transfer_matrix.T
+            sync_time += time_of_flight
+
+    def track(self) -> bool:
+        """Propagates the envelope through the whole lattice and fills the diagnostics.
+
+        Returns
+        ----------
+        out : bool
+            False if the probe bunch was lost, which means the envelope is not valid and particles need to be tracked.
+        """
+
+        initial_bunch = self.model.bunch_dict['initial_bunch']
+        if initial_bunch.getSize() == 0:
+            return False
+        mass = initial_bunch.mass()
+
+        for index, centroid, sigma, energy, sync_time, node_map in self.sweep():
+            for element_name in self.node_diagnostics.get(index, []):
+                self.fill_diagnostic(element_name, centroid, sigma, energy, sync_time, mass)
+            if node_map is None:
+                return False
+        return True
+
+    def fill_diagnostic(self, element_name: str, centroid: np.ndarray, sigma: np.ndarray, energy: float,
+                        sync_time: float, mass: float):
+        model = self.model
+        element_ref = model.get_element_controller(element_name)
+        element_type = element_ref.get_type()
+        gamma = 1 + energy / mass
+        beta = math.sqrt(1 - 1 / (gamma * gamma))
+        part_num = model.model_params['initial_particle_number']
+
+        if element_type == BPMclass.node_type:
+            rf_freq = element_ref.get_parameter('frequency')
+            phase_coeff = 2 * math.pi / (beta * 2.99792458e8 / rf_freq)
+            sync_phase = sync_time * rf_freq * 2 * math.pi
+            phi_avg = (phase_coeff * centroid[4] + sync_phase) % (2 * math.pi) - math.pi
+            phi_rms = phase_coeff * math.sqrt(max(sigma[4, 4], 0))
+            amp = abs(model.model_params['beam_current'] * math.exp(-phi_rms * phi_rms / 2))
+            element_ref.set_parameter('x_avg', centroid[0])
+            element_ref.set_parameter('y_avg', centroid[2])
+            element_ref.set_parameter('phi_avg', phi_avg)
+            element_ref.set_parameter('amp_avg', amp)
+
+        elif element_type == PhysicsClass.node_type:
+            for plane, i in (('x', 0), ('y', 2), ('z', 4)):
+                alpha, beta_twiss, emittance = twiss_from_sigma(sigma[i:i + 2, i:i + 2])
+                element_ref.set_parameter(plane + '_beta', beta_twiss)
+                element_ref.set_parameter(plane + '_alpha', alpha)
+                element_ref.set_parameter(plane + '_emit', emittance)
+            element_ref.set_parameter('energy', energy)
+            element_ref.set_parameter('beta', beta)
+            element_ref.set_parameter('part_num', part_num)
+
+
+def bunch_coordinates(bunch: Bunch) -> np.ndarray:
+    """Returns the coordinates of the particles in a bunch as an N x 6 array."""
+
+    return np.array([(bunch.x(n), bunch.xp(n), bunch.y(n), bunch.yp(n), bunch.z(n), bunch.dE(n))
+                     for n in range(bunch.getSize())]).reshape(-1, 6)
+
+
+def twiss_from_sigma(sigma_2d: np.ndarray) -> Tuple[float, float, float]:
+    """Returns (alpha, beta, emittance) from a 2x2 sigma matrix."""
+
+    emittance = math.sqrt(max(np.linalg.det(sigma_2d), 0))
+    if emittance == 0:
+        return 0.0, 0.0, 0.0
+    return -sigma_2d[0, 1] / emittance, sigma_2d[0, 0] / emittance, emittance
@@ -1,9 +1,11 @@
 import time
+import hashlib
 from datetime import datetime
-from typing import Union, List, Dict, Any
+from typing import Union, List, Dict, Any, Optional, Tuple, Set, Callable
 from pathlib import Path
 import json
 
+from orbit.lattice import AccActionsContainer
 from orbit.py_linac.lattice import BaseLinacNode
 from orbit.py_linac.lattice.LinacAccLatticeLib import LinacAccLattice
 from orbit.core.bunch import Bunch
@@ -11,7 +13,9 @@ from orbit.space_charge.sc3d import setUniformEllipsesSCAccNodes
 from orbit.core.spacecharge import SpaceChargeCalcUnifEllipse
 
 from .pyorbit_element_controllers import PyorbitNode, PyorbitChild, PyorbitCavity
-from .pyorbit_va_nodes import BunchCopyClass, PhysicsClass
+from .pyorbit_va_nodes import BunchCopyClass, PhysicsClass, WSclass, ScreenClass
+from .pyorbit_envelope_tracker import EnvelopeTracker
+from .pyorbit_orbit_response import OrbitResponse
 
 from virtaccl.model import Model
 
@@ -30,6 +34,8 @@ class OrbitModel(Model):
         debug : bool, optional, default = False
             Setting to True has the model print additional information when used
             (when the lattice is updated, the bunch is tracked, etc.).
+        handoff_dir : str or Path, optional
+            Directory where the bunch at the entrance of each sequence is saved after tracking.
     """
 
     # This creates a hint for the element dictionary for easier development.
@@ -37,7 +43,7 @@ class OrbitModel(Model):
     _element_dict_hint = Dict[str, _element_ref_hint]
 
     def __init__(self, input_lattice: LinacAccLattice = None, input_bunch: Bunch = None, debug: bool = False,
-                 save_bunch: str = None, physics_nodes: bool = False):
+                 save_bunch: str = None, physics_nodes: bool = False, handoff_dir: Union[str, Path] = None):
         super().__init__()
         self.debug = debug
         self.save_bunch = save_bunch
@@ -47,6 +53,7 @@ class OrbitModel(Model):
         self.bunch_flag = False
         self.physics_flag = physics_nodes
         self.physics_added_flag = False
+        self.space_charge_flag = False
 
         # A dictionary used in tracking to keep track of parameters useful to the model.
         self.model_params = {}
@@ -56,6 +63,53 @@ class OrbitModel(Model):
         # Store initial settings
         self.initial_optics = {}
 
+        # Fidelity of tracking. In 'envelope' mode only the centroid and sigma matrix are propagated, and changes are
+        # kept aside until particles are tracked again, which happens when a watched diagnostic needs particles or a
+        # node that removes particles (like a slit) is in the beam.
+        self.fidelity_options = ['particles', 'envelope']
+        self.fidelity = 'particles'
+        self.envelope_tracker = EnvelopeTracker(self)
+        self.stale_particle_changes = set()
+        self.particle_requests = set()
+
+        # Progressive tracking. Each tracking level keeps its own set of checkpoint bunches and pending changes. The
+        # coarse level tracks a subsample of the input bunch first, then refine tracks the full bunch.
+        self.coarse_particle_number = None
+        self.tracking_level = 'full'
+        self.level_bunches: Dict[str, Dict[str, Bunch]] = {}
+        self.level_params: Dict[str, Dict[str, Any]] = {}
+        self.level_changes: Dict[str, set] = {'full': set(), 'coarse': set()}
+        self.published_fidelity = 'full'
+
+        # Orbit response to the correctors. When predictions are on, changes of only correctors first update the BPM
+        # positions from the response, and the exact track is done by refine.
+        self.orbit_response = OrbitResponse(self)
+        self.predict_correctors = False
+        self.response_pending = False
+
+        # Function called during particle tracks to apply new settings. A new change upstream of the bunch cancels the
+        # track, which restarts from the checkpoint of that change. Changes downstream of the bunch are simply used when
+        # the bunch gets there.
+        self.tracking_callback: Optional[Callable[[], None]] = None
+        self.callback_period = 0.1
+        self.last_callback_time = 0.0
+        # Index of the node the bunch is entering during a particle track, None when not tracking.
+        self.tracking_index: Optional[int] = None
+
+        # Function given the measurements of diagnostics as soon as the bunch has passed them during a particle track.
+        self.streaming_callback: Optional[Callable[[Dict[str, Dict[str, Any]]], None]] = None
+        # Sorted (node index, element name) of the diagnostics on the lattice, and how many of them were streamed.
+        self.diagnostic_indexes: Optional[List[Tuple[int, str]]] = None
+        self.streamed_number = 0
+
+        # Elements whose measurements are needed, None for all. Tracking stops after the last needed diagnostic, and
+        # the bunch there is kept (under the resume key) so tracking can resume when something downstream is needed.
+        self.needed_elements: Optional[Set[str]] = None
+        self.resume_key = 'resume_bunch'
+
+        # Diagnostic nodes with expensive analysis, which is skipped while no client is watching them.
+        self.lazy_classes = {WSclass.node_type, ScreenClass.node_type, PhysicsClass.node_type}
+
         # Keys to designate different PyORBIT node types.
         quad_key = 'linacQuad'
         correctorH_key = 'dch'
@@ -84,6 +138,7 @@ class OrbitModel(Model):
 
         # Classes that can change the beam.
         self.optic_classes = {self.cavity_key, quad_key, correctorH_key, correctorV_key, bend_key}
+        self.corrector_classes = {correctorH_key, correctorV_key}
 
         # Classes that measure the beam.
         self.diagnostic_classes = set()
@@ -98,6 +153,26 @@ class OrbitModel(Model):
         self.pyorbit_dictionary: OrbitModel._element_dict_hint = {}
         # Dictionary of bunches that allow for tracking starting at changed optics.
         self.bunch_dict = {'initial_bunch': Bunch()}
+        # The bunch at the end of the lattice from the last track.
+        self.output_bunch = None
+
+        # Library of named input beams. Each beam keeps its own set of checkpoint bunches, the optics it was last
+        # tracked with, and its last measurements so that switching back to it does not need a full re-track.
+        self.input_beam_key = 'Input_Beam'
+        self.default_beam = 'default'
+        self.active_beam = self.default_beam
+        self.beam_library: Dict[str, Dict[str, Any]] = {self.default_beam: {}}
+        self.beam_fingerprints: Dict[str, str] = {}
+
+        # Sequence handoff bunches. When a directory is given, the bunch at the entrance of each sequence (after the
+        # first) is saved there after tracking, tagged with a hash of the input beam and the optics upstream of it. Only
+        # the latest bunches of each sequence are kept, along with the one tracked with the design optics.
+        self.handoff_dir = None
+        self.max_handoff_bunches = 20
+        self.handoff_nodes = {}
+        self.handoff_upstream: Dict[str, List[str]] = {}
+        if handoff_dir is not None:
+            self.handoff_dir = Path(handoff_dir)
 
         if input_lattice is not None:
             self.initialize_lattice(input_lattice)
@@ -181,6 +256,11 @@ class OrbitModel(Model):
         self.initial_optics = self.get_settings()
         self.lattice_flag = True
 
+        if self.handoff_dir is not None:
+            self.add_handoff_nodes()
+        self.envelope_tracker.reset()
+        self.diagnostic_indexes = None
+
         if self.physics_flag:
             self.add_physics_nodes()
 
@@ -201,6 +281,9 @@ class OrbitModel(Model):
             nEllipses = 1
             calcUnifEllips = SpaceChargeCalcUnifEllipse(nEllipses)
             setUniformEllipsesSCAccNodes(self.accLattice, minimum_sc_length, calcUnifEllips)
+            self.space_charge_flag = True
+            self.envelope_tracker.reset()
+            self.diagnostic_indexes = None
             if self.bunch_flag:
                 self.accLattice.trackDesignBunch(self.bunch_dict['initial_bunch'])
                 self.force_track()
@@ -228,6 +311,8 @@ class OrbitModel(Model):
                 self.pyorbit_dictionary[physics_name] = PyorbitChild(physics_node, node)
                 physics_node_names.append(physics_name)
             self.physics_added_flag = True
+            self.envelope_tracker.reset()
+            self.diagnostic_indexes = None
 
             if self.bunch_flag:
                 self.accLattice.trackDesignBunch(self.bunch_dict['initial_bunch'])
@@ -250,6 +335,7 @@ class OrbitModel(Model):
             The beam current in Amps.
         """
 
+        self.clear_beam_cache()
         initial_bunch.getSyncParticle().time(0.0)
         initial_bunch.copyBunchTo(self.bunch_dict['initial_bunch'])
         self.set_beam_current(beam_current)
@@ -260,6 +346,253 @@ class OrbitModel(Model):
             self.accLattice.trackDesignBunch(initial_bunch)
             self.force_track()
 
+    def track_input_bunch(self, input_bunch: Bunch, beam_current: float = None,
+                          initial_particle_number: int = None) -> Bunch:
+        """Replaces the input bunch without changing the lattice design and tracks it from the beginning. This is used
+        when the lattice is one section of a longer machine and the bunch comes from the section upstream of it.
+
+        Parameters
+        ----------
+        input_bunch : Bunch
+            PyORBIT bunch to track from the entrance of the lattice.
+        beam_current : float, optional
+            The beam current in Amps. If not given, the current is unchanged.
+        initial_particle_number : int, optional
+            Number of particles the bunch started with at the beginning of the machine. If not given, the number of
+            particles in input_bunch is used.
+
+        Returns
+        ----------
+        out : Bunch
+            The bunch at the end of the lattice.
+        """
+
+        self.clear_beam_cache()
+        input_bunch.copyBunchTo(self.bunch_dict['initial_bunch'])
+        if beam_current is not None:
+            self.set_beam_current(beam_current)
+        if initial_particle_number is None:
+            initial_particle_number = input_bunch.getSizeGlobal()
+        self.model_params['initial_particle_number'] = initial_particle_number
+        self.bunch_flag = True
+        self.force_track()
+        return self.output_bunch
+
+    def clear_beam_cache(self):
+        """Forget values derived from the active input bunch after it changed."""
+
+        self.beam_fingerprints.pop(self.active_beam, None)
+        self.envelope_tracker.clear_input(self.active_beam)
+        self.clear_coarse_level()
+        self.response_pending = False
+
+    def set_fidelity(self, fidelity: str):
+        """Set how the beam is tracked through the lattice.
+
+        Parameters
+        ----------
+        fidelity : string
+            'particles' tracks every particle of the bunch. 'envelope' propagates only the centroid and the sigma matrix
+            using cached linear maps, which is much faster but only fills the BPM and physics nodes.
+            Particles are still tracked when space charge is used or when particles are requested by a diagnostic.
+        """
+
+        if fidelity not in self.fidelity_options:
+            print(f'Error: Fidelity "{fidelity}" not recognized. Options are {", ".join(self.fidelity_options)}.')
+            return
+        self.fidelity = fidelity
+
+    def require_particles(self, element_names: Set[str]):
+        """Designate the watched elements. While any of them is a diagnostic the envelope does not fill (histograms,
+        images, losses), particles are tracked even in envelope mode.
+
+        Parameters
+        ----------
+        element_names : set[string]
+            Names of the watched elements. An empty set clears the request.
+        """
+
+        particle_classes = self.diagnostic_classes - EnvelopeTracker.envelope_types
+        self.particle_requests = {element_name for element_name in element_names
+                                  if element_name in self.pyorbit_dictionary
+                                  and self.pyorbit_dictionary[element_name].get_type() in particle_classes}
+
+    def beam_intercepted(self) -> bool:
+        """Returns True if a node that removes particles from the beam (for example a slit) is in the beam. The
+        linear maps of the envelope can't describe it, so particles need to be tracked."""
+
+        for element_ref in self.pyorbit_dictionary.values():
+            if element_ref.get_type() not in self.optic_classes:
+                continue
+            node = element_ref.get_element()
+            if hasattr(node, 'intercepts_beam') and node.intercepts_beam():
+                return True
+        return False
+
+    def set_progressive(self, coarse_particle_number: Optional[int]):
+        """Turn on progressive tracking. Each track first uses a subsample of the input bunch, and refine then tracks
+        the full bunch. Both levels keep their own checkpoints, so each only re-tracks from its own changes.
+
+        Parameters
+        ----------
+        coarse_particle_number : int or None
+            Number of particles used for the quick track. None turns progressive tracking off.
+        """
+
+        self.set_tracking_level('full')
+        self.coarse_particle_number = coarse_particle_number
+        self.clear_coarse_level()
+
+    def clear_coarse_level(self):
+        """Forget the coarse checkpoints, for example after the input bunch changed."""
+
+        if self.tracking_level == 'coarse':
+            self.set_tracking_level('full')
+        self.level_bunches.pop('coarse', None)
+        self.level_changes['coarse'] = set()
+
+    def set_tracking_level(self, level: str):
+        """Swap in the checkpoint bunches and pending changes of a tracking level ('full' or 'coarse')."""
+
+        if level == self.tracking_level:
+            return
+
+        # Store the state of the current level.
+        self.level_bunches[self.tracking_level] = dict(self.bunch_dict)
+        self.level_params[self.tracking_level] = {'initial_particle_number':
+                                                      self.model_params.get('initial_particle_number')}
+        self.level_changes[self.tracking_level] |= self.current_changes
+
+        if level not in self.level_bunches:
+            # Build the coarse level from particles spread evenly through the full input bunch, keeping the same
+            # intensity. Bunch files are often sorted (for example by longitudinal position), so the first particles
+            # would not be a fair sample.
+            full_bunch = self.bunch_dict['initial_bunch']
+            full_number = full_bunch.getSize()
+            coarse_bunch = Bunch()
+            full_bunch.copyEmptyBunchTo(coarse_bunch)
+            coarse_number = min(self.coarse_particle_number, full_number)
+            for n in range(coarse_number):
+                i = n * full_number // coarse_number
+                coarse_bunch.addParticle(full_bunch.x(i), full_bunch.xp(i), full_bunch.y(i), full_bunch.yp(i),
+                                         full_bunch.z(i), full_bunch.dE(i))
+            if coarse_number > 0:
+                coarse_bunch.macroSize(full_bunch.macroSize() * full_number / coarse_number)
+            self.level_bunches[level] = {'initial_bunch': coarse_bunch}
+            self.level_params[level] = {'initial_particle_number': coarse_bunch.getSizeGlobal()}
+            self.level_changes[level] = {'initial_bunch'}
+
+        level_bunches = self.level_bunches[level]
+        for bunch_key in self.bunch_dict.keys():
+            if bunch_key not in level_bunches:
+                level_bunches[bunch_key] = Bunch()
+            self.bunch_dict[bunch_key] = level_bunches[bunch_key]
+        self.model_params |= self.level_params[level]
+        self.current_changes = self.level_changes[level]
+        self.level_changes[level] = set()
+        self.tracking_level = level
+
+    def add_change(self, element_name: str):
+        """Records a change to be tracked. During a coarse progressive track the full level needs the change too, so
+        refine tracks it."""
+
+        self.current_changes.add(element_name)
+        if self.tracking_level == 'coarse':
+            self.level_changes['full'].add(element_name)
+
+    def refine(self) -> bool:
+        """Tracks the full bunch after a quick track (a coarse progressive track or a corrector prediction).
+
+        Returns
+        ----------
+        out : bool
+            True if the full bunch was tracked and the measurements changed.
+        """
+
+        if not self.refinement_pending():
+            return False
+        self.response_pending = False
+        self.set_tracking_level('full')
+        if not self.current_changes:
+            return False
+        self.track(quick=False)
+        return True
+
+    def refinement_pending(self) -> bool:
+        """Returns True if the last track was a coarse progressive track or a corrector prediction."""
+
+        return self.response_pending or self.tracking_level == 'coarse'
+
+    def set_orbit_response(self, predict_correctors: bool = True):
+        """Turn on predictions of the BPM positions from the orbit response when only correctors changed.
+
+        Parameters
+        ----------
+        predict_correctors : bool, optional
+            True to turn predictions on, False to turn them off.
+        """
+
+        self.predict_correctors = predict_correctors
+        # The measurements are only a base if nothing is left to track.
+        if predict_correctors and not self.current_changes:
+            self.orbit_response.capture_base()
+
+    def get_response_matrix(self) -> Optional[Dict[str, Any]]:
+        """Returns the linear response of the BPM positions to the correctors for the current optics.
+
+        Returns
+        ----------
+        out : dictionary or None
+            Dictionary with the lists of 'bpms' and 'correctors' and the 'x' and 'y' response arrays in meters per
+            Tesla, each with one row per BPM and one column per corrector. None if it could not be computed.
+        """
+
+        if not self.lattice_flag or not self.bunch_flag:
+            print('Error: Initialize a lattice and bunch in order to compute the orbit response.')
+            return None
+        return self.orbit_response.get_response()
+
+    def predict_orbit(self) -> bool:
+        """Predicts the BPM positions from the orbit response if only correctors changed.
+
+        Returns
+        ----------
+        out : bool
+            True if the BPM positions were predicted and the changes still need to be tracked.
+        """
+
+        changed_elements = self.current_changes - {self.resume_key}
+        if not changed_elements or self.tracking_level != 'full' or self.use_envelope():
+            return False
+        for element_name in changed_elements:
+            if element_name not in self.pyorbit_dictionary:
+                return False
+            if self.pyorbit_dictionary[element_name].get_type() not in self.corrector_classes:
+                return False
+        if not self.orbit_response.predict():
+            return False
+        self.response_pending = True
+        self.published_fidelity = 'response'
+        return True
+
+    def get_model_status(self) -> Dict[str, Any]:
+        """Returns the fidelity ('full', 'coarse', or 'envelope') and the number of particles of the last track.
+
+        Returns
+        ----------
+        out : dictionary
+            Dictionary with the 'fidelity' and 'particle_number' of the values currently in the diagnostics.
+        """
+
+        return {'fidelity': self.published_fidelity,
+                'particle_number': self.model_params.get('initial_particle_number', 0)}
+
+    def use_envelope(self) -> bool:
+        """Returns True if the next track will propagate the envelope instead of particles."""
+
+        return (self.fidelity == 'envelope' and not self.space_charge_flag and not self.particle_requests
+                and not self.beam_intercepted())
+
     def set_beam_current(self, beam_current: float):
         """Set the beam current for the initial bunch.
 
@@ -271,6 +604,242 @@ class OrbitModel(Model):
 
         self.model_params['beam_current'] = beam_current
 
+    def add_input_beam(self, beam_name: str, input_bunch: Bunch, beam_current: float = 40e-3):
+        """Add a named input bunch to the library of input beams. The beam is not tracked until it is selected. The
+        design of the lattice is always set by the bunch given to set_initial_bunch, so library beams should have the
+        same design energy as that bunch.
+
+        Parameters
+        ----------
+        beam_name : string
+            Name used to select the beam.
+        input_bunch : Bunch
+            PyORBIT bunch that the model will track from the entrance of the lattice when this beam is selected.
+        beam_current : float, optional
+            The beam current in Amps.
+        """
+
+        if beam_name == self.active_beam:
+            print(f'Warning: "{beam_name}" is the active beam. Use set_initial_bunch to change it.')
+            return
+
+        library_bunch = Bunch()
+        input_bunch.getSyncParticle().time(0.0)
+        input_bunch.copyBunchTo(library_bunch)
+        self.beam_library[beam_name] = {'bunches': {'initial_bunch': library_bunch},
+                                        'model_params': {'beam_current': beam_current,
+                                                         'initial_particle_number': input_bunch.getSizeGlobal()},
+                                        'optics': None, 'changes': set(), 'measurements': {}}
+
+    def get_input_beams(self) -> List[str]:
+        """Returns a list of the names of all beams in the input beam library, starting with the default beam.
+
+        Results
+        ----------
+        out : list[string]
+            List of input beam names.
+        """
+
+        return list(self.beam_library.keys())
+
+    def get_active_beam(self) -> str:
+        """Returns the name of the input beam currently used for tracking.
+
+        Results
+        ----------
+        out : string
+            Name of the active input beam.
+        """
+
+        return self.active_beam
+
+    def select_input_beam(self, beam_name: str):
+        """Switch the input beam used for tracking. The checkpoint bunches and measurements of the current beam are
+        stored in the library, and those of the selected beam are restored. Only the optics that changed since the
+        selected beam was last tracked are re-tracked, so switching back to a beam with unchanged optics needs no
+        tracking at all.
+
+        Parameters
+        ----------
+        beam_name : string
+            Name of the input beam in the library.
+        """
+
+        if beam_name == self.active_beam:
+            return
+        if beam_name not in self.beam_library:
+            print(f'Error: Input beam "{beam_name}" is not in the beam library.')
+            return
+
+        # Only the full level is kept in the library. The coarse level is rebuilt from the new beam. A prediction of the
+        # current beam is not refined, since its changes are stored with it and tracked when it is selected again.
+        self.clear_coarse_level()
+        self.response_pending = False
+        current_settings = self.get_settings()
+        beam_params = ['beam_current', 'initial_particle_number']
+
+        # Store the state of the current beam. The pending changes are kept since its checkpoints do not include them.
+        self.beam_library[self.active_beam] = {
+            'bunches': dict(self.bunch_dict),
+            'model_params': {key: self.model_params[key] for key in beam_params if key in self.model_params},
+            'optics': current_settings, 'changes': self.current_changes | self.stale_particle_changes,
+            'measurements': self.get_measurements()}
+
+        # Swap the selected beam's bunches into the dictionary referenced by the bunch saver nodes.
+        new_beam = self.beam_library[beam_name]
+        beam_bunches = new_beam['bunches']
+        for bunch_key in self.bunch_dict.keys():
+            if bunch_key not in beam_bunches:
+                beam_bunches[bunch_key] = Bunch()
+            self.bunch_dict[bunch_key] = beam_bunches[bunch_key]
+        self.model_params |= new_beam['model_params']
+        self.active_beam = beam_name
+
+        # Restore the measurements from the last time the beam was tracked. Diagnostics downstream of any change are
+        # overwritten when the beam is tracked again.
+        for element_name, measurement in new_beam['measurements'].items():
+            element_ref = self.pyorbit_dictionary[element_name]
+            for param, value in measurement.items():
+                element_ref.set_parameter(param, value)
+
+        self.stale_particle_changes = set()
+        if new_beam['optics'] is None:
+            self.current_changes = {'initial_bunch'}
+        else:
+            self.current_changes = set(new_beam['changes'])
+            for element_name, params in current_settings.items():
+                if new_beam['optics'].get(element_name) != params:
+                    self.current_changes.add(element_name)
+
+        if self.debug:
+            print(f'Input beam changed to "{beam_name}".')
+
+    def set_handoff_directory(self, handoff_dir: Union[str, Path], max_bunches: int = 20):
+        """Designate a directory where the bunch at the entrance of each sequence is saved after tracking with the full
+        bunch. These handoff bunches let a model of only the downstream sequences start with a beam consistent with the
+        upstream optics (see load_handoff_bunch).
+
+        Parameters
+        ----------
+        handoff_dir : str or Path
+            Location of the directory for the handoff bunches and their index file.
+        max_bunches : int, optional
+            Number of handoff bunches kept for each sequence. Older bunches are deleted, except the one tracked with the
+            design optics. The default is 20.
+        """
+
+        self.handoff_dir = Path(handoff_dir)
+        self.max_handoff_bunches = max_bunches
+        if self.lattice_flag:
+            self.add_handoff_nodes()
+
+    def add_handoff_nodes(self):
+        """Attaches bunch saver nodes at the entrance of every sequence after the first one in the lattice."""
+
+        sequences = self.accLattice.getSequences()
+        setting_names = list(self.get_settings().keys())
+        for sequence in sequences[1:]:
+            sequence_name = sequence.getName()
+            bunch_key = sequence_name + ':handoff'
+            if bunch_key in self.bunch_dict or not sequence.getNodes():
+                continue
+            location_node = sequence.getNodes()[0]
+            self.bunch_dict[bunch_key] = Bunch()
+            location_node.addChildNode(BunchCopyClass(bunch_key + ':copyBunch', bunch_key, self.bunch_dict),
+                                       location_node.ENTRANCE)
+            self.handoff_nodes[sequence_name] = location_node
+
+            # Optics elements upstream of the sequence determine the handoff bunch.
+            location_index = self.accLattice.getNodeIndex(location_node)
+            upstream_elements = []
+            for element_name in setting_names:
+                tracking_node = self.pyorbit_dictionary[element_name].get_tracking_node()
+                if self.accLattice.getNodeIndex(tracking_node) < location_index:
+                    upstream_elements.append(element_name)
+            self.handoff_upstream[sequence_name] = sorted(upstream_elements)
+
+    def get_beam_fingerprint(self) -> str:
+        """Returns a hash identifying the active input bunch.
+
+        Results
+        ----------
+        out : string
+            Hexadecimal hash of the active input bunch.
+        """
+
+        if self.active_beam not in self.beam_fingerprints:
+            initial_bunch = self.bunch_dict['initial_bunch']
+            bunch_hash = hashlib.sha1()
+            sync_part = initial_bunch.getSyncParticle()
+            bunch_hash.update(repr((initial_bunch.getSize(), initial_bunch.macroSize(), sync_part.kinEnergy(),
+                                    self.model_params.get('beam_current'))).encode())
+            for n in range(initial_bunch.getSize()):
+                bunch_hash.update(repr((initial_bunch.x(n), initial_bunch.xp(n), initial_bunch.y(n),
+                                        initial_bunch.yp(n), initial_bunch.z(n), initial_bunch.dE(n))).encode())
+            self.beam_fingerprints[self.active_beam] = bunch_hash.hexdigest()
+        return self.beam_fingerprints[self.active_beam]
+
+    def save_handoff_bunches(self, start_index: int = -1, stop_index: int = None):
+        """Saves the handoff bunches of all sequences downstream of the given node index to the handoff directory and
+        records them in the directory's index file.
+
+        Parameters
+        ----------
+        start_index : int, optional
+            Lattice index tracking started from. Handoff bunches upstream of it did not change and are not saved.
+        stop_index : int, optional
+            Lattice index tracking stopped at. Handoff bunches downstream of it were not reached and are not saved.
+        """
+
+        self.handoff_dir.mkdir(parents=True, exist_ok=True)
+        index_file = self.handoff_dir / 'index.json'
+        handoff_index = {}
+        if index_file.exists():
+            with open(index_file, "r") as json_file:
+                handoff_index = json.load(json_file)
+
+        beam_fingerprint = self.get_beam_fingerprint()
+        for sequence_name, location_node in self.handoff_nodes.items():
+            node_index = self.accLattice.getNodeIndex(location_node)
+            if node_index < start_index or (stop_index is not None and node_index > stop_index):
+                continue
+            upstream_elements = self.handoff_upstream[sequence_name]
+            upstream_optics = self.get_settings(upstream_elements)
+            tag = handoff_tag(beam_fingerprint, upstream_optics)
+
+            handoff_bunch = self.bunch_dict[sequence_name + ':handoff']
+            bunch_file = f'{sequence_name}_{tag[:16]}.dat'
+            handoff_bunch.dumpBunch(str(self.handoff_dir / bunch_file))
+
+            sequence_index = handoff_index.setdefault(sequence_name, {'bunches': {}})
+            sequence_index['upstream_elements'] = upstream_elements
+            design_optics = {name: self.initial_optics[name] for name in upstream_elements}
+            sequence_index['design_optics'] = design_optics
+            sequence_index['latest'] = tag
+            sync_part = handoff_bunch.getSyncParticle()
+            # Entries are kept in the order they were saved, so a bunch saved again moves to the end.
+            sequence_bunches = sequence_index['bunches']
+            sequence_bunches.pop(tag, None)
+            sequence_bunches[tag] = {'file': bunch_file, 'beam': beam_fingerprint,
+                                              'beam_current': self.model_params['beam_current'],
+                                              'initial_particle_number': self.model_params['initial_particle_number'],
+                                              'kin_energy': sync_part.kinEnergy(), 'sync_time': sync_part.time(),
+                                              'saved': datetime.now().isoformat()}
+
+            # Delete the oldest bunches of the sequence beyond the limit.
+            design_tag = handoff_tag(beam_fingerprint, design_optics)
+            old_tags = [old_tag for old_tag in sequence_bunches if old_tag not in (tag, design_tag)]
+            while len(sequence_bunches) > self.max_handoff_bunches and old_tags:
+                old_info = sequence_bunches.pop(old_tags.pop(0))
+                old_file = self.handoff_dir / old_info['file']
+                if old_file.exists():
+                    old_file.unlink()
+
+        with open(index_file, "w") as json_file:
+            json.dump(handoff_index, json_file, indent=4)
+        if self.debug:
+            print(f'Handoff bunches saved in "{self.handoff_dir}".')
+
     def get_element_list(self) -> List[str]:
         """Returns a list of all element key names currently maintained in the model.
 
@@ -420,6 +989,8 @@ class OrbitModel(Model):
             ancestor = parent.get_element()
         ancestor.addChildNode(child_node, ancestor.ENTRANCE)
         self.get_element_dictionary()[child_name] = PyorbitChild(child_node, ancestor)
+        self.envelope_tracker.reset()
+        self.diagnostic_indexes = None
 
         if child_node.getType() not in self.modeled_elements:
             print(f'Warning: The node type "{child_node.getType()}" is not in the current list of node types managed by'
@@ -538,10 +1109,245 @@ class OrbitModel(Model):
         for element_name in good_names:
             element_dict = self.get_element_parameters(element_name)
             return_dict[element_name] = element_dict
+
         return return_dict
 
-    def track(self) -> None:
-        """Tracks the bunch through the lattice. Tracks from the most upstream change to the end."""
+    def set_tracking_callback(self, callback: Optional[Callable[[], None]], callback_period: float = 0.1) -> None:
+        """Gives the model a function that applies new settings (using update_optics) during particle tracks.
+
+        Parameters
+        ----------
+        callback : function or None
+            Function without arguments, or None to remove it.
+        callback_period : float, optional
+            Minimum time in seconds between calls of the function. The default is 0.1 seconds.
+        """
+
+        self.tracking_callback = callback
+        self.callback_period = callback_period
+
+    def set_streaming_callback(self, callback: Optional[Callable[[Dict[str, Dict[str, Any]]], None]]) -> None:
+        """Gives the model a function that receives the measurements of diagnostics as the bunch passes them during
+        particle tracks, so upstream diagnostics can be published before the track is finished.
+
+        Parameters
+        ----------
+        callback : function or None
+            Function taking a dictionary of measurements in the same format as get_measurements, or None to remove it.
+        """
+
+        self.streaming_callback = callback
+
+    def get_diagnostic_indexes(self) -> List[Tuple[int, str]]:
+        """Returns the node index and name of every element that is not an optic, sorted along the lattice."""
+
+        if self.diagnostic_indexes is None:
+            node_indexes = {id(node): index for index, node in enumerate(self.accLattice.getNodes())}
+            diagnostic_indexes = []
+            for element_name, element_ref in self.pyorbit_dictionary.items():
+                node_id = id(element_ref.get_tracking_node())
+                if element_ref.get_type() not in self.optic_classes and node_id in node_indexes:
+                    diagnostic_indexes.append((node_indexes[node_id], element_name))
+            self.diagnostic_indexes = sorted(diagnostic_indexes)
+        return self.diagnostic_indexes
+
+    def stream_measurements(self):
+        """Gives the measurements of the diagnostics the bunch has passed since the last call to the streaming
+        callback."""
+
+        diagnostic_indexes = self.get_diagnostic_indexes()
+        passed_names = []
+        while self.streamed_number < len(diagnostic_indexes):
+            node_index, element_name = diagnostic_indexes[self.streamed_number]
+            if node_index >= self.tracking_index:
+                break
+            passed_names.append(element_name)
+            self.streamed_number += 1
+        if passed_names:
+            self.streaming_callback(self.get_measurements(passed_names))
+
+    def set_needed_elements(self, element_names: Optional[Set[str]]) -> None:
+        """Sets which elements need their measurements updated. Tracking stops after the last of them, and the rest of
+        the lattice is tracked once something downstream is needed again.
+
+        Parameters
+        ----------
+        element_names : set of strings or None
+            Names of the needed elements, or None if all elements are needed.
+        """
+
+        self.needed_elements = None if element_names is None else set(element_names)
+
+    def set_observed_elements(self, element_names: Optional[Set[str]]) -> None:
+        """Sets which elements clients are watching. Wire scanner, screen, and physics nodes that are not watched skip
+        their analysis. When one is watched again, the bunch is tracked again from the checkpoint upstream of it.
+
+        Parameters
+        ----------
+        element_names : set of strings or None
+            Names of the watched elements, or None if all elements are watched.
+        """
+
+        for element_name, element_ref in self.pyorbit_dictionary.items():
+            if element_ref.get_type() not in self.lazy_classes:
+                continue
+            node = element_ref.get_element()
+            active = element_names is None or element_name in element_names
+            if active and not node.active:
+                self.add_change(self.get_checkpoint_name(self.get_change_index(element_name)))
+            node.active = active
+
+    def get_checkpoint_name(self, node_index: int) -> str:
+        """Returns the name of the closest checkpoint bunch at or upstream of a node, or 'initial_bunch' if there is
+        none."""
+
+        checkpoint_name = 'initial_bunch'
+        checkpoint_index = -1
+        for element_name in self.bunch_dict.keys():
+            if element_name not in self.pyorbit_dictionary:
+                continue
+            element_index = self.get_change_index(element_name)
+            if checkpoint_index < element_index <= node_index:
+                checkpoint_name = element_name
+                checkpoint_index = element_index
+        return checkpoint_name
+
+    def get_end_index(self) -> Optional[int]:
+        """Returns the index of the last node that needs to be tracked for the needed elements, or None if the whole
+        lattice needs to be tracked."""
+
+        if self.needed_elements is None:
+            return None
+        end_index = -1
+        for node_index, element_name in self.get_diagnostic_indexes():
+            if element_name in self.needed_elements:
+                end_index = node_index
+        if end_index >= len(self.accLattice.getNodes()) - 1:
+            return None
+        return end_index
+
+    def get_change_index(self, element_name: str) -> int:
+        """Returns the index of the node where a change to an element affects the bunch, -1 if the whole lattice is
+        affected."""
+
+        if element_name == self.resume_key:
+            resume_bunch = self.bunch_dict.get(self.resume_key)
+            if resume_bunch is not None and resume_bunch.hasBunchAttrInt('resume_index'):
+                return resume_bunch.bunchAttrInt('resume_index')
+            return -1
+        if element_name not in self.pyorbit_dictionary:
+            return -1
+        location_node = self.pyorbit_dictionary[element_name].get_tracking_node()
+        return self.accLattice.getNodeIndex(location_node)
+
+    def find_track_start(self) -> Tuple[int, Optional[str]]:
+        """Returns the node index and checkpoint name to track from for the current changes. The name is None when
+        tracking from the start of the lattice."""
+
+        if 'initial_bunch' in self.current_changes:
+            return -1, None
+
+        upstream_index = float('inf')
+        upstream_name = None
+        for element_name in self.current_changes:
+            ind_check = self.get_change_index(element_name)
+            if ind_check < upstream_index:
+                upstream_index = ind_check
+                upstream_name = element_name
+
+        if upstream_index < 0 or upstream_name not in self.bunch_dict:
+            return -1, None
+        return upstream_index, upstream_name
+
+    def check_new_changes(self, params_dict: Dict[str, Any]):
+        """Tracking action that streams the passed diagnostics and applies new settings as the bunch enters each node
+        of the lattice."""
+
+        if params_dict['parentNode'] is not self.accLattice:
+            return
+        self.tracking_index += 1
+        if time.time() - self.last_callback_time < self.callback_period:
+            return
+        self.last_callback_time = time.time()
+
+        if self.streaming_callback is not None:
+            self.stream_measurements()
+        if self.tracking_callback is None:
+            return
+
+        known_changes = set(self.current_changes)
+        tracked_beam = self.active_beam
+        self.tracking_callback()
+        if self.active_beam != tracked_beam:
+            raise TrackCancelled(-1)
+        new_changes = self.current_changes - known_changes
+        if self.tracking_level == 'coarse':
+            self.level_changes['full'] |= new_changes
+        if new_changes:
+            restart_index = min(self.get_change_index(element_name) for element_name in new_changes)
+            # The bunch has already passed this change, so the rest of the track is wasted.
+            if restart_index < self.tracking_index:
+                raise TrackCancelled(restart_index)
+
+    def track_particles(self, tracked_bunch: Bunch, start_index: int, end_index: int = None):
+        """Tracks a bunch from a node to the end of the lattice (or the end index), calling the tracking and streaming
+        callbacks between nodes."""
+
+        stop_index = -1 if end_index is None else end_index
+        if self.tracking_callback is None and self.streaming_callback is None:
+            self.accLattice.trackBunch(tracked_bunch, paramsDict=self.model_params, index_start=start_index,
+                                       index_stop=stop_index)
+            return
+
+        # The lattice adds its own tracking action to the container, so a new one is needed for every track.
+        action_container = AccActionsContainer()
+        action_container.addAction(self.check_new_changes, AccActionsContainer.ENTRANCE)
+        self.tracking_index = max(start_index, 0) - 1
+        self.last_callback_time = time.time()
+        # Diagnostics upstream of the start did not change.
+        self.streamed_number = 0
+        if self.streaming_callback is not None:
+            diagnostic_indexes = self.get_diagnostic_indexes()
+            while (self.streamed_number < len(diagnostic_indexes)
+                   and diagnostic_indexes[self.streamed_number][0] < start_index):
+                self.streamed_number += 1
+        try:
+            self.accLattice.trackBunch(tracked_bunch, paramsDict=self.model_params, actionContainer=action_container,
+                                       index_start=start_index, index_stop=stop_index)
+        finally:
+            self.tracking_index = None
+
+    def track(self, quick: bool = True, end_index: int = None) -> None:
+        """Tracks the bunch through the lattice. Tracks from the most upstream change to the end. In envelope mode, the
+        envelope is propagated instead unless particles are needed.
+
+        Parameters
+        ----------
+        quick : bool, optional
+            Allow quick approximate results (corrector predictions and coarse progressive tracks) that are finished by
+            refine. The default is True.
+        end_index : int, optional
+            Index of the last node to track. Tracking past it is deferred until a later track needs it. The default is
+            found from the needed elements (see set_needed_elements).
+        """
+
+        if end_index is None and self.lattice_flag:
+            end_index = self.get_end_index()
+
+        if quick and self.predict_correctors and self.lattice_flag and self.bunch_flag and self.predict_orbit():
+            return
+
+        # A progressive track starts with the coarse level. The full level needs the same changes when refined.
+        if quick and self.coarse_particle_number is not None and not self.use_envelope() and self.current_changes:
+            new_changes = set(self.current_changes)
+            self.set_tracking_level('coarse')
+            self.current_changes |= new_changes
+            self.level_changes['full'] |= new_changes
+
+        # Changes made while propagating the envelope still need to be tracked with particles.
+        if self.stale_particle_changes and not self.use_envelope():
+            self.current_changes |= self.stale_particle_changes
+            self.stale_particle_changes = set()
 
         if not self.lattice_flag:
             print('Error: Initialize a lattice in order to start tracking.')
@@ -552,63 +1358,108 @@ class OrbitModel(Model):
             # print("No changes to track through.")
             pass
 
-        else:
-            track_start_time = time.time()
-
-            # I wanted to freeze the lattice to make sure no modifications could be made to it while it is tracking.
-            # Still trying to figure out the best way to do so.
-            # frozen_lattice = copy.deepcopy(self.accLattice)
-            frozen_lattice = self.accLattice
-            frozen_changes = self.current_changes
-            tracked_bunch = Bunch()
+        elif self.use_envelope() and self.track_envelope():
+            self.stale_particle_changes |= self.current_changes
+            self.current_changes = set()
+            self.published_fidelity = 'envelope'
+            if self.predict_correctors:
+                self.orbit_response.capture_base()
 
-            # Determine the furthest upstream node where an optic has been changed.
-            if 'initial_bunch' in frozen_changes:
-                upstream_index = -1
-                upstream_name = None
+        elif end_index is not None and (end_index < 0 or self.find_track_start()[0] > end_index):
+            # Nothing needed has changed. The changes stay pending until something downstream of them is needed.
+            pass
 
-            else:
-                upstream_index = float('inf')
-                upstream_name = None
-                for element_name in frozen_changes:
-                    location_node = self.pyorbit_dictionary[element_name].get_tracking_node()
-                    ind_check = frozen_lattice.getNodeIndex(location_node)
-                    if ind_check < upstream_index:
-                        upstream_index = ind_check
-                        upstream_name = element_name
-
-                if upstream_name not in self.bunch_dict:
-                    upstream_index = -1
-                    upstream_name = None
-
-            if upstream_name is None:
-                # If no bunch is found for that node, track from the beginning.
-                self.bunch_dict['initial_bunch'].copyBunchTo(tracked_bunch)
-                if self.debug:
-                    print("Tracking bunch from start...")
-            else:
-                # Use the bunch in the dictionary associated with the node that tracking will start with.
-                self.bunch_dict[upstream_name].copyBunchTo(tracked_bunch)
-                if self.debug:
-                    print("Tracking bunch from " + upstream_name + "...")
+        else:
+            self.current_changes |= self.stale_particle_changes
+            self.stale_particle_changes = set()
+            track_start_time = time.time()
 
-            # Track bunch
-            frozen_lattice.trackBunch(tracked_bunch, paramsDict=self.model_params, index_start=upstream_index)
+            while True:
+                # Determine the furthest upstream node where an optic has been changed.
+                upstream_index, upstream_name = self.find_track_start()
+                tracked_bunch = Bunch()
+                if upstream_name is None:
+                    # If no bunch is found for that node, track from the beginning.
+                    self.bunch_dict['initial_bunch'].copyBunchTo(tracked_bunch)
+                    if self.debug:
+                        print("Tracking bunch from start...")
+                else:
+                    # Use the bunch in the dictionary associated with the node that tracking will start with.
+                    self.bunch_dict[upstream_name].copyBunchTo(tracked_bunch)
+                    if self.debug:
+                        print("Tracking bunch from " + upstream_name + "...")
+
+                # Track bunch
+                try:
+                    self.track_particles(tracked_bunch, upstream_index, end_index)
+                    break
+                except TrackCancelled as cancel:
+                    # Changes upstream of the restart were already tracked through, and the checkpoint at the restart
+                    # includes them.
+                    self.current_changes = {element_name for element_name in self.current_changes
+                                            if self.get_change_index(element_name) >= cancel.restart_index}
+                    if not self.current_changes:
+                        # A different input beam was selected that has nothing left to track.
+                        return
+                    if self.debug:
+                        print("New change upstream of the bunch. Restarting the track...")
+
+            self.published_fidelity = self.tracking_level
+            if self.predict_correctors and self.tracking_level == 'full':
+                # BPMs past the end of a truncated track keep old positions, so they can't be a base for predictions.
+                if end_index is None:
+                    self.orbit_response.capture_base()
+                else:
+                    self.orbit_response.clear_base()
             track_time_taken = time.time() - track_start_time
             if self.debug:
                 print(f"Bunch tracked. Tracking time was {round(track_time_taken, 3)} seconds")
-            if self.save_bunch:
-                tracked_bunch.dumpBunch(self.save_bunch)
-                print(f'Final bunch saved as "{self.save_bunch}"')
+            if self.handoff_dir is not None and self.tracking_level == 'full':
+                self.save_handoff_bunches(upstream_index, end_index)
+
+            if end_index is not None:
+                # Keep the bunch where tracking stopped. Any changes downstream of it are covered by resuming from it.
+                resume_bunch = Bunch()
+                tracked_bunch.copyBunchTo(resume_bunch)
+                resume_bunch.bunchAttrInt('resume_index', end_index + 1)
+                self.bunch_dict[self.resume_key] = resume_bunch
+                self.current_changes = {self.resume_key}
+                if self.debug:
+                    print(f"Tracking stopped at node {end_index}. The rest of the lattice is tracked when needed.")
+            else:
+                self.output_bunch = tracked_bunch
+                if self.save_bunch:
+                    tracked_bunch.dumpBunch(self.save_bunch)
+                    print(f'Final bunch saved as "{self.save_bunch}"')
 
-            # Clear the set of changes
-            self.current_changes = set()
+                # Clear the set of changes
+                self.current_changes = set()
+
+    def track_envelope(self) -> bool:
+        """Propagates the centroid and sigma matrix of the initial bunch through the lattice and fills the diagnostics
+        that can be computed from them.
+
+        Returns
+        ----------
+        out : bool
+            False if the envelope could not be propagated (for example the probe was lost on an aperture).
+        """
+
+        track_start_time = time.time()
+        success = self.envelope_tracker.track()
+        if self.debug:
+            track_time_taken = time.time() - track_start_time
+            if success:
+                print(f"Envelope tracked. Tracking time was {round(track_time_taken, 3)} seconds")
+            else:
+                print("Envelope tracking failed. Tracking particles instead.")
+        return success
 
     def force_track(self) -> None:
         """Tracks the bunch through the lattice. Tracks from the beginning to the end."""
 
         # Clear the set of changes to force tracking from the beginning of the lattice.
-        self.current_changes.add('initial_bunch')
+        self.add_change('initial_bunch')
         self.track()
 
     def update_optics(self, changed_optics: Dict[str, Dict[str, Any]]) -> None:
@@ -623,7 +1474,9 @@ class OrbitModel(Model):
 
         pyorbit_dict = self.pyorbit_dictionary
         for element_name, param_dict in changed_optics.items():
-            if element_name not in pyorbit_dict.keys():
+            if element_name == self.input_beam_key:
+                self.select_input_beam(param_dict['name'])
+            elif element_name not in pyorbit_dict.keys():
                 print(f'PyORBIT element "{element_name}" not found.')
             elif pyorbit_dict[element_name].get_type() in self.optic_classes:
                 element_ref = pyorbit_dict[element_name]
@@ -638,7 +1491,7 @@ class OrbitModel(Model):
                         # Resolution at which point the parameter will be changed.
                         elif abs(new_value - current_value) > 1e-12:
                             element_ref.set_parameter(param, new_value)
-                            self.current_changes.add(element_name)
+                            self.add_change(element_name)
                             if self.debug:
                                 print(f'Value of "{param}" in "{element_name}" changed from {current_value} to '
                                       f'{new_value}.')
@@ -695,3 +1548,64 @@ class OrbitModel(Model):
         saved_diagnostics = self.get_measurements()
         with open(filename, "w") as json_file:
             json.dump(saved_diagnostics, json_file, indent=4)
+
+
+class TrackCancelled(Exception):
+    """Raised during a particle track when a new change is upstream of the bunch."""
+
+    def __init__(self, restart_index: int):
+        super().__init__(restart_index)
+        self.restart_index = restart_index
+
+
+def handoff_tag(beam_fingerprint: str, upstream_optics: Dict[str, Dict[str, Any]]) -> str:
+    """Returns the hash used to tag a handoff bunch from the input beam and the optics upstream of the handoff."""
+
+    tag_source = json.dumps({'beam': beam_fingerprint, 'optics': upstream_optics}, sort_keys=True)
+    return hashlib.sha1(tag_source.encode()).hexdigest()
+
+
+def load_handoff_bunch(handoff_dir: Union[str, Path], sequence_name: str,
+                       optics_file: Union[str, Path] = None) -> Optional[Tuple[Bunch, float]]:
+    """Finds the stored handoff bunch at the entrance of a sequence that matches the upstream optics. If no optics file
+    is given, the bunch tracked with the design upstream optics is used.
+
+    Parameters
+    ----------
+    handoff_dir : str or Path
+        Directory containing the handoff bunches and their index file.
+    sequence_name : string
+        Name of the sequence the bunch enters.
+    optics_file : str or Path, optional
+        A json optics file (see OrbitModel.save_optics) with the upstream settings to match.
+
+    Returns
+    ----------
+    out : tuple(Bunch, float) or None
+        The handoff bunch and its beam current in Amps, or None if no matching bunch was found.
+    """
+
+    index_file = Path(handoff_dir) / 'index.json'
+    if not index_file.exists():
+        return None
+    with open(index_file, "r") as json_file:
+        handoff_index = json.load(json_file)
+    if sequence_name not in handoff_index:
+        return None
+
+    sequence_index = handoff_index[sequence_name]
+    upstream_optics = sequence_index['design_optics']
+    if optics_file is not None:
+        with open(optics_file, "r") as json_file:
+            input_optics = json.load(json_file)
+        upstream_optics = {name: input_optics.get(name, params) for name, params in upstream_optics.items()}
+
+    for tag, bunch_info in sequence_index['bunches'].items():
+        if handoff_tag(bunch_info['beam'], upstream_optics) == tag:
+            handoff_bunch = Bunch()
+            handoff_bunch.readBunch(str(Path(handoff_dir) / bunch_info['file']))
+            handoff_bunch.getSyncParticle().kinEnergy(bunch_info['kin_energy'])
+            print(f'Using handoff bunch "{bunch_info["file"]}" for sequence {sequence_name}.')
+            return handoff_bunch, bunch_info['beam_current']
+    print(f'No handoff bunch for sequence {sequence_name} matches the upstream optics.')
+    return None
@@ -0,0 +1,181 @@
+from typing import Dict, List, Any, Optional, TYPE_CHECKING
+
+import numpy as np
+
+from .pyorbit_va_nodes import BPMclass
+
+if TYPE_CHECKING:
+    from .pyorbit_lattice_controller import OrbitModel
+
+
+class OrbitResponse:
+    """
+    Linear response of the BPM positions to every corrector in an OrbitModel. The response is found in one sweep of the
+    envelope tracker: the kick of each corrector is the finite difference of its node's map, and all kicks are carried
+    downstream together as the columns of one 6 x N matrix. The result is cached for each state of the other optics
+    (quadrupoles, cavities, etc.) and input beam, since correctors barely change the linear optics.
+
+    When only correctors changed since the last exact track, the model can predict the BPM positions as the measured
+    positions plus the response times the change in corrector fields, and track exactly afterwards. The measured
+    positions are kept for each input beam and only used with the input bunch they were tracked with.
+
+        Parameters
+        ----------
+        model : OrbitModel
+            The model whose lattice, input beam, and envelope tracker are used.
+        corrector_delta : float, optional
+            Change of the corrector field [T] used for the finite differences. The default is 1e-4 T.
+    """
+
+    corrector_key = 'B'
+
+    def __init__(self, model: 'OrbitModel', corrector_delta: float = 1e-4):
+        self.model = model
+        self.corrector_delta = corrector_delta
+        self.response_cache: Dict[tuple, Dict[str, Any]] = {}
+
+        # Corrector fields and BPM positions from the last exact track of each input beam, with the fingerprint of the
+        # input bunch they were tracked with.
+        self.bases: Dict[str, Dict[str, Any]] = {}
+
+    def get_corrector_names(self) -> List[str]:
+        model = self.model
+        return [name for name, element_ref in model.get_element_dictionary().items()
+                if element_ref.get_type() in model.corrector_classes]
+
+    def get_bpm_names(self) -> List[str]:
+        return [name for name, element_ref in self.model.get_element_dictionary().items()
+                if element_ref.get_type() == BPMclass.node_type]
+
+    def state_key(self) -> tuple:
+        model = self.model
+        settings = model.get_settings()
+        return (model.active_beam,) + tuple((name, tuple(sorted(params.items())))
+                                            for name, params in sorted(settings.items())
+                                            if model.get_element_controller(name).get_type()
+                                            not in model.corrector_classes)
+
+    def get_response(self) -> Optional[Dict[str, Any]]:
+        """Returns the response for the current optics, computing it if needed.
+
+        Returns
+        ----------
+        out : dictionary or None
+            Dictionary with the lists of 'bpms' and 'correctors' and the 'x' and 'y' response arrays in meters per
+            Tesla, each with one row per BPM and one column per corrector. None if the response could not be computed.
+        """
+
+        key = self.state_key()
+        if key not in self.response_cache:
+            response = self.compute()
+            if response is None:
+                return None
+            self.response_cache.clear()
+            self.response_cache[key] = response
+        return self.response_cache[key]
+
+    def compute(self) -> Optional[Dict[str, Any]]:
+        model = self.model
+        tracker = model.envelope_tracker
+        corrector_names = self.get_corrector_names()
+        bpm_names = self.get_bpm_names()
+        corrector_columns = {name: j for j, name in enumerate(corrector_names)}
+        bpm_rows = {name: i for i, name in enumerate(bpm_names)}
+
+        x_response = np.zeros((len(bpm_names), len(corrector_names)))
+        y_response = np.zeros((len(bpm_names), len(corrector_names)))
+        kicks = np.zeros((6, len(corrector_names)))
+
+        for index, centroid, sigma, energy, sync_time, node_map in tracker.sweep():
+            for element_name in tracker.node_diagnostics.get(index, []):
+                if element_name in bpm_rows:
+                    x_response[bpm_rows[element_name]] = kicks[0]
+                    y_response[bpm_rows[element_name]] = kicks[2]
+            if node_map is None:
+                return None
+
+            kicks = node_map[0] @ kicks
+            for element_name in tracker.node_elements.get(index, []):
+                if element_name in corrector_columns:
+                    kick = self.corrector_kick(element_name, index, centroid, energy, sync_time)
+                    if kick is None:
+                        return None
+                    kicks[:, corrector_columns[element_name]] += kick
+
+        return {'bpms': bpm_names, 'correctors': corrector_names, 'x': x_response, 'y': y_response}
+
+    def corrector_kick(self, corrector_name: str, index: int, centroid: np.ndarray, energy: float,
+                       sync_time: float) -> Optional[np.ndarray]:
+        """Returns the change of the coordinates at the exit of a corrector's node per Tesla of corrector field."""
+
+        tracker = self.model.envelope_tracker
+        element_ref = self.model.get_element_controller(corrector_name)
+        field = element_ref.get_parameter(OrbitResponse.corrector_key)
+
+        outputs = []
+        for sign in (1, -1):
+            element_ref.set_parameter(OrbitResponse.corrector_key, field + sign * self.corrector_delta)
+            node_map = tracker.get_node_map(index, centroid, energy, sync_time)
+            if node_map is None:
+                element_ref.set_parameter(OrbitResponse.corrector_key, field)
+                return None
+            transfer_matrix, out_reference, in_reference = node_map[:3]
+            outputs.append(out_reference + transfer_matrix @ (centroid - in_reference))
+        element_ref.set_parameter(OrbitResponse.corrector_key, field)
+        return (outputs[0] - outputs[1]) / (2 * self.corrector_delta)
+
+    def capture_base(self):
+        """Stores the corrector fields and BPM positions after an exact track as the base for predictions."""
+
+        model = self.model
+        self.bases[model.active_beam] = {
+            'beam': model.get_beam_fingerprint(),
+            'correctors': {name: model.get_parameter(name, OrbitResponse.corrector_key)
+                           for name in self.get_corrector_names()},
+            'bpms': {name: (model.get_parameter(name, 'x_avg'), model.get_parameter(name, 'y_avg'))
+                     for name in self.get_bpm_names()}}
+
+    def clear_base(self):
+        """Forgets the base of the active input beam, for example after a track that stopped before the last BPM."""
+
+        self.bases.pop(self.model.active_beam, None)
+
+    def get_base(self) -> Optional[Dict[str, Any]]:
+        """Returns the base of the active input beam, or None if there is none for its current input bunch."""
+
+        model = self.model
+        base = self.bases.get(model.active_beam)
+        if base is None or base['beam'] != model.get_beam_fingerprint():
+            return None
+        return base
+
+    def predict(self) -> bool:
+        """Sets the BPM positions predicted from the change of corrector fields since the last exact track.
+
+        Returns
+        ----------
+        out : bool
+            False if there is no base or response to predict from.
+        """
+
+        base = self.get_base()
+        if base is None:
+            return False
+        response = self.get_response()
+        if response is None:
+            return False
+        base_correctors, base_bpms = base['correctors'], base['bpms']
+
+        model = self.model
+        fields = {name: model.get_parameter(name, OrbitResponse.corrector_key) for name in response['correctors']}
+        field_changes = np.array([field - base_correctors.get(name, field) for name, field in fields.items()])
+        x_changes = response['x'] @ field_changes
+        y_changes = response['y'] @ field_changes
+        for i, bpm_name in enumerate(response['bpms']):
+            if bpm_name not in base_bpms:
+                continue
+            x_base, y_base = base_bpms[bpm_name]
+            element_ref = model.get_element_controller(bpm_name)
+            element_ref.set_parameter('x_avg', x_base + x_changes[i])
+            element_ref.set_parameter('y_avg', y_base + y_changes[i])
+        return True
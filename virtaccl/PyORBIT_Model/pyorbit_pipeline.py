@@ -0,0 +1,252 @@
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import Callable, List, Dict, Any
+
+import numpy as np
+
+from orbit.core.bunch import Bunch
+
+from .pyorbit_lattice_controller import OrbitModel
+
+
+# Tools to split a lattice into sections that are tracked in separate processes. Each section is owned by a worker
+# process with its own OrbitModel, and bunches are passed between sections through shared memory. While section k tracks
+# pulse n + 1, section k + 1 can track pulse n, so the throughput for many pulses scales with the number of sections.
+
+
+class BunchBuffer:
+    """
+    A block of shared memory that holds one bunch. The block starts with a header describing the bunch followed by the
+    six coordinates (x, xp, y, yp, z, dE) of each particle.
+
+        Parameters
+        ----------
+        capacity : int
+            Maximum number of particles the buffer can hold.
+        name : str, optional
+            Name of an existing shared memory block. If not given, a new block is created.
+    """
+
+    header_keys = ['particle_number', 'kin_energy', 'sync_time', 'macro_size', 'mass', 'charge', 'beam_current',
+                   'initial_particle_number']
+    header_size = len(header_keys)
+
+    def __init__(self, capacity: int, name: str = None):
+        self.capacity = capacity
+        buffer_size = (BunchBuffer.header_size + 6 * capacity) * np.dtype(np.float64).itemsize
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=buffer_size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.array = np.ndarray((BunchBuffer.header_size + 6 * capacity,), dtype=np.float64, buffer=self.memory.buf)
+
+    def write(self, bunch: Bunch, beam_current: float, initial_particle_number: int):
+        part_num = bunch.getSize()
+        if part_num > self.capacity:
+            print(f'Warning: Bunch has {part_num} particles, but the buffer only holds {self.capacity}. Extra '
+                  f'particles are dropped.')
+            part_num = self.capacity
+
+        coordinates = self.array[BunchBuffer.header_size:BunchBuffer.header_size + 6 * part_num].reshape(part_num, 6)
+        for n in range(part_num):
+            coordinates[n] = (bunch.x(n), bunch.xp(n), bunch.y(n), bunch.yp(n), bunch.z(n), bunch.dE(n))
+
+        sync_part = bunch.getSyncParticle()
+        self.array[:BunchBuffer.header_size] = (part_num, sync_part.kinEnergy(), sync_part.time(), bunch.macroSize(),
+                                                bunch.mass(), bunch.charge(), beam_current, initial_particle_number)
+
+    def read(self) -> (Bunch, float, int):
+        header = dict(zip(BunchBuffer.header_keys, self.array[:BunchBuffer.header_size]))
+        part_num = int(header['particle_number'])
+
+        bunch = Bunch()
+        bunch.mass(header['mass'])
+        bunch.charge(header['charge'])
+        bunch.macroSize(header['macro_size'])
+        sync_part = bunch.getSyncParticle()
+        sync_part.kinEnergy(header['kin_energy'])
+        sync_part.time(header['sync_time'])
+
+        coordinates = self.array[BunchBuffer.header_size:BunchBuffer.header_size + 6 * part_num].reshape(part_num, 6)
+        for x, xp, y, yp, z, dE in coordinates:
+            bunch.addParticle(x, xp, y, yp, z, dE)
+        return bunch, header['beam_current'], int(header['initial_particle_number'])
+
+    def close(self):
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
+
+
+def _section_worker(section_index: int, model_factory: Callable[..., OrbitModel], section_kwargs: Dict[str, Any],
+                    capacity: int, input_queue, input_free, input_names: List[str], output_queue, output_free,
+                    output_names: List[str], results_queue):
+    model = model_factory(**section_kwargs)
+    element_names = set(model.get_element_list())
+    input_buffers = {name: BunchBuffer(capacity, name) for name in input_names}
+    output_buffers = {name: BunchBuffer(capacity, name) for name in output_names}
+
+    # The arrival time of the first (reference) pulse defines time zero for the section, the same way the design bunch
+    # does for a lattice built from that sequence.
+    reference_time = None
+
+    while True:
+        message = input_queue.get()
+        if message is None:
+            break
+        pulse_id, optics, slot = message
+        model.update_optics({name: params for name, params in optics.items() if name in element_names})
+
+        if slot is None:
+            model.track()
+            beam_current = model.model_params['beam_current']
+            initial_particle_number = model.model_params['initial_particle_number']
+        else:
+            bunch, beam_current, initial_particle_number = input_buffers[slot].read()
+            input_free.put(slot)
+            sync_part = bunch.getSyncParticle()
+            if reference_time is None:
+                reference_time = sync_part.time()
+                model.set_initial_bunch(bunch, beam_current)
+                model.model_params['initial_particle_number'] = initial_particle_number
+            else:
+                sync_part.time(sync_part.time() - reference_time)
+                model.track_input_bunch(bunch, beam_current, initial_particle_number)
+
+        results_queue.put((pulse_id, section_index, model.get_measurements()))
+
+        if output_queue is not None:
+            out_slot = output_free.get()
+            output_buffers[out_slot].write(model.output_bunch, beam_current, initial_particle_number)
+            output_queue.put((pulse_id, optics, out_slot))
+
+    if output_queue is not None:
+        output_queue.put(None)
+    for buffer in list(input_buffers.values()) + list(output_buffers.values()):
+        buffer.close()
+
+
+class PipelineTracker:
+    """
+    Tracks pulses through a lattice split into sections, each section tracked by its own process.
+
+        Parameters
+        ----------
+        model_factory : callable
+            Picklable function that returns an initialized OrbitModel for a section. It is called in the worker process
+            with the keyword arguments of that section. The model of the first section needs an initial bunch; the
+            models of the other sections only need a lattice.
+        sections : list[dict]
+            Keyword arguments for model_factory, one dictionary per section, ordered from upstream to downstream.
+        max_particles : int, optional
+            Maximum number of particles passed between sections. The default is 100000.
+        buffer_slots : int, optional
+            Number of shared memory bunches between each pair of sections. The default is 2.
+    """
+
+    def __init__(self, model_factory: Callable[..., OrbitModel], sections: List[Dict[str, Any]],
+                 max_particles: int = 100000, buffer_slots: int = 2):
+        self.model_factory = model_factory
+        self.sections = sections
+        self.max_particles = max_particles
+        self.buffer_slots = buffer_slots
+
+        self.processes = []
+        self.buffers: List[BunchBuffer] = []
+        self.input_queues = []
+        self.results_queue = None
+        self.next_pulse = 0
+        self.running = False
+
+    def start(self):
+        """Starts the worker processes and tracks a reference pulse with the current optics through all sections."""
+
+        context = multiprocessing.get_context('spawn')
+        section_number = len(self.sections)
+        self.input_queues = [context.Queue() for _ in range(section_number)]
+        self.results_queue = context.Queue()
+
+        # Each boundary between two sections has its own set of buffers and a queue of the buffers that are free.
+        boundary_names = []
+        free_queues = []
+        for _ in range(section_number - 1):
+            names = []
+            free_queue = context.Queue()
+            for _ in range(self.buffer_slots):
+                buffer = BunchBuffer(self.max_particles)
+                self.buffers.append(buffer)
+                names.append(buffer.name)
+                free_queue.put(buffer.name)
+            boundary_names.append(names)
+            free_queues.append(free_queue)
+
+        for k, section_kwargs in enumerate(self.sections):
+            input_free, input_names = (free_queues[k - 1], boundary_names[k - 1]) if k > 0 else (None, [])
+            if k < section_number - 1:
+                output_queue, output_free, output_names = self.input_queues[k + 1], free_queues[k], boundary_names[k]
+            else:
+                output_queue, output_free, output_names = None, None, []
+            process = context.Process(target=_section_worker,
+                                      args=(k, self.model_factory, section_kwargs, self.max_particles,
+                                            self.input_queues[k], input_free, input_names, output_queue, output_free,
+                                            output_names, self.results_queue),
+                                      daemon=True)
+            process.start()
+            self.processes.append(process)
+        self.running = True
+
+        self.track_pulses([{}])
+
+    def track_pulses(self, optics_list: List[Dict[str, Dict[str, Any]]]) -> List[Dict[str, Dict[str, Any]]]:
+        """Tracks one pulse for each optics dictionary. The optics changes of a pulse stay in place for the following
+        pulses.
+
+        Parameters
+        ----------
+        optics_list : list[dict]
+            For each pulse, a dictionary using the element names as keys. Each key is connected to a parameter
+            dictionary containing the new parameter values.
+
+        Returns
+        ----------
+        out : list[dict]
+            For each pulse, a dictionary of the measurements from all sections.
+        """
+
+        if not self.running:
+            print('Error: Start the pipeline in order to track pulses.')
+            return []
+
+        first_pulse = self.next_pulse
+        for optics in optics_list:
+            self.input_queues[0].put((self.next_pulse, optics, None))
+            self.next_pulse += 1
+
+        measurements = [{} for _ in optics_list]
+        for _ in range(len(optics_list) * len(self.sections)):
+            pulse_id, section_index, section_measurements = self.results_queue.get()
+            measurements[pulse_id - first_pulse] |= section_measurements
+        return measurements
+
+    def stop(self):
+        """Stops the worker processes and releases the shared memory."""
+
+        if self.running:
+            self.input_queues[0].put(None)
+            for process in self.processes:
+                process.join()
+        for buffer in self.buffers:
+            buffer.close()
+            buffer.unlink()
+        self.processes = []
+        self.buffers = []
+        self.running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -7,13 +7,16 @@ from orbit.core.bunch import Bunch, BunchTwissAnalysis
 from orbit.py_linac.lattice import BaseLinacNode
 
 
-# A collection of classes that are attached to the lattice as child nodes for the virtual accelerator.
+# A collection of classes that are attached to the lattice as child nodes for the virtual accelerator. The nodes do
+# nothing when the tracked bunch is a probe bunch (see pyorbit_envelope_tracker.py), since its particles are not a beam.
+# Nodes with expensive analysis have an "active" flag that the model clears while no client is watching them.
 
 
 class PhysicsClass(BaseLinacNode):
     node_type = "Physics"
     parameter_list = ['x_beta', 'x_alpha', 'x_emit', 'y_beta', 'y_alpha', 'y_emit', 'z_beta', 'z_alpha', 'z_emit',
                       'position', 'energy', 'beta', 'part_num']
+    active = True
 
     def __init__(self, node_name: str):
         parameters = {'x_beta': 0.0, 'x_alpha': 0.0, 'y_beta': 0.0, 'y_alpha': 0.0,
@@ -29,7 +32,7 @@ class PhysicsClass(BaseLinacNode):
         self.setParam('position', paramsDict["path_length"])
 
     def track(self, paramsDict):
-        if "bunch" not in paramsDict:
+        if "bunch" not in paramsDict or paramsDict.get("probe") or not self.active:
             return
         bunch = paramsDict["bunch"]
         part_num = bunch.getSizeGlobal()
@@ -90,7 +93,7 @@ class BPMclass(BaseLinacNode):
         self.si_e_charge = 1.6021773e-19
 
     def track(self, paramsDict):
-        if "bunch" not in paramsDict:
+        if "bunch" not in paramsDict or paramsDict.get("probe"):
             return
         bunch = paramsDict["bunch"]
         part_num = bunch.getSizeGlobal()
@@ -147,6 +150,7 @@ class BPMclass(BaseLinacNode):
 class WSclass(BaseLinacNode):
     node_type = "WireScanner"
     parameter_list = ['x_histogram', 'y_histogram', 'x_avg', 'y_avg', 'x_sigma', 'y_sigma', 'bin_number']
+    active = True
 
     def __init__(self, node_name: str, bin_number: int = 50):
         default_histogram = np.column_stack((np.linspace(-10, 10, bin_number), np.zeros(bin_number)))
@@ -159,7 +163,7 @@ class WSclass(BaseLinacNode):
         self.setType(WSclass.node_type)
 
     def track(self, paramsDict):
-        if "bunch" not in paramsDict:
+        if "bunch" not in paramsDict or paramsDict.get("probe") or not self.active:
             return
         bunch = paramsDict["bunch"]
         part_num = bunch.getSizeGlobal()
@@ -242,6 +246,7 @@ class WSclass(BaseLinacNode):
 class ScreenClass(BaseLinacNode):
     node_type = "Screen"
     parameter_list = ['xy_histogram', 'x_axis', 'y_axis', 'x_avg', 'y_avg']
+    active = True
 
     def __init__(self, node_name: str, x_bin_number: int = 10, y_bin_number: int = 10):
         parameters = {'xy_histogram': np.zeros((2, 2)), 'x_axis': np.array([-10, 10]), 'y_axis': np.array([-10, 10]),
@@ -255,7 +260,7 @@ class ScreenClass(BaseLinacNode):
         self.y_number = y_bin_number
 
     def track(self, paramsDict):
-        if "bunch" not in paramsDict:
+        if "bunch" not in paramsDict or paramsDict.get("probe") or not self.active:
             return
         bunch = paramsDict["bunch"]
         part_num = bunch.getSizeGlobal()
@@ -315,8 +320,13 @@ class FCclass(BaseLinacNode):
         self.setType(FCclass.node_type)
         self.si_e_charge = 1.6021773e-19
 
+    def intercepts_beam(self) -> bool:
+        # An inserted Faraday cup stops the whole beam, which the envelope model can't describe (see
+        # OrbitModel.beam_intercepted).
+        return self.getParam('state') == 1
+
     def track(self, paramsDict):
-        if "bunch" not in paramsDict:
+        if "bunch" not in paramsDict or paramsDict.get("probe"):
             return
         bunch = paramsDict["bunch"]
         part_num = bunch.getSizeGlobal()
@@ -355,7 +365,7 @@ class BCMclass(BaseLinacNode):
         self.si_e_charge = 1.6021773e-19
 
     def track(self, paramsDict):
-        if "bunch" not in paramsDict:
+        if "bunch" not in paramsDict or paramsDict.get("probe"):
             return
         bunch = paramsDict["bunch"]
 
@@ -383,7 +393,7 @@ class DumpBunchClass(BaseLinacNode):
         self.setType(DumpBunchClass.node_type)
 
     def track(self, paramsDict):
-        if "bunch" not in paramsDict:
+        if "bunch" not in paramsDict or paramsDict.get("probe"):
             return
         bunch = paramsDict["bunch"]
         file_name = self.getParam('out_file')
@@ -404,7 +414,7 @@ class BunchCopyClass(BaseLinacNode):
         self.bunch_dict = bunch_dict
 
     def track(self, paramsDict):
-        if "bunch" not in paramsDict:
+        if "bunch" not in paramsDict or paramsDict.get("probe"):
             return
         bunch = paramsDict["bunch"]
         bunch.copyBunchTo(self.bunch_dict[self.bunch_key])
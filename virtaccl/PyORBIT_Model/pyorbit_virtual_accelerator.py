@@ -1,5 +1,12 @@
+import json
+import math
+from pathlib import Path
+from typing import Union
+
+from orbit.core.bunch import Bunch
+
 from virtaccl.PyORBIT_Model.pyorbit_lattice_controller import OrbitModel
-from virtaccl.beam_line import BeamLine, PhysicsDevice
+from virtaccl.beam_line import BeamLine, PhysicsDevice, InputBeamDevice, ModelStatusDevice
 from virtaccl.server import Server
 from virtaccl.virtual_accelerator import VA_Parser, VirtualAcceleratorBuilder
 
@@ -21,6 +28,17 @@ def add_pyorbit_arguments(va_parser: VA_Parser) -> VA_Parser:
                                       "is given. If the argument is not used, no space charge nodes are added.")
     va_parser.add_model_argument('--physics_nodes', dest='physics_nodes', action='store_true',
                                  help="Adds physics child nodes to each node on the lattice.")
+    va_parser.add_model_argument('--envelope', dest='envelope', action='store_true',
+                                 help="Propagates only the beam centroid and sigma matrix instead of tracking "
+                                      "particles. Only BPM and physics values are updated. Particles are still "
+                                      "tracked if space charge is used or a watched diagnostic needs them.")
+    va_parser.add_model_argument('--progressive', const=1000, nargs='?', type=int,
+                                 help="Each change is first tracked with a subsample of the bunch and published, then "
+                                      "tracked with all particles and published again. The number of particles for "
+                                      "the quick track can be specified; the default is 1000.")
+    va_parser.add_model_argument('--orbit_response', dest='orbit_response', action='store_true',
+                                 help="When only correctors change, BPM positions are first predicted from the orbit "
+                                      "response matrix and published, then the beam is tracked exactly.")
 
     # Desired initial bunch file and the desired number of particles from that file.
     va_parser.add_model_argument('--bunch', type=str, help='Pathname of input bunch file.')
@@ -32,9 +50,65 @@ def add_pyorbit_arguments(va_parser: VA_Parser) -> VA_Parser:
                                  help="Saves the bunch at the end of the lattice after each track in the given "
                                       "location. If no location is given, the bunch is saved as 'end_bunch.dat' in "
                                       "the working directory.")
+    va_parser.add_model_argument('--input_beams', type=str,
+                                 help='Pathname of a json file defining a library of input beams that can be selected '
+                                      'while the virtual accelerator is running. Each entry maps a beam name to a '
+                                      'dictionary with a "bunch" file and optionally "beam_current" (mA) and '
+                                      '"particle_number".')
+
+    # Bunches handed off between sequences.
+    va_parser.add_model_argument('--handoff_dir', type=str,
+                                 help='Directory for sequence handoff bunches. If a stored bunch matches the start '
+                                      'sequence, it is used instead of the bunch file. Otherwise the bunch entering '
+                                      'each sequence is saved there after every track.')
+    va_parser.add_model_argument('--handoff_optics', type=str,
+                                 help='Optics json file with the upstream settings the handoff bunch must match. The '
+                                      'design optics are used if not given.')
     return va_parser
 
 
+def load_input_bunch(bunch_file: Union[str, Path], particle_number: int, beam_current: float,
+                     bunch_frequency: float = 402.5e6) -> Bunch:
+    """Reads a bunch file and sets the macro-size and number of particles the same way the site builders do.
+
+    Parameters
+    ----------
+    bunch_file : str or Path
+        Pathname of the PyORBIT bunch file.
+    particle_number : int
+        Number of particles to keep from the file.
+    beam_current : float
+        The beam current in Amps.
+    bunch_frequency : float, optional
+        Bunch frequency in Hz. The default is 402.5 MHz.
+
+    Returns
+    ----------
+    out : Bunch
+        The prepared PyORBIT bunch.
+    """
+
+    si_e_charge = 1.6021773e-19
+
+    bunch_in = Bunch()
+    bunch_in.readBunch(str(bunch_file))
+    bunch_orig_num = bunch_in.getSizeGlobal()
+    bunch_macrosize = beam_current * 1.0e-3 / bunch_frequency
+    bunch_macrosize /= math.fabs(bunch_in.charge()) * si_e_charge
+    bunch_in.macroSize(bunch_macrosize / particle_number)
+
+    if bunch_orig_num < particle_number:
+        print('Bunch file contains less particles than the desired number of particles.')
+    elif particle_number <= 0:
+        bunch_in.deleteAllParticles()
+    else:
+        for n in range(bunch_orig_num):
+            if n + 1 > particle_number:
+                bunch_in.deleteParticleFast(n)
+        bunch_in.compress()
+    return bunch_in
+
+
 class PyorbitVirtualAcceleratorBuilder(VirtualAcceleratorBuilder[OrbitModel, Server]):
     def __init__(self, model: OrbitModel, beam_line: BeamLine, server: Server, **kwargs):
         super().__init__(model, beam_line, server, **kwargs)
@@ -42,10 +116,44 @@ class PyorbitVirtualAcceleratorBuilder(VirtualAcceleratorBuilder[OrbitModel, Ser
         if kwargs['physics_nodes']:
             self.add_physics_nodes()
 
+        if kwargs.get('envelope'):
+            self.model.set_fidelity('envelope')
+
+        if kwargs.get('progressive'):
+            self.model.set_progressive(kwargs['progressive'])
+
+        if kwargs.get('orbit_response'):
+            self.model.set_orbit_response(True)
+
+        if kwargs.get('envelope') or kwargs.get('progressive') or kwargs.get('orbit_response'):
+            status_device = ModelStatusDevice('Virac:Model')
+            self.beam_line.add_device(status_device)
+
+        if kwargs.get('input_beams'):
+            self.add_input_beams(kwargs['input_beams'])
+
     def add_physics_nodes(self):
         physics_elements = self.model.add_physics_nodes()
         for physics_name in physics_elements:
             phys_device = PhysicsDevice(physics_name)
             self.beam_line.add_device(phys_device)
 
+    def add_input_beams(self, library_file: Union[str, Path]):
+        library_file = Path(library_file)
+        with open(library_file, "r") as json_file:
+            library_dict = json.load(json_file)
+
+        default_number = self.options['particle_number']
+        default_current = self.options['beam_current']
+        for beam_name, beam_dict in library_dict.items():
+            bunch_file = Path(beam_dict['bunch'])
+            if not bunch_file.is_absolute():
+                bunch_file = library_file.parent / bunch_file
+            part_num = beam_dict.get('particle_number', default_number)
+            beam_current = beam_dict.get('beam_current', default_current) / 1000
+            bunch_in = load_input_bunch(bunch_file, part_num, beam_current)
+            self.model.add_input_beam(beam_name, bunch_in, beam_current)
 
+        beam_device = InputBeamDevice('Virac:Input_Beam', self.model.input_beam_key, self.model.get_input_beams(),
+                                      self.model.get_active_beam())
+        self.beam_line.add_device(beam_device)
@@ -0,0 +1,81 @@
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Dict, List
+
+import numpy as np
+
+from virtaccl.SHM_Server.shm_layout import SharedValues, SettingsRing, align, read_header
+
+
+class SHM_Client:
+    """
+    Client for an SHM_Server running on the same host. Reads are copies out of the shared memory block, so the whole
+    machine state can be read in microseconds. Settings go to the server through the ring of the client's slot; the
+    virtual accelerator uses them in its next track.
+
+        Parameters
+        ----------
+        name : str, optional
+            Name of the shared memory block of the server. The default is 'virac'.
+        slot : int, optional
+            Settings ring used by this client. Clients writing settings at the same time need different slots. The
+            default is 0.
+    """
+
+    def __init__(self, name: str = 'virac', slot: int = 0):
+        self.shared_memory = SharedMemory(name=name)
+        # The block belongs to the server, so it must not be removed when this process ends.
+        resource_tracker.unregister(self.shared_memory._name, 'shared_memory')
+        buffer = self.shared_memory.buf
+        header, values_offset = read_header(buffer)
+
+        self.types = {key: parameter_type for key, count, parameter_type in header['parameters']}
+        self.counts = {key: count for key, count, parameter_type in header['parameters']}
+        layout = [(key, count) for key, count, parameter_type in header['parameters']]
+        self.shared_values = SharedValues(layout, buffer, values_offset)
+
+        if not 0 <= slot < header['client_slots']:
+            raise ValueError(f'Slot {slot} does not exist, the server has {header["client_slots"]} client slots.')
+        ring_size = SettingsRing.size(header['ring_capacity'])
+        ring_offset = values_offset + align(SharedValues.size(layout)) + slot * ring_size
+        self.ring = SettingsRing(buffer, ring_offset, header['ring_capacity'])
+
+    def get_keys(self) -> List[str]:
+        return list(self.shared_values.keys)
+
+    def get(self, key: str) -> Any:
+        return self.get_values([key])[key]
+
+    def get_values(self, keys: List[str] = None) -> Dict[str, Any]:
+        """Returns the values of the keys (or of every key) from the same update of the server."""
+
+        if keys is None:
+            keys = self.shared_values.keys
+        snapshot = self.shared_values.read(keys)
+        return {key: self._convert(key, array) for key, array in snapshot.items()}
+
+    def set(self, key: str, value):
+        self.set_values({key: value})
+
+    def set_values(self, new_values: Dict[str, Any]):
+        """Sends new settings to the server. The server takes them together, so they are used in the same track."""
+
+        indexes = self.shared_values.indexes
+        unknown_keys = [key for key in new_values.keys() if key not in indexes]
+        if unknown_keys:
+            raise KeyError(f'Unknown parameters: {", ".join(unknown_keys)}')
+        entries = [(indexes[key], float(value)) for key, value in new_values.items()]
+        if not self.ring.push(entries):
+            raise BufferError('The settings ring is full, the server has not taken the previous settings yet.')
+
+    def close(self):
+        self.shared_values = None
+        self.ring = None
+        self.shared_memory.close()
+
+    def _convert(self, key: str, array: np.ndarray) -> Any:
+        if self.types[key] in ('int', 'enum', 'char'):
+            array = array.astype(np.int64)
+        if self.counts[key] == 1 and array.size == 1:
+            return array[0].item()
+        return array
@@ -0,0 +1,184 @@
+import json
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class SharedValues:
+    """
+    Block of shared memory holding the numeric values of the parameters, so the virtual accelerator and other
+    processes can exchange values without sending them through a pipe.
+
+    The virtual accelerator is the only writer of the values. It guards each batch of values with a sequence lock: the
+    sequence number is odd while a batch is written, and readers copy the values again if the sequence number was odd
+    or changed while they copied them. Each parameter has a version number that changes whenever a new value is
+    written, so readers can tell which values changed. The interest flags and read times are written by the reading
+    process.
+
+        Parameters
+        ----------
+        layout : list of tuples
+            List of (key, number of elements) for the numeric parameters, in the order of their slots.
+        buffer : memoryview
+            Buffer of the shared memory block.
+        offset : int, optional
+            Position of the values in the buffer, which needs SharedValues.size(layout) bytes from there. The default
+            is 0.
+    """
+
+    def __init__(self, layout: List[Tuple[str, int]], buffer, offset: int = 0):
+        self.keys = [key for key, count in layout]
+        self.indexes = {key: i for i, key in enumerate(self.keys)}
+        counts = np.array([count for key, count in layout], dtype=np.int64)
+        self.counts = counts
+        self.offsets = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+        pv_number = len(layout)
+        value_number = int(np.sum(counts))
+
+        sections = [('sequence', np.int64, 1), ('versions', np.int64, pv_number), ('lengths', np.int64, pv_number),
+                    ('times', np.float64, pv_number), ('read_times', np.float64, pv_number),
+                    ('values', np.float64, value_number), ('interest', np.uint8, pv_number)]
+        start = offset
+        for name, dtype, number in sections:
+            setattr(self, name, np.ndarray((number,), dtype=dtype, buffer=buffer, offset=start))
+            start += number * np.dtype(dtype).itemsize
+
+    @staticmethod
+    def size(layout: List[Tuple[str, int]]) -> int:
+        pv_number = len(layout)
+        value_number = sum(count for key, count in layout)
+        return 8 * (1 + 4 * pv_number + value_number) + pv_number
+
+    def fits(self, key: str, value: Any) -> Optional[np.ndarray]:
+        """Returns the value as a float array if it can be stored in the slot of the key, otherwise None."""
+
+        if key not in self.indexes or isinstance(value, str):
+            return None
+        try:
+            array = np.asarray(value, dtype=np.float64).ravel()
+        except (TypeError, ValueError):
+            return None
+        if array.size > self.counts[self.indexes[key]]:
+            return None
+        return array
+
+    def write(self, new_values: Dict[str, Tuple[np.ndarray, Optional[datetime]]]):
+        self.sequence[0] += 1
+        for key, (array, timestamp) in new_values.items():
+            i = self.indexes[key]
+            offset = self.offsets[i]
+            self.values[offset:offset + array.size] = array
+            self.lengths[i] = array.size
+            self.times[i] = np.nan if timestamp is None else timestamp.timestamp()
+            self.versions[i] += 1
+        self.sequence[0] += 1
+
+    def read_changes(self, seen_versions: np.ndarray) -> Dict[str, Tuple[np.ndarray, float]]:
+        """Returns the values of the keys whose version differs from the seen versions, and updates the seen versions."""
+
+        while True:
+            start_sequence = int(self.sequence[0])
+            if start_sequence % 2 == 1:
+                time.sleep(0)
+                continue
+            versions = self.versions.copy()
+            changed = {}
+            for i in np.nonzero(versions != seen_versions)[0]:
+                offset = self.offsets[i]
+                changed[self.keys[i]] = (self.values[offset:offset + self.lengths[i]].copy(), float(self.times[i]))
+            if int(self.sequence[0]) == start_sequence:
+                seen_versions[:] = versions
+                return changed
+
+    def read(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Returns a consistent snapshot of the values of the keys."""
+
+        while True:
+            start_sequence = int(self.sequence[0])
+            if start_sequence % 2 == 1:
+                time.sleep(0)
+                continue
+            snapshot = {}
+            for key in keys:
+                i = self.indexes[key]
+                offset = self.offsets[i]
+                snapshot[key] = self.values[offset:offset + self.lengths[i]].copy()
+            if int(self.sequence[0]) == start_sequence:
+                return snapshot
+
+
+class SettingsRing:
+    """
+    Ring buffer in shared memory through which one client sends new settings to the server without locks. Each entry
+    is the slot index of a key and a value. The client is the only writer of the head and the server the only writer
+    of the tail, so entries between the tail and the head belong to the server and the rest to the client. A client
+    writes several entries before moving the head, which makes the server take them all in the same batch.
+
+        Parameters
+        ----------
+        buffer : memoryview
+            Buffer of the shared memory block.
+        offset : int
+            Position of the ring in the buffer, which needs SettingsRing.size(capacity) bytes from there.
+        capacity : int
+            Number of entries in the ring.
+    """
+
+    def __init__(self, buffer, offset: int, capacity: int):
+        self.capacity = capacity
+        self.positions = np.ndarray((2,), dtype=np.int64, buffer=buffer, offset=offset)
+        self.indexes = np.ndarray((capacity,), dtype=np.int64, buffer=buffer, offset=offset + 16)
+        self.values = np.ndarray((capacity,), dtype=np.float64, buffer=buffer, offset=offset + 16 + 8 * capacity)
+
+    @staticmethod
+    def size(capacity: int) -> int:
+        return 16 + 16 * capacity
+
+    def push(self, entries: List[Tuple[int, float]]) -> bool:
+        """Adds the entries to the ring as one batch. Returns False if there is not enough room."""
+
+        head, tail = int(self.positions[0]), int(self.positions[1])
+        if head - tail + len(entries) > self.capacity:
+            return False
+        for n, (index, value) in enumerate(entries):
+            position = (head + n) % self.capacity
+            self.indexes[position] = index
+            self.values[position] = value
+        self.positions[0] = head + len(entries)
+        return True
+
+    def pop_all(self) -> List[Tuple[int, float]]:
+        """Takes all entries the client has finished writing."""
+
+        head, tail = int(self.positions[0]), int(self.positions[1])
+        entries = [(int(self.indexes[position % self.capacity]), float(self.values[position % self.capacity]))
+                   for position in range(tail, head)]
+        self.positions[1] = head
+        return entries
+
+
+def align(position: int) -> int:
+    return (position + 7) // 8 * 8
+
+
+def header_size(header: Dict[str, Any]) -> int:
+    return align(8 + len(json.dumps(header).encode()))
+
+
+def write_header(buffer, header: Dict[str, Any]) -> int:
+    """Writes the layout description at the start of a shared memory block. Returns the position after it."""
+
+    header_bytes = json.dumps(header).encode()
+    np.ndarray((1,), dtype=np.int64, buffer=buffer)[0] = len(header_bytes)
+    buffer[8:8 + len(header_bytes)] = header_bytes
+    return align(8 + len(header_bytes))
+
+
+def read_header(buffer) -> Tuple[Dict[str, Any], int]:
+    """Returns the layout description at the start of a shared memory block and the position after it."""
+
+    header_length = int(np.ndarray((1,), dtype=np.int64, buffer=buffer)[0])
+    header = json.loads(bytes(buffer[8:8 + header_length]).decode())
+    return header, align(8 + header_length)
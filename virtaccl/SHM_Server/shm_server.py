@@ -0,0 +1,161 @@
+from datetime import datetime
+from multiprocessing.shared_memory import SharedMemory
+from threading import Thread, Event
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from virtaccl.server import Server
+from virtaccl.SHM_Server.shm_layout import SharedValues, SettingsRing, align, header_size, write_header
+
+
+class SHM_Server(Server):
+    """
+    Server that publishes every numeric parameter into one shared memory block, for clients on the same host that
+    need to read the whole machine state quickly (see SHM_Client). The block starts with a json description of the
+    layout, followed by the values (see SharedValues) and one settings ring per client slot (see SettingsRing).
+
+    Settings written by clients are taken from the rings every poll period (and whenever the virtual accelerator asks
+    for new writes), checked with the write validator, and counted in the settings generation right away. The settings
+    and the generation parameter are published back at once, the other values at the next update. Parameters with
+    string values are not in the block.
+
+        Parameters
+        ----------
+        name : str, optional
+            Name of the shared memory block. The default is 'virac'.
+        client_slots : int, optional
+            Number of clients that can write settings at the same time, each through its own ring. The default is 4.
+        ring_capacity : int, optional
+            Number of settings each ring holds before the server takes them. The default is 1024.
+        poll_period : float, optional
+            Time (in seconds) between checks of the rings for new settings. The default is 0.01 s.
+    """
+
+    def __init__(self, name: str = 'virac', client_slots: int = 4, ring_capacity: int = 1024,
+                 poll_period: float = 0.01):
+        super().__init__()
+        self.name = name
+        self.client_slots = client_slots
+        self.ring_capacity = ring_capacity
+        self.poll_period = poll_period
+        self.start_flag = False
+        self.stop_event = Event()
+        self.poll_thread: Optional[Thread] = None
+
+        self.shared_memory: Optional[SharedMemory] = None
+        self.shared_values: Optional[SharedValues] = None
+        self.rings: List[SettingsRing] = []
+        # Values set since the last update, written to the shared memory together. The values are the only part of the
+        # block with a single writer, so they are written while holding the settings lock.
+        self.pending_values: Dict[str, Tuple[np.ndarray, Optional[datetime]]] = {}
+
+    def set_parameter(self, parameter_key: str, new_value, timestamp: datetime = None):
+        super().set_parameter(parameter_key, new_value, timestamp)
+        if self.start_flag:
+            array = self.shared_values.fits(parameter_key, new_value)
+            if array is not None:
+                self.pending_values[parameter_key] = (array, timestamp)
+
+    def update(self):
+        if self.start_flag:
+            with self.settings_lock:
+                new_values, self.pending_values = self.pending_values, {}
+                if new_values:
+                    self.shared_values.write(new_values)
+
+    def post_pending(self, keys: List[str]):
+        # Writes the pending values of some keys right away, leaving the others for the next update.
+        with self.settings_lock:
+            new_values = {key: self.pending_values.pop(key) for key in keys if key in self.pending_values}
+            if new_values:
+                self.shared_values.write(new_values)
+
+    def get_writes(self) -> List[Tuple[str, Any, datetime]]:
+        if self.start_flag:
+            self.receive_settings()
+        return super().get_writes()
+
+    def poll_settings(self):
+        while not self.stop_event.wait(self.poll_period):
+            self.receive_settings()
+
+    def receive_settings(self):
+        keys = self.shared_values.keys
+        for ring in self.rings:
+            # The poll thread and the virtual accelerator both take settings, so the tail only moves under the lock.
+            with self.settings_lock:
+                entries = ring.pop_all()
+                if not entries:
+                    continue
+                write_time = datetime.now()
+                written_keys = [self.generation_key]
+                accepted = False
+                for index, value in entries:
+                    key = keys[index]
+                    if self.parameter_db[key].get('type') in ('int', 'enum'):
+                        value = int(value)
+                    written_keys.append(key)
+                    try:
+                        new_value = self.validate_write(key, value)
+                    except ValueError as e:
+                        print(f'Warning: Write to {key} rejected. {e}')
+                        self.set_parameter(key, self.parameter_db[key]['value'])
+                        continue
+                    self.set_parameter(key, new_value)
+                    self.queue_write(key, new_value, write_time)
+                    accepted = True
+                # Each batch of settings from a client with an accepted write counts as one change.
+                if accepted:
+                    self.settings_generation += 1
+                    if self.generation_key is not None:
+                        self.set_parameter(self.generation_key, self.settings_generation)
+                self.post_pending(written_keys)
+
+    def start(self):
+        parameters = [[key, definitions.get('count', 1), definitions.get('type', 'float')]
+                      for key, definitions in self.parameter_db.items() if definitions.get('type') != 'string']
+        layout = [(key, count) for key, count, parameter_type in parameters]
+        header = {'parameters': parameters, 'client_slots': self.client_slots, 'ring_capacity': self.ring_capacity}
+        values_size = align(SharedValues.size(layout))
+        ring_size = SettingsRing.size(self.ring_capacity)
+        block_size = header_size(header) + values_size + self.client_slots * ring_size
+
+        try:
+            self.shared_memory = SharedMemory(name=self.name, create=True, size=block_size)
+        except FileExistsError:
+            # Left over from a server that did not stop cleanly.
+            SharedMemory(name=self.name).unlink()
+            self.shared_memory = SharedMemory(name=self.name, create=True, size=block_size)
+
+        buffer = self.shared_memory.buf
+        values_offset = write_header(buffer, header)
+        self.shared_values = SharedValues(layout, buffer, values_offset)
+        ring_offset = values_offset + values_size
+        self.rings = [SettingsRing(buffer, ring_offset + slot * ring_size, self.ring_capacity)
+                      for slot in range(self.client_slots)]
+
+        initial_values = {}
+        for key, count in layout:
+            array = self.shared_values.fits(key, self.parameter_db[key].get('value'))
+            if array is not None:
+                initial_values[key] = (array, None)
+        self.shared_values.write(initial_values)
+        self.start_flag = True
+        self.stop_event.clear()
+        self.poll_thread = Thread(target=self.poll_settings, daemon=True)
+        self.poll_thread.start()
+
+    def stop(self):
+        if not self.start_flag:
+            return
+        self.stop_event.set()
+        self.poll_thread.join()
+        self.start_flag = False
+        self.shared_values = None
+        self.rings = []
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+    def __str__(self):
+        return f'Following parameters are shared in "{self.name}":\n' + '\n'.join(self.parameter_db.keys())
@@ -0,0 +1,112 @@
+import socket
+from threading import Thread, Condition
+from typing import Any, Callable, Dict, List, Optional
+
+from virtaccl.Socket_Server.socket_protocol import encode_message, receive_message, parse_address
+
+
+class Socket_Client:
+    """
+    Client for a Socket_Server. Gets and sets of many keys take one round trip each.
+
+        Parameters
+        ----------
+        address : str, optional
+            'host:port' for TCP or a file path for a Unix domain socket. The default is 'localhost:7780'.
+        timeout : float, optional
+            Longest time (in seconds) to wait for a reply. The default is 10 s.
+    """
+
+    def __init__(self, address: str = 'localhost:7780', timeout: float = 10.0):
+        family, socket_address = parse_address(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.connect(socket_address)
+        self.timeout = timeout
+
+        self.reply_condition = Condition()
+        self.replies: Dict[int, Dict[str, Any]] = {}
+        # Operation of each request waiting for its reply.
+        self.pending_ops: Dict[int, str] = {}
+        self.next_id = 0
+        self.connected = True
+
+        # Latest values of the subscribed keys, and the function called with each update.
+        self.subscribed_values: Dict[str, Any] = {}
+        self.update_callback: Optional[Callable[[Dict[str, Any]], None]] = None
+
+        Thread(target=self._receive, daemon=True).start()
+
+    def _receive(self):
+        while True:
+            try:
+                message = receive_message(self.socket)
+            except OSError:
+                message = None
+            if message is None:
+                with self.reply_condition:
+                    self.connected = False
+                    self.reply_condition.notify_all()
+                return
+            if message.get('op') == 'update':
+                self.subscribed_values |= message['values']
+                if self.update_callback is not None:
+                    self.update_callback(message['values'])
+            else:
+                with self.reply_condition:
+                    # The values of a subscribe reply are stored here, in order with the updates, so that they never
+                    # overwrite newer values from an update that came after them.
+                    if self.pending_ops.pop(message['id'], None) == 'subscribe' and 'values' in message:
+                        self.subscribed_values |= message['values']
+                    self.replies[message['id']] = message
+                    self.reply_condition.notify_all()
+
+    def request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Sends a request and returns the reply. Raises a RuntimeError if the server reports an error."""
+
+        with self.reply_condition:
+            request_id = self.next_id
+            self.next_id += 1
+            self.pending_ops[request_id] = request['op']
+        self.socket.sendall(encode_message(request | {'id': request_id}))
+        with self.reply_condition:
+            if not self.reply_condition.wait_for(lambda: request_id in self.replies or not self.connected,
+                                                 timeout=self.timeout):
+                raise TimeoutError(f'No reply to "{request["op"]}" within {self.timeout} s.')
+            if request_id not in self.replies:
+                raise ConnectionError('The connection to the server was closed.')
+            reply = self.replies.pop(request_id)
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply
+
+    def get_keys(self) -> List[str]:
+        return self.request({'op': 'keys'})['keys']
+
+    def get(self, key: str) -> Any:
+        return self.get_values([key])[key]
+
+    def get_values(self, keys: List[str] = None) -> Dict[str, Any]:
+        """Returns the values of the keys (or of every key), all read at the same time."""
+        return self.request({'op': 'get', 'keys': keys})['values']
+
+    def set(self, key: str, value) -> int:
+        return self.set_values({key: value})
+
+    def set_values(self, new_values: Dict[str, Any]) -> int:
+        """Sets the values together, so they are used in the same track. Returns their settings generation."""
+        return self.request({'op': 'set', 'values': new_values})['generation']
+
+    def subscribe(self, keys: List[str], callback: Callable[[Dict[str, Any]], None] = None,
+                  period: float = 0.0) -> Dict[str, Any]:
+        """Subscribes to the keys and returns their current values. After each update of the server, the subscribed
+        keys that changed are stored in subscribed_values and passed to the callback, at most once per period."""
+
+        if callback is not None:
+            self.update_callback = callback
+        return self.request({'op': 'subscribe', 'keys': list(keys), 'period': period})['values']
+
+    def unsubscribe(self, keys: List[str] = None):
+        self.request({'op': 'unsubscribe', 'keys': None if keys is None else list(keys)})
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,85 @@
+import json
+import socket
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Every message is a frame of two lengths (header, payload), a json header, and a payload holding the raw bytes of the
+# NumPy arrays in the message, so arrays are never converted to lists.
+frame_format = '!II'
+frame_size = struct.calcsize(frame_format)
+
+
+def encode_message(message: Dict[str, Any]) -> bytes:
+    buffers: List[bytes] = []
+
+    def encode(value):
+        if isinstance(value, np.ndarray):
+            array = np.ascontiguousarray(value)
+            buffers.append(array.tobytes())
+            return {'__array__': len(buffers) - 1, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, dict):
+            return {key: encode(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [encode(item) for item in value]
+        return value
+
+    header = encode(message)
+    header['__buffers__'] = [len(buffer) for buffer in buffers]
+    header_bytes = json.dumps(header).encode()
+    payload = b''.join(buffers)
+    return struct.pack(frame_format, len(header_bytes), len(payload)) + header_bytes + payload
+
+
+def decode_message(header_bytes: bytes, payload: bytes) -> Dict[str, Any]:
+    header = json.loads(header_bytes.decode())
+    buffer_starts = np.concatenate(([0], np.cumsum(header.pop('__buffers__', []))))
+
+    def decode(value):
+        if isinstance(value, dict):
+            if '__array__' in value:
+                i = value['__array__']
+                data = payload[int(buffer_starts[i]):int(buffer_starts[i + 1])]
+                return np.frombuffer(data, dtype=np.dtype(value['dtype'])).reshape(value['shape'])
+            return {key: decode(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [decode(item) for item in value]
+        return value
+
+    return decode(header)
+
+
+def receive_exactly(connection: socket.socket, size: int) -> Optional[bytes]:
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def receive_message(connection: socket.socket) -> Optional[Dict[str, Any]]:
+    """Returns the next message from the socket, or None if it was closed."""
+
+    frame = receive_exactly(connection, frame_size)
+    if frame is None:
+        return None
+    header_length, payload_length = struct.unpack(frame_format, frame)
+    header_bytes = receive_exactly(connection, header_length)
+    payload = receive_exactly(connection, payload_length)
+    if header_bytes is None or payload is None:
+        return None
+    return decode_message(header_bytes, payload)
+
+
+def parse_address(address: str) -> Tuple[int, Any]:
+    """Returns the socket family and address for 'host:port' (TCP) or a file path (Unix domain socket)."""
+
+    if ':' in address and '/' not in address:
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
@@ -0,0 +1,204 @@
+import os
+import socket
+from threading import Thread, Lock
+from time import monotonic
+from typing import Any, Dict, List, Optional, Set
+
+from virtaccl.server import Server
+from virtaccl.Socket_Server.socket_protocol import encode_message, receive_message, parse_address
+
+
+class Connection:
+    """A connected client with its subscriptions and the subscribed keys that changed since it was last sent."""
+
+    def __init__(self, client_socket: socket.socket):
+        self.socket = client_socket
+        self.send_lock = Lock()
+        self.subscriptions: Set[str] = set()
+        self.changed_keys: Set[str] = set()
+        self.period = 0.0
+        self.last_sent = 0.0
+
+    def send(self, message: Dict[str, Any]):
+        with self.send_lock:
+            self.socket.sendall(encode_message(message))
+
+
+class Socket_Server(Server):
+    """
+    Server for scripts that don't use EPICS. Clients connect over TCP or a Unix domain socket (see Socket_Client) and
+    get or set any number of keys in one round trip. NumPy arrays are sent as raw bytes. Subscribed clients are sent
+    one message per update of the server with all their subscribed keys that changed, at most once per their period.
+
+    Requests are dictionaries with an 'op' and an 'id', which is repeated in the reply:
+        {'op': 'keys'} -> {'keys': [...]}
+        {'op': 'get', 'keys': [...] or None} -> {'values': {...}}
+        {'op': 'set', 'values': {...}} -> {'generation': int} or {'error': str}
+        {'op': 'subscribe', 'keys': [...], 'period': float} -> {'values': {...}}, then {'op': 'update', 'values': {...}}
+        {'op': 'unsubscribe', 'keys': [...] or None} -> {}
+
+        Parameters
+        ----------
+        address : str, optional
+            'host:port' for TCP or a file path for a Unix domain socket. The default is 'localhost:7780'. Port 0 picks a
+            free port, see get_address.
+        read_window : float, optional
+            Keys read within this many seconds count as watched. The default is 10 s.
+    """
+
+    def __init__(self, address: str = 'localhost:7780', read_window: float = 10.0):
+        super().__init__()
+        self.address = address
+        self.read_window = read_window
+        self.start_flag = False
+        self.listen_socket: Optional[socket.socket] = None
+        self.connections: List[Connection] = []
+        self.connections_lock = Lock()
+        # Position in the change journal up to which changes were sent to the subscribers.
+        self.journal_position = 0
+        self.read_times: Dict[str, float] = {}
+
+    def get_address(self) -> str:
+        """Returns the address clients connect to, with the actual port if the server picked one."""
+
+        if self.listen_socket is not None and self.listen_socket.family == socket.AF_INET:
+            host, port = self.listen_socket.getsockname()
+            return f'{host}:{port}'
+        return self.address
+
+    def get_subscribed_keys(self) -> Optional[Set[str]]:
+        if not self.start_flag:
+            return None
+        now = monotonic()
+        recently_read = {key for key, read_time in list(self.read_times.items()) if now - read_time < self.read_window}
+        with self.connections_lock:
+            subscribed = set().union(*[connection.subscriptions for connection in self.connections])
+        return subscribed | recently_read
+
+    def update(self):
+        if not self.start_flag:
+            return
+        changed_keys, self.journal_position = self.get_changes(self.journal_position)
+        now = monotonic()
+        with self.connections_lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.changed_keys |= changed_keys & connection.subscriptions
+            if connection.changed_keys and now - connection.last_sent >= connection.period:
+                keys, connection.changed_keys = connection.changed_keys, set()
+                connection.last_sent = now
+                self.send(connection, {'op': 'update', 'values': self.get_values(keys)})
+
+    def get_values(self, keys) -> Dict[str, Any]:
+        return {key: self.get_parameter(key) for key in keys}
+
+    def send(self, connection: Connection, message: Dict[str, Any]):
+        try:
+            connection.send(message)
+        except OSError:
+            self.remove_connection(connection)
+
+    def remove_connection(self, connection: Connection):
+        with self.connections_lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+        connection.socket.close()
+
+    def handle_request(self, connection: Connection, request: Dict[str, Any]) -> Dict[str, Any]:
+        op = request.get('op')
+        if op == 'keys':
+            return {'keys': self.get_parameter_keys()}
+
+        elif op == 'get':
+            keys = request.get('keys')
+            if keys is None:
+                keys = self.get_parameter_keys()
+            unknown_keys = [key for key in keys if key not in self.parameter_db]
+            if unknown_keys:
+                return {'error': f'Unknown parameters: {", ".join(unknown_keys)}'}
+            now = monotonic()
+            for key in keys:
+                self.read_times[key] = now
+                if self.read_callback is not None:
+                    self.read_callback(key)
+            with self.settings_lock:
+                return {'values': self.get_values(keys)}
+
+        elif op == 'set':
+            try:
+                return {'generation': self.apply_transaction(request['values'])}
+            except (ValueError, KeyError) as e:
+                return {'error': str(e)}
+
+        elif op == 'subscribe':
+            keys = set(request['keys'])
+            unknown_keys = keys - self.parameter_db.keys()
+            if unknown_keys:
+                return {'error': f'Unknown parameters: {", ".join(unknown_keys)}'}
+            connection.subscriptions |= keys
+            connection.period = request.get('period', 0.0)
+            return {'values': self.get_values(keys)}
+
+        elif op == 'unsubscribe':
+            keys = request.get('keys')
+            connection.subscriptions = set() if keys is None else connection.subscriptions - set(keys)
+            return {}
+
+        return {'error': f'Unknown operation: {op}'}
+
+    def serve_connection(self, connection: Connection):
+        while self.start_flag:
+            try:
+                request = receive_message(connection.socket)
+            except OSError:
+                request = None
+            if request is None:
+                break
+            reply = self.handle_request(connection, request)
+            reply['id'] = request.get('id')
+            self.send(connection, reply)
+        self.remove_connection(connection)
+
+    def accept_connections(self):
+        while self.start_flag:
+            try:
+                client_socket, client_address = self.listen_socket.accept()
+            except OSError:
+                break
+            connection = Connection(client_socket)
+            with self.connections_lock:
+                self.connections.append(connection)
+            Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+
+    def start(self):
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+        self.listen_socket = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind(address)
+        self.listen_socket.listen()
+        self.start_flag = True
+        Thread(target=self.accept_connections, daemon=True).start()
+
+    def stop(self):
+        if not self.start_flag:
+            return
+        self.start_flag = False
+        try:
+            # Wakes up the thread waiting for connections.
+            self.listen_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listen_socket.close()
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.socket.close()
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+
+    def __str__(self):
+        return f'Following parameters are served at {self.get_address()}:\n' + '\n'.join(self.parameter_db.keys())
@@ -2,7 +2,9 @@ import math
 
 import numpy as np
 from numpy.random import random_sample
-from typing import Optional, Union, List, Dict, Any, Set
+from typing import Optional, Union, List, Dict, Any, Set, Callable
+
+from virtaccl.server import PublishPolicy
 
 
 class Transform:
@@ -217,18 +219,27 @@ class Device:
         self.measurements: Set[str] = set()
         self.readbacks: Set[str] = set()
 
+        # Parameters that clients are watching, None if unknown (everything is treated as watched).
+        self.observed: Optional[Set[str]] = None
+
+        # Function returning the value of a server key on the server, set once the device is served.
+        self.server_getter: Optional[Callable[[str], Any]] = None
+
     def register_parameter(self, reason: str, definition=None, default=0, setting_reason: str = None, transform=None,
-                           noise=None, server_key_override: str = None) -> Parameter:
+                           noise=None, server_key_override: str = None,
+                           publish_policy: PublishPolicy = None) -> Parameter:
         if definition is None:
             definition = {}
+        if publish_policy is not None:
+            definition = definition | {'publish_policy': publish_policy}
         param = Parameter(reason, definition, default, setting_reason, transform, noise, server_key_override)
         self.parameters[reason] = param
         return param
 
     def register_measurement(self, reason: str, definition=None, transform=None, noise=None,
-                             server_key_override: str = None) -> Parameter:
+                             server_key_override: str = None, publish_policy: PublishPolicy = None) -> Parameter:
         param = self.register_parameter(reason, definition, transform=transform, noise=noise,
-                                        server_key_override=server_key_override)
+                                        server_key_override=server_key_override, publish_policy=publish_policy)
         self.measurements.add(reason)
         return param
 
@@ -240,17 +251,24 @@ class Device:
         return param
 
     def register_readback(self, reason: str, setting: str = None, definition=None, transform=None, noise=None,
-                          server_key_override: str = None) -> Parameter:
+                          server_key_override: str = None, publish_policy: PublishPolicy = None) -> Parameter:
         rb_def = {}
         if definition is not None:
             rb_def = definition
         elif setting is not None and setting in self.settings:
             rb_def = self.get_parameter(setting).get_definition()
         param = self.register_parameter(reason, definition=rb_def, setting_reason=setting, transform=transform,
-                                        noise=noise, server_key_override=server_key_override)
+                                        noise=noise, server_key_override=server_key_override,
+                                        publish_policy=publish_policy)
         self.readbacks.add(reason)
         return param
 
+    def set_observed(self, reasons: Optional[Set[str]]):
+        self.observed = reasons
+
+    def is_observed(self, reason: str) -> bool:
+        return self.observed is None or reason in self.observed
+
     def get_parameter_value(self, reason):
         return self.parameters[reason].get_value()
 
@@ -272,6 +290,18 @@ class Device:
             if reason in new_settings:
                 self.update_setting(reason, new_settings[reason])
 
+    # Called when a client writes a setting, before the value is accepted. Returns the value to use or raises a
+    # ValueError to reject the write.
+    def validate_setting(self, reason: str, new_value):
+        return new_value
+
+    # Returns the value of a parameter on the server, which includes writes the virtual accelerator has not taken yet.
+    # Used to validate writes against other settings, like limits.
+    def get_server_value(self, reason: str):
+        if self.server_getter is None:
+            return self.get_parameter_value(reason)
+        return self.server_getter(self.parameters[reason].get_server_key())
+
     def server_setting_override(self, reason: str, new_value=None):
         self.set_parameter_value(reason, new_value)
         self.sever_changes.add(reason)
@@ -289,6 +319,10 @@ class Device:
                 for reason, value in measurement.items():
                     self.update_measurement(reason, value)
 
+    def update_model_status(self, status: Dict[str, Any]):
+        # Only devices reporting on the model itself use its status.
+        pass
+
     def update_readback(self, reason, value=None):
         if value is None:
             setting_reason = self.parameters[reason].setting_reason
@@ -404,6 +438,96 @@ class PhysicsDevice(Device):
         self.update_measurement(PhysicsDevice.num_pv, phys_params[PhysicsDevice.num_key])
 
 
+# An unrealistic device that selects which input beam from the model's library is tracked.
+class InputBeamDevice(Device):
+    # EPICS PV names
+    select_pv = 'Select'
+    readback_pv = 'Selected'
+
+    # Model parameter keys
+    name_key = 'name'
+
+    def __init__(self, name: str, model_name: str, beam_names: List[str], initial_beam: str = None):
+        self.model_name = model_name
+        super().__init__(name, self.model_name)
+        self.beam_names = beam_names
+
+        initial_index = 0
+        if initial_beam in beam_names:
+            initial_index = beam_names.index(initial_beam)
+
+        # Registers the device's PVs with the server.
+        beam_definition = {'type': 'enum', 'enums': beam_names}
+        self.register_setting(InputBeamDevice.select_pv, beam_definition, default=initial_index)
+        self.register_readback(InputBeamDevice.readback_pv, InputBeamDevice.select_pv)
+
+    # Return the name of the selected beam as a dictionary using the model key and it's value.
+    def get_model_optics(self) -> Dict[str, Dict[str, Any]]:
+        index = int(self.get_parameter_value(InputBeamDevice.select_pv))
+        if not 0 <= index < len(self.beam_names):
+            index = 0
+        return {self.model_name: {InputBeamDevice.name_key: self.beam_names[index]}}
+
+
+# An unrealistic device that reports how the current model values were computed.
+class ModelStatusDevice(Device):
+    # EPICS PV names
+    fidelity_pv = 'Fidelity'
+    number_pv = 'Particle_Number'
+
+    # Model parameter keys
+    fidelity_key = 'fidelity'
+    number_key = 'particle_number'
+
+    fidelity_options = ['full', 'coarse', 'envelope', 'response']
+
+    def __init__(self, name: str):
+        super().__init__(name, [])
+
+        # Registers the device's PVs with the server.
+        fidelity_definition = {'type': 'enum', 'enums': [option.capitalize() for option in self.fidelity_options]}
+        self.register_measurement(ModelStatusDevice.fidelity_pv, fidelity_definition)
+        self.register_measurement(ModelStatusDevice.number_pv, {'type': 'int'})
+
+    # The device has no model values. It is updated with the status of the model (see Model.get_model_status).
+    def update_model_status(self, status: Dict[str, Any]):
+        if not status:
+            return
+        fidelity = status[ModelStatusDevice.fidelity_key]
+        if fidelity in self.fidelity_options:
+            self.update_measurement(ModelStatusDevice.fidelity_pv, self.fidelity_options.index(fidelity))
+        self.update_measurement(ModelStatusDevice.number_pv, status[ModelStatusDevice.number_key])
+
+
+# An unrealistic device that reports the progress of the virtual accelerator, so clients can wait for one update
+# that includes their settings instead of sleeping.
+class VAStatusDevice(Device):
+    # EPICS PV names
+    cycle_pv = 'Cycle'
+    settings_generation_pv = 'Settings_Generation'
+    applied_generation_pv = 'Applied_Generation'
+    busy_pv = 'Busy'
+
+    def __init__(self, name: str):
+        super().__init__(name, [])
+
+        # Registers the device's PVs with the server.
+        self.register_measurement(VAStatusDevice.cycle_pv, {'type': 'int'})
+        self.register_measurement(VAStatusDevice.settings_generation_pv, {'type': 'int'})
+        self.register_measurement(VAStatusDevice.applied_generation_pv, {'type': 'int'})
+        self.register_measurement(VAStatusDevice.busy_pv, {'type': 'enum', 'enums': ['Idle', 'Busy']})
+
+    # The device has no model values. The virtual accelerator updates it directly.
+    def update_measurements(self, new_params: Dict[str, Dict[str, Any]] = None):
+        pass
+
+    def update_status(self, cycle: int, settings_generation: int, applied_generation: int, busy: bool):
+        self.update_measurement(VAStatusDevice.cycle_pv, cycle)
+        self.update_measurement(VAStatusDevice.settings_generation_pv, settings_generation)
+        self.update_measurement(VAStatusDevice.applied_generation_pv, applied_generation)
+        self.update_measurement(VAStatusDevice.busy_pv, int(busy))
+
+
 class BeamLine:
 
     def __init__(self, server_key_joiner: str = ':'):
@@ -413,9 +537,12 @@ class BeamLine:
         self.setting_keys = set()
         self.measurement_keys = set()
         self.readback_keys = set()
+        self.setting_parameters: Dict[str, tuple] = {}
+        self.server_getter: Optional[Callable[[str], Any]] = None
 
     def add_device(self, device: Device) -> Device:
         self.devices[device.name] = device
+        device.server_getter = self.server_getter
         for reason, parameter in device.get_parameters().items():
             server_key = parameter.get_server_key()
             if server_key is None:
@@ -424,6 +551,7 @@ class BeamLine:
 
             if reason in device.settings:
                 self.setting_keys.add(server_key)
+                self.setting_parameters[server_key] = (device, reason)
             elif reason in device.measurements:
                 self.measurement_keys.add(server_key)
             elif reason in device.readbacks:
@@ -458,6 +586,20 @@ class BeamLine:
                     device_settings |= {reason: server_parameters[param_key]}
             device.update_settings(device_settings)
 
+    def set_server_getter(self, server_getter: Optional[Callable[[str], Any]]):
+        # Lets devices read the values on the server (see Device.get_server_value).
+        self.server_getter = server_getter
+        for device in self.devices.values():
+            device.server_getter = server_getter
+
+    def validate_setting(self, server_key: str, new_value):
+        # Clients only write settings. Measurements, readbacks and the status of the virtual accelerator come from the
+        # model.
+        if server_key not in self.setting_parameters:
+            raise ValueError(f'{server_key} is not a setting.')
+        device, reason = self.setting_parameters[server_key]
+        return device.validate_setting(reason, new_value)
+
     def get_model_optics(self) -> Dict[str, Dict[str, Any]]:
         optics_dict = {}
         for device_name, device in self.devices.items():
@@ -470,6 +612,17 @@ class BeamLine:
             device_measurements = {key: value for key, value in new_measurements.items() if key in model_names}
             device.update_measurements(device_measurements)
 
+    def update_model_status(self, status: Dict[str, Any]):
+        for device in self.devices.values():
+            device.update_model_status(status)
+
+    def update_partial_measurements_from_model(self, new_measurements: Dict[str, Dict[str, Any]]):
+        # Updates only the devices with all their measurements in the dictionary, for results streamed during a track.
+        for device_name, device in self.devices.items():
+            model_names = device.model_names
+            if model_names and all(model_name in new_measurements for model_name in model_names):
+                device.update_measurements({model_name: new_measurements[model_name] for model_name in model_names})
+
     def update_readbacks(self):
         for device_name, device in self.devices.items():
             device.update_readbacks()
@@ -481,6 +634,28 @@ class BeamLine:
             device.clear_changes()
         return sever_dict
 
+    def set_observed_keys(self, server_keys: Optional[Set[str]]):
+        """Tells each device which of its parameters clients are watching. None means unknown, and every parameter is
+        treated as watched."""
+
+        for device_name, device in self.devices.items():
+            if server_keys is None:
+                device.set_observed(None)
+            else:
+                device.set_observed({reason for reason, param in device.get_parameters().items()
+                                     if param.get_server_key() in server_keys})
+
+    def get_model_names(self, server_keys: Set[str]) -> Set[str]:
+        """Returns the model names of the devices that have a measurement with one of the given server keys."""
+
+        model_names = set()
+        for device_name, device in self.devices.items():
+            for reason in device.measurements:
+                if device.get_parameter(reason).get_server_key() in server_keys:
+                    model_names |= set(device.model_names)
+                    break
+        return model_names
+
     def get_setting_keys(self) -> List[str]:
         setting_keys = []
         for device_name, device in self.devices.items():
@@ -7,7 +7,9 @@
 
 
 from epics import caget, caput
-from time import sleep
+# Instead of sleeping after each caput, wait_for_update waits until the virtual accelerator has tracked with the new
+# setting. It raises a TimeoutError if the virtual accelerator does not.
+from virtaccl.EPICS_Server.va_status import wait_for_update
 
 magnet = 'BTF_MEBT_Mag:PS_QV10'
 current_set = f'{magnet}:I_Set'
@@ -17,25 +19,25 @@ BS = 'ITSF_Diag:BS36_LP:CurrentAvrGt'
 FC = 'ITSF_Diag:FC12:CurrentAvrGt'
 FC_state = 'ITSF_Diag:FC12:State_Set'
 
+
 original_value = caget(current)
 
 print(f'Initial: QH10 current: {caget(current)}', f'BS36 value: {caget(BS)}')
 
 for i in range(10):
     new_current = caget(current) + 1/2
-    caput(current_set, new_current)
-    sleep(1)
+    caput(current_set, new_current, wait=True)
+    wait_for_update()
     print(f'QH10 current: {caget(current)}', f'BS36 value: {caget(BS)}')
 
-caput(current_set, original_value)
-sleep(1)
+caput(current_set, original_value, wait=True)
+wait_for_update()
 print(f'Reset values: QH10 current: {caget(current)}', f'BS36 value: {caget(BS)}')
-sleep(1)
 
 print(f'Before FC12 insert: FC12 value: {caget(FC)}', f'BS36 value: {caget(BS)}') 
-caput(FC_state, 1)
-sleep(1)
+caput(FC_state, 1, wait=True)
+wait_for_update()
 print(f'FC12 inserted: FC12 value: {caget(FC)}', f'BS36 value: {caget(BS)}')
-caput(FC_state, 0)
-sleep(1)
+caput(FC_state, 0, wait=True)
+wait_for_update()
 print(f'FC12 retracted: FC12 value: {caget(FC)}', f'BS36 value:{caget(BS)}')
@@ -0,0 +1,36 @@
+# This example needs the SNS virtual accelerator running in a separate window.
+# It measures how long CA gets take while the virtual accelerator is tracking. Run it once with the CA server in the
+# main process and once with it in its own process, and compare:
+#   sns_va --refresh_rate 10
+#   sns_va --refresh_rate 10 --ca_process
+# Changing a corrector every few gets keeps the model tracking particles the whole time.
+
+from time import perf_counter, sleep
+
+import numpy as np
+from epics import PV
+
+get_number = 2000
+corrector_set = PV('SCL_Mag:PS_DCH00:B_Set')
+bpm = PV('SCL_Diag:BPM04:xAvg')
+bpm.wait_for_connection()
+corrector_set.wait_for_connection()
+original_field = corrector_set.get()
+
+latencies = []
+for i in range(get_number):
+    if i % 50 == 0:
+        corrector_set.put(0.01 * np.sin(i / 50))
+    start_time = perf_counter()
+    bpm.get(use_monitor=False)
+    latencies.append(perf_counter() - start_time)
+    sleep(0.005)
+
+corrector_set.put(original_field)
+
+latencies = np.array(latencies) * 1000
+print(f'CA get latency over {get_number} gets [ms]:')
+print(f'  median: {np.median(latencies):.2f}')
+print(f'  95th percentile: {np.percentile(latencies, 95):.2f}')
+print(f'  99th percentile: {np.percentile(latencies, 99):.2f}')
+print(f'  max: {np.max(latencies):.2f}')
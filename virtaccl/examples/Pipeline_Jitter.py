@@ -0,0 +1,34 @@
+import time
+from functools import partial
+
+import numpy as np
+
+from virtaccl.PyORBIT_Model.pyorbit_pipeline import PipelineTracker
+from virtaccl.site.SNS_Linac.virtual_SNS_linac import build_sns_section_model
+
+# Jitter study of the SNS linac using the pipeline tracker. Each section of the linac is tracked in its own process, so
+# the sections work on different pulses at the same time.
+
+bunch_file = 'virtaccl/site/SNS_Linac/orbit_model/MEBT_in.dat'
+sections = [{'start': 'MEBT', 'end': 'DTL6', 'bunch_file': bunch_file},
+            {'start': 'CCL1', 'end': 'CCL4'},
+            {'start': 'SCLMed', 'end': 'SCLHigh'},
+            {'start': 'HEBT1', 'end': 'HEBT1'}]
+model_factory = partial(build_sns_section_model, particle_number=1000, beam_current=38.0)
+
+pulse_number = 20
+rng = np.random.default_rng()
+optics_list = []
+for n in range(pulse_number):
+    optics_list.append({'MEBT_Mag:DCH01': {'B': rng.normal(0, 1e-3)},
+                        'SCL_Mag:DCH00': {'B': rng.normal(0, 1e-3)}})
+
+if __name__ == '__main__':
+    with PipelineTracker(model_factory, sections, max_particles=1000) as pipeline:
+        start_time = time.time()
+        pulses = pipeline.track_pulses(optics_list)
+        time_taken = time.time() - start_time
+
+    print(f'Tracked {pulse_number} pulses in {round(time_taken, 2)} seconds.')
+    for n, measurements in enumerate(pulses):
+        print(n, measurements['HEBT_Diag:BPM11']['x_avg'])
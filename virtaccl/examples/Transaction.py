@@ -0,0 +1,23 @@
+# This example needs the SNS virtual accelerator running in a separate window.
+# It changes several correctors in one transaction, so they are all applied in the same track, and then waits for that
+# track to finish.
+
+import json
+
+from epics import caget, caput
+
+from virtaccl.EPICS_Server.va_status import wait_for_update
+
+new_settings = {'SCL_Mag:PS_DCH00:B_Set': 0.02,
+                'SCL_Mag:PS_DCV00:B_Set': -0.01,
+                'SCL_Mag:PS_DCH04:B_Set': 0.01}
+
+caput('Virac:Transaction:Commit', json.dumps(new_settings), wait=True)
+error = caget('Virac:Transaction:Error', as_string=True)
+if error:
+    print(f'Transaction rejected: {error}')
+else:
+    generation = caget('Virac:Transaction:Generation')
+    print(f'Transaction applied as settings generation {generation}.')
+    wait_for_update(generation=generation)
+    print(f'BPM04 x position: {caget("SCL_Diag:BPM04:xAvg")}')
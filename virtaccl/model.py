@@ -1,4 +1,4 @@
-from typing import Dict, Any
+from typing import Dict, Any, Callable, Optional, Set
 
 
 class Model:
@@ -22,6 +22,85 @@ class Model:
         """Updates values within your model."""
         pass
 
+    def refine(self) -> bool:
+        """Improves the values from the last track, for models that first give a quick approximate result.
+
+        Returns
+        ----------
+        out : bool
+            True if the values changed and need to be published again.
+        """
+        return False
+
+    def refinement_pending(self) -> bool:
+        """Returns True if the values of the last track are a quick result that refine would improve."""
+        return False
+
+    def get_model_status(self) -> Dict[str, Any]:
+        """Returns how the values of the last track were computed, for models with several fidelities.
+
+        Returns
+        ----------
+        out : dictionary
+            Dictionary of status parameters, empty if the model has none.
+        """
+        return {}
+
+    def set_tracking_callback(self, callback: Optional[Callable[[], None]]) -> None:
+        """Gives the model a function to call periodically during long tracks. The function applies any new settings
+        with update_optics, so models that support it can react to changes before the track is finished.
+
+        Parameters
+        ----------
+        callback : function or None
+            Function without arguments, or None to remove it.
+        """
+        pass
+
+    def set_streaming_callback(self, callback: Optional[Callable[[Dict[str, Dict[str, Any]]], None]]) -> None:
+        """Gives the model a function to call with partial measurements during long tracks, so diagnostics that are
+        already computed can be published before the track is finished.
+
+        Parameters
+        ----------
+        callback : function or None
+            Function taking a dictionary of measurements in the same format as get_measurements, or None to remove it.
+        """
+        pass
+
+    def set_needed_elements(self, element_names: Optional[Set[str]]) -> None:
+        """Tells the model which elements need their measurements updated, so models that support it can skip
+        computing the others.
+
+        Parameters
+        ----------
+        element_names : set of strings or None
+            Model names of the needed elements, or None if all elements are needed.
+        """
+        pass
+
+    def set_observed_elements(self, element_names: Optional[Set[str]]) -> None:
+        """Tells the model which elements clients are watching, so models that support it can skip expensive
+        measurements nobody is looking at.
+
+        Parameters
+        ----------
+        element_names : set of strings or None
+            Model names of the watched elements, or None if all elements are watched.
+        """
+        pass
+
+    def require_particles(self, element_names: Set[str]) -> None:
+        """Tells the model which elements clients are watching, so models with a fast mode that does not track
+        particles can track them while a watched diagnostic needs them.
+
+        Parameters
+        ----------
+        element_names : set of strings
+            Model names of the watched elements.
+        """
+        pass
+
     def update_optics(self, changed_optics: Dict[str, Dict[str, Any]]) -> None:
         """Take external values and update the model. Needs an input of a dictionary with the model name of the element
         as a key to a dictionary of the element's parameters with their new values.
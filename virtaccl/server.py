@@ -1,12 +1,81 @@
 import signal
-from threading import Event
-from typing import Dict, Any
+import itertools
+from queue import SimpleQueue, Empty
+from threading import Event, Lock, RLock, current_thread, main_thread
+from typing import Dict, Any, Optional, Set, Callable, List, Tuple
 from datetime import datetime
 
+import numpy as np
+
+
+class PublishPolicy:
+    """
+    How often a server parameter is sent to clients. The server may skip or delay values according to the policy.
+
+        Parameters
+        ----------
+        max_rate : float, optional
+            Highest rate (in Hz) the parameter is published at. Values that come faster are held, and the latest one is
+            published once the rate allows. The default is no limit.
+        deadband : float, optional
+            Smallest change (largest change of any element for arrays) from the last published value that is
+            published, like the EPICS MDEL field. The default is no deadband.
+        on_change : bool, optional
+            Only publish values that differ from the last published value. The default is False.
+    """
+
+    def __init__(self, max_rate: float = None, deadband: float = None, on_change: bool = False):
+        self.max_rate = max_rate
+        self.deadband = deadband
+        self.on_change = on_change
+
+    def is_significant(self, last_value, new_value) -> bool:
+        if last_value is None or (self.deadband is None and not self.on_change):
+            return True
+        try:
+            last_array = np.asarray(last_value, dtype=float)
+            new_array = np.asarray(new_value, dtype=float)
+        except (TypeError, ValueError):
+            return new_value != last_value
+        if last_array.shape != new_array.shape:
+            return True
+        difference = float(np.max(np.abs(new_array - last_array))) if new_array.size > 0 else 0.0
+        if self.deadband is not None:
+            return difference > self.deadband
+        return difference > 0
+
+    def is_due(self, last_time: Optional[float], now: float) -> bool:
+        if last_time is None or self.max_rate is None:
+            return True
+        return now - last_time >= 1 / self.max_rate
+
 
 class Server:
     def __init__(self):
         self.parameter_db = {}
+        # Counts the writes of settings by clients. If a generation key is given, that parameter shows the count as
+        # soon as a write arrives.
+        self.settings_generation = 0
+        self.generation_key: Optional[str] = None
+        # Number of the update cycle the values being published belong to, for servers that publish it with the values.
+        self.cycle = 0
+        # Held while settings are written or read, so a group of settings is never seen half applied.
+        self.settings_lock = RLock()
+        # Function called with the key of a parameter before a client reads it. Servers answering reads from the thread
+        # that serves all clients turn off waiting, so the callback only asks for new values and returns.
+        self.read_callback: Optional[Callable[[str], None]] = None
+        self.wait_on_read = True
+        # Writes by clients as (key, value, timestamp), in the order they arrived, until the virtual accelerator takes
+        # them. The validator is called with the key and value of each write and returns the value to use (for example
+        # clamped to limits) or raises a ValueError to reject the write.
+        self.write_queue: SimpleQueue = SimpleQueue()
+        # Change journal: sequence number of the last change of each parameter, so servers and gateways can find what
+        # changed since they last looked. Changes are recorded from the threads of clients and of the virtual
+        # accelerator, so numbering and storing a change happen under the journal lock.
+        self.change_counter = itertools.count(1)
+        self.change_journal: Dict[str, int] = {}
+        self.journal_lock = Lock()
+        self.write_validator: Optional[Callable[[str, Any], Any]] = None
 
     def add_parameters(self, new_parameters: Dict[str, Dict[str, Any]]):
         for parameter_key, parameter_definitions in new_parameters.items():
@@ -33,7 +102,86 @@ class Server:
         return self.parameter_db[parameter_key]['value']
 
     def set_parameter(self, parameter_key: str, new_value, timestamp: datetime = None):
+        # Only values that changed go in the journal, so readers of the changes skip parameters set to the same value.
+        changed = not np.array_equal(self.parameter_db[parameter_key].get('value'), new_value)
         self.parameter_db[parameter_key]['value'] = new_value
+        if changed:
+            self.record_change(parameter_key)
+
+    def record_change(self, parameter_key: str):
+        with self.journal_lock:
+            self.change_journal[parameter_key] = next(self.change_counter)
+
+    def get_changes(self, since: int) -> Tuple[Set[str], int]:
+        """Returns the keys of the parameters changed after the given sequence number, and the sequence number to pass
+        next time."""
+        with self.journal_lock:
+            changes = {key: sequence for key, sequence in self.change_journal.items() if sequence > since}
+        return set(changes.keys()), max(changes.values(), default=since)
+
+    def apply_transaction(self, new_settings: Dict[str, Any]) -> int:
+        """Sets several parameters as one change, so they are all used in the same track.
+
+        Parameters
+        ----------
+        new_settings : dictionary
+            Dictionary of parameter keys and their new values.
+
+        Returns
+        ----------
+        out : int
+            The settings generation of the transaction.
+        """
+
+        unknown_keys = [key for key in new_settings.keys() if key not in self.parameter_db]
+        if unknown_keys:
+            raise KeyError(f'Unknown parameters: {", ".join(unknown_keys)}')
+        new_settings = {key: self.validate_write(key, value) for key, value in new_settings.items()}
+        with self.settings_lock:
+            self.set_parameters(new_settings)
+            for key, value in new_settings.items():
+                self.queue_write(key, value)
+            self.settings_generation += 1
+            if self.generation_key is not None:
+                self.set_parameter(self.generation_key, self.settings_generation)
+            return self.settings_generation
+
+    def set_cycle(self, cycle: int):
+        self.cycle = cycle
+
+    def set_generation_key(self, generation_key: Optional[str]):
+        self.generation_key = generation_key
+
+    def set_write_validator(self, validator: Optional[Callable[[str, Any], Any]]):
+        self.write_validator = validator
+
+    def validate_write(self, parameter_key: str, new_value) -> Any:
+        if self.write_validator is None:
+            return new_value
+        return self.write_validator(parameter_key, new_value)
+
+    def queue_write(self, parameter_key: str, new_value, timestamp: datetime = None):
+        if timestamp is None:
+            timestamp = datetime.now()
+        self.write_queue.put((parameter_key, new_value, timestamp))
+        self.record_change(parameter_key)
+
+    def get_writes(self) -> List[Tuple[str, Any, datetime]]:
+        """Takes all writes by clients since the last call, in the order they arrived."""
+        writes = []
+        while True:
+            try:
+                writes.append(self.write_queue.get_nowait())
+            except Empty:
+                return writes
+
+    def set_read_callback(self, callback: Optional[Callable[[str], None]]):
+        self.read_callback = callback
+
+    def get_subscribed_keys(self) -> Optional[Set[str]]:
+        """Returns the keys of the parameters that clients are currently watching (monitoring or recently reading), or
+        None if the server can't tell."""
+        return None
 
     def update(self):
         pass
@@ -55,3 +203,11 @@ def not_ctrlc():
 class CtrlC:
     event = Event()
     signal.signal(signal.SIGINT, lambda _1, _2: CtrlC.event.set())
+
+
+def stop_on_terminate():
+    # Terminating the process (as test suites do) stops the virtual accelerator like Ctrl-C, so it shuts down cleanly.
+    # Only the main loops of virtual accelerators install this, since other processes importing virtaccl (CA processes,
+    # replicas, test runners) need to stay terminable.
+    if current_thread() is main_thread():
+        signal.signal(signal.SIGTERM, lambda _1, _2: CtrlC.event.set())
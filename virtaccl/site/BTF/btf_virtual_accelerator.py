@@ -7,6 +7,7 @@ import sys
 import time
 import argparse
 from pathlib import Path
+from typing import List
 from importlib.metadata import version
 
 from orbit.py_linac.lattice_modifications import Add_quad_apertures_to_lattice, Add_bend_apertures_to_lattice, Add_drift_apertures_to_lattice
@@ -24,13 +25,13 @@ from virtaccl.site.BTF.orbit_model.virtual_devices_BTF import BTF_FC, BTF_Quadru
     BTF_BCM, BTF_Actuator, BTF_Corrector, BTF_Corrector_Power_Supply
 from virtaccl.site.BTF.orbit_model.btf_child_nodes import BTF_Screenclass, BTF_Slitclass
 
-from virtaccl.PyORBIT_Model.pyorbit_lattice_controller import OrbitModel
-from virtaccl.EPICS_Server.ca_server import EPICS_Server, add_epics_arguments
+from virtaccl.PyORBIT_Model.pyorbit_lattice_controller import OrbitModel, load_handoff_bunch
+from virtaccl.EPICS_Server.ca_server import build_epics_server, add_epics_arguments
 
 from virtaccl.virtual_accelerator import VA_Parser
 
 
-def btf_arguments():
+def btf_arguments(argv: List[str] = None):
     loc = Path(__file__).parent
     va_parser = VA_Parser()
     va_parser.set_description('Run the BTF PyORBIT virtual accelerator server.')
@@ -54,12 +55,12 @@ def btf_arguments():
     va_parser.add_argument('--phase_offset', default=None, type=str,
                            help='Pathname of phase offset file.')
 
-    va_args = va_parser.initialize_arguments()
+    va_args = va_parser.initialize_arguments(argv)
     return va_args
 
 
 def build_btf(**kwargs):
-    kwargs = btf_arguments() | kwargs
+    kwargs = btf_arguments(kwargs.pop('argv', None)) | kwargs
 
     kwargs['sync_time'] = True
     debug = kwargs['debug']
@@ -135,6 +136,14 @@ def build_btf(**kwargs):
                 bunch_in.deleteParticleFast(n)
         bunch_in.compress()
 
+    # Use the stored bunch entering the start sequence if one matches the upstream optics.
+    handoff_dir = kwargs['handoff_dir']
+    handoff = None
+    if handoff_dir is not None:
+        handoff = load_handoff_bunch(handoff_dir, start_sequence, kwargs['handoff_optics'])
+        if handoff is not None:
+            bunch_in, beam_current = handoff
+
     # get sync particle momentum for use in corrector current conversion
     syncPart = bunch_in.getSyncParticle()
     momentum = syncPart.momentum()
@@ -146,6 +155,8 @@ def build_btf(**kwargs):
     model.define_custom_node(BTF_Slitclass.node_type, BTF_Slitclass.parameter_list, optic=True)
     model.define_custom_node(BCMclass.node_type, BCMclass.parameter_list, diagnostic=True)
     model.initialize_lattice(model_lattice)
+    if handoff_dir is not None and handoff is None:
+        model.set_handoff_directory(handoff_dir)
     model.set_initial_bunch(bunch_in, beam_current)
     element_list = model.get_element_list()
 
@@ -301,8 +312,7 @@ def build_btf(**kwargs):
             slit_device = BTF_Actuator(name, ele_name, speed=speed, limit=limit)
             beam_line.add_device(slit_device)
 
-    delay = kwargs['ca_proc']
-    server = EPICS_Server(process_delay=delay)
+    server = build_epics_server(**kwargs)
 
     btf_virac = PyorbitVirtualAcceleratorBuilder(model, beam_line, server, **kwargs)
     return btf_virac
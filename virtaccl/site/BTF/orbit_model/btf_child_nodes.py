@@ -31,8 +31,16 @@ class BTF_Screenclass(BaseLinacNode):
             self.setParam('axis_polarity', 1)
             print('No axis polarity set for', child_name + ',', 'using standard value')
 
+    def intercepts_beam(self) -> bool:
+        # True when the screen is close enough to the bunch to remove particles, like the slit below.
+        current_position = (self.getParam('position') + self.getParam('interaction_start')) * \
+            self.getParam('axis_polarity')
+        if self.getParam('axis_polarity') < 0:
+            return current_position < self.near_bunch
+        return current_position > -self.near_bunch
+
     def track(self, paramsDict):
-        if "bunch" not in paramsDict:
+        if "bunch" not in paramsDict or paramsDict.get("probe"):
             return
         bunch = paramsDict["bunch"]
 
@@ -133,8 +141,18 @@ class BTF_Slitclass(BaseLinacNode):
         if self.getParam('slit_width') is None:
             self.setParam('slit_width', 0.0002)
 
+    def intercepts_beam(self) -> bool:
+        # True when the slit is close enough to the bunch to remove particles. The envelope model can't describe that,
+        # so the model tracks particles while it is (see OrbitModel.beam_intercepted).
+        current_position = (self.getParam('position') + self.getParam('interaction_start')) * \
+            self.getParam('axis_polarity')
+        if self.getParam('axis_polarity') < 0:
+            return current_position < self.near_bunch
+        return current_position > -self.near_bunch
+
     def track(self, paramsDict):
-        if "bunch" not in paramsDict:
+        # Probe bunches of the envelope model only pass while the slit is out of the beam, where it does nothing.
+        if "bunch" not in paramsDict or paramsDict.get("probe"):
             return
         bunch = paramsDict["bunch"]
 
@@ -1,6 +1,7 @@
 import json
 import sys
 from pathlib import Path
+from typing import List
 
 from virtaccl.PyORBIT_Model.pyorbit_va_nodes import BPMclass, WSclass, ScreenClass
 from virtaccl.PyORBIT_Model.pyorbit_virtual_accelerator import PyorbitVirtualAcceleratorBuilder, add_pyorbit_arguments
@@ -11,13 +12,13 @@ from virtaccl.site.SNS_Linac.virtual_devices_SNS import SNS_Dummy_BCM, SNS_Dummy
 
 from virtaccl.PyORBIT_Model.pyorbit_lattice_controller import OrbitModel
 from virtaccl.beam_line import BeamLine
-from virtaccl.EPICS_Server.ca_server import EPICS_Server, add_epics_arguments
+from virtaccl.EPICS_Server.ca_server import build_epics_server, add_epics_arguments
 from virtaccl.virtual_accelerator import VA_Parser
 
 from virtaccl.site.SNS_IDmp.IDmp_maker import get_IDMP_lattice_and_bunch
 
 
-def idmp_arguments():
+def idmp_arguments(argv: List[str] = None):
     loc = Path(__file__).parent
     va_parser = VA_Parser()
     va_parser.set_description('Run the SNS Injection Dump PyORBIT virtual accelerator server.')
@@ -31,6 +32,8 @@ def idmp_arguments():
     va_parser.remove_argument('--bunch')
 
     va_parser = add_epics_arguments(va_parser)
+    # The screen image is only rendered while a client is watching it.
+    va_parser.change_argument_default('--lazy', True)
 
     # Json file that contains a dictionary connecting EPICS name of devices with their associated element model names.
     va_parser.add_argument('--config_file', '-f', default=loc / 'va_config.json', type=str,
@@ -40,12 +43,12 @@ def idmp_arguments():
     va_parser.add_argument('--phase_offset', default=None, type=str,
                            help='Pathname of phase offset file.')
 
-    va_args = va_parser.initialize_arguments()
+    va_args = va_parser.initialize_arguments(argv)
     return va_args
 
 
 def build_idmp(**kwargs):
-    kwargs = idmp_arguments() | kwargs
+    kwargs = idmp_arguments(kwargs.pop('argv', None)) | kwargs
 
     debug = kwargs['debug']
 
@@ -124,8 +127,7 @@ def build_idmp(**kwargs):
     dummy_device = SNS_Dummy_ICS("ICS_Tim")
     beam_line.add_device(dummy_device)
 
-    delay = kwargs['ca_proc']
-    server = EPICS_Server(process_delay=delay)
+    server = build_epics_server(**kwargs)
 
     idmp_virac = PyorbitVirtualAcceleratorBuilder(model, beam_line, server, **kwargs)
     return idmp_virac
@@ -1,9 +1,10 @@
 import json
 import math
 from pathlib import Path
+from typing import List
 
 from orbit.lattice import AccNode
-from orbit.py_linac.lattice import LinacPhaseApertureNode
+from orbit.py_linac.lattice import LinacPhaseApertureNode, LinacAccLattice
 from orbit.py_linac.lattice_modifications import Add_quad_apertures_to_lattice, Add_rfgap_apertures_to_lattice
 from orbit.core.bunch import Bunch
 from orbit.core.linac import BaseRfGap, RfGapTTF
@@ -14,17 +15,18 @@ from virtaccl.site.SNS_Linac.virtual_devices import (BPM, Quadrupole, Corrector,
                                                      Quadrupole_Power_Shunt)
 from virtaccl.site.SNS_Linac.virtual_devices_SNS import SNS_Dummy_BCM, SNS_Cavity, SNS_Dummy_ICS
 
-from virtaccl.PyORBIT_Model.pyorbit_virtual_accelerator import PyorbitVirtualAcceleratorBuilder, add_pyorbit_arguments
-from virtaccl.PyORBIT_Model.pyorbit_lattice_controller import OrbitModel
+from virtaccl.PyORBIT_Model.pyorbit_virtual_accelerator import PyorbitVirtualAcceleratorBuilder, add_pyorbit_arguments, \
+    load_input_bunch
+from virtaccl.PyORBIT_Model.pyorbit_lattice_controller import OrbitModel, load_handoff_bunch
 from virtaccl.PyORBIT_Model.pyorbit_va_nodes import BPMclass, WSclass
 
-from virtaccl.EPICS_Server.ca_server import EPICS_Server, add_epics_arguments
+from virtaccl.EPICS_Server.ca_server import build_epics_server, add_epics_arguments
 from virtaccl.beam_line import BeamLine
 
 from virtaccl.virtual_accelerator import VA_Parser
 
 
-def sns_arguments():
+def sns_arguments(argv: List[str] = None):
     loc = Path(__file__).parent
     va_parser = VA_Parser()
     va_parser.set_description('Run the SNS linac PyORBIT virtual accelerator server.')
@@ -45,12 +47,50 @@ def sns_arguments():
     va_parser.add_argument('--phase_offset', default=None, type=str,
                            help='Pathname of phase offset file.')
 
-    va_args = va_parser.initialize_arguments()
+    va_args = va_parser.initialize_arguments(argv)
     return va_args
 
 
+def sns_lattice(lattice_file, start_sequence: str, end_sequence: str, drift_length: float = 1.0) -> LinacAccLattice:
+    lattice_factory = PyORBIT_Lattice_Factory()
+    lattice_factory.setMaxDriftLength(drift_length)
+    model_lattice = lattice_factory.getLinacAccLattice_test(lattice_file, end_sequence, start_sequence)
+    cppGapModel = BaseRfGap
+    rf_gaps = model_lattice.getRF_Gaps()
+    for rf_gap in rf_gaps:
+        rf_gap.setCppGapModel(cppGapModel())
+        phaseAperture = LinacPhaseApertureNode(rf_gap.getRF_Cavity().getFrequency(), rf_gap.getName() + ":phaseAprt")
+        phaseAperture.setPosition(rf_gap.getPosition())
+        phaseAperture.setMinMaxPhase(-180.0 * 2, +180.0 * 2)
+        rf_gap.addChildNode(phaseAperture, AccNode.EXIT)
+    Add_quad_apertures_to_lattice(model_lattice)
+    Add_rfgap_apertures_to_lattice(model_lattice)
+    return model_lattice
+
+
+# Builds the model of one section of the linac for the pipeline tracker (see PyORBIT_Model/pyorbit_pipeline.py). Only
+# the first section needs a bunch file, the other sections get their bunch from the section upstream.
+def build_sns_section_model(start: str, end: str, bunch_file: str = None, particle_number: int = 1000,
+                            beam_current: float = 38.0, lattice_file: str = None, drift_length: float = 1.0,
+                            space_charge: float = None) -> OrbitModel:
+    if lattice_file is None:
+        lattice_file = Path(__file__).parent / 'orbit_model/sns_linac.xml'
+    model_lattice = sns_lattice(lattice_file, start, end, drift_length)
+
+    model = OrbitModel()
+    model.define_custom_node(BPMclass.node_type, BPMclass.parameter_list, diagnostic=True)
+    model.define_custom_node(WSclass.node_type, WSclass.parameter_list, diagnostic=True)
+    model.initialize_lattice(model_lattice)
+    if space_charge is not None:
+        model.add_space_charge_nodes(space_charge)
+    if bunch_file is not None:
+        bunch_in = load_input_bunch(bunch_file, particle_number, beam_current / 1000)
+        model.set_initial_bunch(bunch_in, beam_current / 1000)
+    return model
+
+
 def build_sns(**kwargs):
-    kwargs = sns_arguments() | kwargs
+    kwargs = sns_arguments(kwargs.pop('argv', None)) | kwargs
 
     debug = kwargs['debug']
     save_bunch = kwargs['save_bunch']
@@ -64,19 +104,7 @@ def build_sns(**kwargs):
     end_sequence = kwargs['end']
     drift_length = kwargs['drift_length']
 
-    lattice_factory = PyORBIT_Lattice_Factory()
-    lattice_factory.setMaxDriftLength(drift_length)
-    model_lattice = lattice_factory.getLinacAccLattice_test(lattice_file, end_sequence, start_sequence)
-    cppGapModel = BaseRfGap
-    rf_gaps = model_lattice.getRF_Gaps()
-    for rf_gap in rf_gaps:
-        rf_gap.setCppGapModel(cppGapModel())
-        phaseAperture = LinacPhaseApertureNode(rf_gap.getRF_Cavity().getFrequency(), rf_gap.getName() + ":phaseAprt")
-        phaseAperture.setPosition(rf_gap.getPosition())
-        phaseAperture.setMinMaxPhase(-180.0 * 2, +180.0 * 2)
-        rf_gap.addChildNode(phaseAperture, AccNode.EXIT)
-    Add_quad_apertures_to_lattice(model_lattice)
-    Add_rfgap_apertures_to_lattice(model_lattice)
+    model_lattice = sns_lattice(lattice_file, start_sequence, end_sequence, drift_length)
 
     part_num = kwargs['particle_number']
     beam_current = kwargs['beam_current'] / 1000  # Set the initial beam current in Amps.
@@ -105,6 +133,14 @@ def build_sns(**kwargs):
                 bunch_in.deleteParticleFast(n)
         bunch_in.compress()
 
+    # Use the stored bunch entering the start sequence if one matches the upstream optics.
+    handoff_dir = kwargs['handoff_dir']
+    handoff = None
+    if handoff_dir is not None:
+        handoff = load_handoff_bunch(handoff_dir, start_sequence, kwargs['handoff_optics'])
+        if handoff is not None:
+            bunch_in, beam_current = handoff
+
     space_charge = kwargs['space_charge']
     model = OrbitModel(debug=debug, save_bunch=save_bunch)
     model.define_custom_node(BPMclass.node_type, BPMclass.parameter_list, diagnostic=True)
@@ -112,6 +148,8 @@ def build_sns(**kwargs):
     model.initialize_lattice(model_lattice)
     if space_charge is not None:
         model.add_space_charge_nodes(space_charge)
+    if handoff_dir is not None and handoff is None:
+        model.set_handoff_directory(handoff_dir)
     model.set_initial_bunch(bunch_in, beam_current)
     element_list = model.get_element_list()
 
@@ -231,8 +269,7 @@ def build_sns(**kwargs):
     dummy_device = SNS_Dummy_ICS("ICS_Tim")
     beam_line.add_device(dummy_device)
 
-    delay = kwargs['ca_proc']
-    server = EPICS_Server(process_delay=delay)
+    server = build_epics_server(**kwargs)
 
     sns_virac = PyorbitVirtualAcceleratorBuilder(model, beam_line, server, **kwargs)
     return sns_virac
@@ -1,6 +1,7 @@
 import sys
 import time
 import math
+import zlib
 from random import randint, random
 from typing import Dict, Any, Union, Literal
 
@@ -8,6 +9,7 @@ import numpy as np
 from scipy.interpolate import interp2d
 
 from virtaccl.beam_line import Device, AbsNoise, LinearT, PhaseT, PhaseTInv, LinearTInv, PosNoise, NormalizePeak
+from virtaccl.server import PublishPolicy
 
 
 # Here are the device definitions that take the information from PyORBIT and translates/packages it into information for
@@ -375,10 +377,16 @@ class WireScanner(Device):
         self.register_measurement(WireScanner.y_avg_pv, noise=xy_noise, transform=self.milli_units)
         self.register_measurement(WireScanner.x_sigma_pv, noise=xy_noise, transform=self.milli_units)
         self.register_measurement(WireScanner.y_sigma_pv, noise=xy_noise, transform=self.milli_units)
-        self.register_measurement(WireScanner.x_profile_pv, definition={'count': bin_number})
-        self.register_measurement(WireScanner.x_axis_pv, transform=self.milli_units, definition={'count': bin_number})
-        self.register_measurement(WireScanner.y_profile_pv, definition={'count': bin_number})
-        self.register_measurement(WireScanner.y_axis_pv, transform=self.milli_units, definition={'count': bin_number})
+        # The profiles only change when the beam does, so they are only published when they change.
+        profile_policy = PublishPolicy(on_change=True)
+        self.register_measurement(WireScanner.x_profile_pv, definition={'count': bin_number},
+                                  publish_policy=profile_policy)
+        self.register_measurement(WireScanner.x_axis_pv, transform=self.milli_units, definition={'count': bin_number},
+                                  publish_policy=profile_policy)
+        self.register_measurement(WireScanner.y_profile_pv, definition={'count': bin_number},
+                                  publish_policy=profile_policy)
+        self.register_measurement(WireScanner.y_axis_pv, transform=self.milli_units, definition={'count': bin_number},
+                                  publish_policy=profile_policy)
 
         self.register_setting(WireScanner.speed_pv, default=initial_speed, transform=self.milli_units)
         self.register_setting(WireScanner.position_pv, default=initial_position, transform=self.milli_units)
@@ -455,9 +463,31 @@ class Screen(Device):
     y_profile_pv = 'resultsVerProf'  # [au]
     image_pv = 'resultsImg'  # [au]
     image_noise = 5  # [au]
+    image_rate = 1.0  # [Hz]
     x_axis_pv = 'resultsHorProfX'  # [mm]
     y_axis_pv = 'resultsVerProfX'  # [mm]
 
+    # Live view: the region of interest of the image, binned and optionally compressed.
+    roi_x_start_pv = 'ROI_X_Start'  # [pixel]
+    roi_x_size_pv = 'ROI_X_Size'  # [pixel]
+    roi_y_start_pv = 'ROI_Y_Start'  # [pixel]
+    roi_y_size_pv = 'ROI_Y_Size'  # [pixel]
+    binning_pv = 'Binning'
+    binning_options = ['1x1', '2x2', '4x4']
+    binning_factors = [1, 2, 4]
+    compression_pv = 'Compression'
+    compression_options = ['None', 'Zlib']
+    live_image_pv = 'Live_Img'  # [au]
+    live_width_pv = 'Live_Width'  # [pixel]
+    live_height_pv = 'Live_Height'  # [pixel]
+    live_size_pv = 'Live_Size'  # [byte]
+
+    # The full resolution image and profiles are published continuously, or once each time one is requested. Requests
+    # are the default, since the live view is the continuous view of the screen.
+    full_mode_pv = 'Full_Img_Mode'
+    full_mode_options = ['Continuous', 'On_Demand']
+    full_request_pv = 'Full_Img_Request'
+
     # PyORBIT parameter keys
     hist_key = 'xy_histogram'  # [au]
     x_axis_key = 'x_axis'  # [m]
@@ -473,8 +503,8 @@ class Screen(Device):
             self.model_name = model_name
         super().__init__(name, self.model_name)
 
-        x_pixels = x_pixels
-        y_pixels = y_pixels
+        self.x_pixels = x_pixels
+        self.y_pixels = y_pixels
         x_scale = x_scale
         y_scale = y_scale
 
@@ -488,17 +518,63 @@ class Screen(Device):
         signal_max = 254
         self.signal_normalize = NormalizePeak(max_value=signal_max)
 
-        # Registers the device's PVs with the server.
-        self.register_measurement(Screen.x_profile_pv, definition={'count': x_pixels})
-        self.register_measurement(Screen.y_profile_pv, definition={'count': y_pixels})
-        self.register_measurement(Screen.image_pv, definition={'type': 'char', 'count': x_pixels * y_pixels})
+        # Registers the device's PVs with the server. The image is large, so it is published at most once a second.
+        image_policy = PublishPolicy(max_rate=Screen.image_rate)
+        self.register_measurement(Screen.x_profile_pv, definition={'count': x_pixels}, publish_policy=image_policy)
+        self.register_measurement(Screen.y_profile_pv, definition={'count': y_pixels}, publish_policy=image_policy)
+        self.register_measurement(Screen.image_pv, definition={'type': 'char', 'count': x_pixels * y_pixels,
+                                                               'shape': (y_pixels, x_pixels)},
+                                  publish_policy=image_policy)
 
         self.register_readback(Screen.x_axis_pv, definition={'count': x_pixels})
         self.register_readback(Screen.y_axis_pv, definition={'count': y_pixels})
 
+        self.register_setting(Screen.roi_x_start_pv, default=0, definition={'type': 'int'})
+        self.register_setting(Screen.roi_x_size_pv, default=x_pixels, definition={'type': 'int'})
+        self.register_setting(Screen.roi_y_start_pv, default=0, definition={'type': 'int'})
+        self.register_setting(Screen.roi_y_size_pv, default=y_pixels, definition={'type': 'int'})
+        self.register_setting(Screen.binning_pv, default=2,
+                              definition={'type': 'enum', 'enums': Screen.binning_options})
+        self.register_setting(Screen.compression_pv, default=0,
+                              definition={'type': 'enum', 'enums': Screen.compression_options})
+        self.register_setting(Screen.full_mode_pv, default=Screen.full_mode_options.index('On_Demand'),
+                              definition={'type': 'enum', 'enums': Screen.full_mode_options})
+        self.register_setting(Screen.full_request_pv, default=0, definition={'type': 'int'})
+
+        # Compressing noisy images at 1x1 binning can make them larger, so the live image has room for zlib's bound on
+        # the compressed size (compressBound in zlib.h).
+        pixel_number = x_pixels * y_pixels
+        live_count = pixel_number + (pixel_number >> 12) + (pixel_number >> 14) + (pixel_number >> 25) + 13
+        self.register_measurement(Screen.live_image_pv, definition={'type': 'char', 'count': live_count})
+        self.register_measurement(Screen.live_width_pv, definition={'type': 'int'})
+        self.register_measurement(Screen.live_height_pv, definition={'type': 'int'})
+        self.register_measurement(Screen.live_size_pv, definition={'type': 'int'})
+
+    # The region of interest is kept on the screen.
+    def validate_setting(self, reason: str, new_value):
+        if reason in (Screen.roi_x_start_pv, Screen.roi_x_size_pv):
+            pixels = self.x_pixels
+        elif reason in (Screen.roi_y_start_pv, Screen.roi_y_size_pv):
+            pixels = self.y_pixels
+        else:
+            return new_value
+        if reason in (Screen.roi_x_start_pv, Screen.roi_y_start_pv):
+            return min(max(int(new_value), 0), pixels - 1)
+        return min(max(int(new_value), 1), pixels)
+
     # Updates the measurement values on the server. Needs the model key associated with its value and the new value.
     # This is where the measurement PV name is associated with it's model key.
     def update_measurements(self, new_params: Dict[str, Dict[str, Any]] = None):
+        # Rendering the image is expensive, so it is skipped while no client is watching the screen. In on demand mode,
+        # the full resolution image is only rendered when requested.
+        full_requested = self.get_parameter_value(Screen.full_request_pv) != 0
+        full_continuous = Screen.full_mode_options[self.get_parameter_value(Screen.full_mode_pv)] == 'Continuous'
+        full_needed = (full_continuous or full_requested) and \
+            any(self.is_observed(reason) for reason in (Screen.image_pv, Screen.x_profile_pv, Screen.y_profile_pv))
+        live_needed = self.is_observed(Screen.live_image_pv)
+        if not full_needed and not live_needed:
+            return
+
         screen_params = new_params[self.model_name]
         xy_hist = screen_params[Screen.hist_key]
         x_axis = screen_params[Screen.x_axis_key] * 1000
@@ -511,6 +587,13 @@ class Screen(Device):
         # Create linearly interpolated function
         interp_func = interp2d(x_centers, y_centers, xy_hist, kind='linear', fill_value=False)
 
+        if live_needed:
+            self.update_live_view(interp_func)
+        if not full_needed:
+            return
+        if full_requested:
+            self.server_setting_override(Screen.full_request_pv, 0)
+
         # Interpolate histogram to higher resolution
         xy_hist_new = interp_func(self.x_axis_new, self.y_axis_new)
         xy_hist_new = self.image_noise.add_noise(xy_hist_new)
@@ -524,6 +607,29 @@ class Screen(Device):
         self.update_measurement(Screen.x_profile_pv, x_profile)
         self.update_measurement(Screen.y_profile_pv, y_profile)
 
+    # Renders only the region of interest, directly at the binned resolution.
+    def update_live_view(self, interp_func):
+        x_start = self.get_parameter_value(Screen.roi_x_start_pv)
+        y_start = self.get_parameter_value(Screen.roi_y_start_pv)
+        x_axis = self.x_axis_new[x_start:x_start + self.get_parameter_value(Screen.roi_x_size_pv)]
+        y_axis = self.y_axis_new[y_start:y_start + self.get_parameter_value(Screen.roi_y_size_pv)]
+
+        binning = Screen.binning_factors[self.get_parameter_value(Screen.binning_pv)]
+        binning = max(min(binning, len(x_axis), len(y_axis)), 1)
+        x_bins = x_axis[:len(x_axis) // binning * binning].reshape(-1, binning).mean(axis=1)
+        y_bins = y_axis[:len(y_axis) // binning * binning].reshape(-1, binning).mean(axis=1)
+
+        live_image = interp_func(x_bins, y_bins)
+        live_image = live_image + Screen.image_noise * np.random.random_sample(live_image.shape)
+        live_image = self.signal_normalize.raw(live_image).astype(np.uint8).flatten()
+        if Screen.compression_options[self.get_parameter_value(Screen.compression_pv)] == 'Zlib':
+            live_image = np.frombuffer(zlib.compress(live_image.tobytes()), dtype=np.uint8)
+
+        self.update_measurement(Screen.live_width_pv, len(x_bins))
+        self.update_measurement(Screen.live_height_pv, len(y_bins))
+        self.update_measurement(Screen.live_size_pv, len(live_image))
+        self.update_measurement(Screen.live_image_pv, live_image)
+
     def update_readbacks(self):
         self.update_readback(Screen.x_axis_pv, self.x_axis_new)
         self.update_readback(Screen.y_axis_pv, self.y_axis_new)
@@ -619,3 +725,12 @@ class Corrector_Power_Supply(Device):
         self.register_setting(Corrector_Power_Supply.field_low_limit_pv, default=Corrector_Power_Supply.field_limits[0])
 
         self.register_readback(Corrector_Power_Supply.book_pv, Corrector_Power_Supply.field_set_pv)
+
+    # Field settings written outside the field limits are clamped to the limits. The limits are read from the server,
+    # so limits written just before the field apply even if no track took them yet.
+    def validate_setting(self, reason: str, new_value):
+        if reason == Corrector_Power_Supply.field_set_pv:
+            field_limit_high = self.get_server_value(Corrector_Power_Supply.field_high_limit_pv)
+            field_limit_low = self.get_server_value(Corrector_Power_Supply.field_low_limit_pv)
+            new_value = min(max(new_value, field_limit_low), field_limit_high)
+        return new_value
@@ -0,0 +1,252 @@
+import heapq
+import shlex
+import argparse
+import itertools
+from time import monotonic
+from datetime import datetime
+from importlib import import_module
+from importlib.metadata import version
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from virtaccl.server import Server, CtrlC, not_ctrlc, stop_on_terminate
+from virtaccl.virtual_accelerator import VirtualAccelerator
+
+# Module and build function of each site the supervisor can host. Sites are imported when first used.
+sites = {'sns': ('virtaccl.site.SNS_Linac.virtual_SNS_linac', 'build_sns'),
+         'btf': ('virtaccl.site.BTF.btf_virtual_accelerator', 'build_btf'),
+         'idmp': ('virtaccl.site.SNS_IDmp.IDmp_virtual_accelerator', 'build_idmp')}
+
+
+class Shared_Server:
+    """
+    One server hosting the parameters of several virtual accelerators. Each virtual accelerator is given a
+    Prefixed_Server, which puts its prefix in front of its keys on the shared server. Client writes, write validation
+    and read callbacks of the shared server are passed to the virtual accelerator owning the parameter.
+
+        Parameters
+        ----------
+        server : Server
+            The server clients connect to, started once the parameters of every virtual accelerator are added.
+    """
+
+    def __init__(self, server: Server):
+        self.server = server
+        self.views: List['Prefixed_Server'] = []
+        # Virtual accelerator server and its own key for every key of the shared server.
+        self.owners: Dict[str, Tuple['Prefixed_Server', str]] = {}
+        server.set_write_validator(self.validate_write)
+        server.set_read_callback(self.read)
+
+    def create_view(self, prefix: str) -> 'Prefixed_Server':
+        view = Prefixed_Server(self, prefix)
+        self.views.append(view)
+        return view
+
+    def add_owner(self, server_key: str, view: 'Prefixed_Server', view_key: str):
+        if server_key in self.owners:
+            print(f'Warning: Parameter "{server_key}" already exists on the shared server. Check the prefixes.')
+        self.owners[server_key] = (view, view_key)
+
+    def validate_write(self, server_key: str, new_value) -> Any:
+        if server_key not in self.owners:
+            return new_value
+        view, view_key = self.owners[server_key]
+        return view.validate_write(view_key, new_value)
+
+    def read(self, server_key: str):
+        if server_key in self.owners:
+            view, view_key = self.owners[server_key]
+            if view.read_callback is not None:
+                view.read_callback(view_key)
+
+    def route_writes(self):
+        # Passes the writes by clients to the virtual accelerators they belong to.
+        for server_key, new_value, timestamp in self.server.get_writes():
+            if server_key in self.owners:
+                view, view_key = self.owners[server_key]
+                view.queue_write(view_key, new_value, timestamp)
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+
+class Prefixed_Server(Server):
+    """
+    The part of a Shared_Server belonging to one virtual accelerator. The virtual accelerator uses its own keys, which
+    are served with the prefix in front of them. All virtual accelerators on the shared server count the same settings
+    generation, so views need to be created before clients connect.
+
+        Parameters
+        ----------
+        shared_server : Shared_Server
+            Server shared by the virtual accelerators.
+        prefix : str
+            Put in front of every key of this virtual accelerator on the shared server.
+    """
+
+    def __init__(self, shared_server: Shared_Server, prefix: str):
+        self.shared_server = shared_server
+        self.prefix = prefix
+        super().__init__()
+        self.settings_lock = shared_server.server.settings_lock
+        self.wait_on_read = shared_server.server.wait_on_read
+
+    @property
+    def settings_generation(self) -> int:
+        return self.shared_server.server.settings_generation
+
+    @settings_generation.setter
+    def settings_generation(self, value: int):
+        self.shared_server.server.settings_generation = value
+
+    def add_parameter(self, parameter_key: str, parameter_definitions: Dict[str, Any]):
+        super().add_parameter(parameter_key, parameter_definitions)
+        self.shared_server.server.add_parameter(self.prefix + parameter_key, parameter_definitions)
+        self.shared_server.add_owner(self.prefix + parameter_key, self, parameter_key)
+
+    def get_parameter(self, parameter_key: str):
+        return self.shared_server.server.get_parameter(self.prefix + parameter_key)
+
+    def set_parameter(self, parameter_key: str, new_value, timestamp: datetime = None):
+        shared_server = self.shared_server.server
+        changed = not np.array_equal(shared_server.parameter_db[self.prefix + parameter_key].get('value'), new_value)
+        shared_server.set_parameter(self.prefix + parameter_key, new_value, timestamp)
+        if changed:
+            self.record_change(parameter_key)
+
+    def apply_transaction(self, new_settings: Dict[str, Any]) -> int:
+        unknown_keys = [key for key in new_settings.keys() if key not in self.parameter_db]
+        if unknown_keys:
+            raise KeyError(f'Unknown parameters: {", ".join(unknown_keys)}')
+        prefixed_settings = {self.prefix + key: value for key, value in new_settings.items()}
+        return self.shared_server.server.apply_transaction(prefixed_settings)
+
+    def get_writes(self) -> List[Tuple[str, Any, datetime]]:
+        self.shared_server.route_writes()
+        return super().get_writes()
+
+    def get_subscribed_keys(self) -> Optional[Set[str]]:
+        subscribed_keys = self.shared_server.server.get_subscribed_keys()
+        if subscribed_keys is None:
+            return None
+        owners = self.shared_server.owners
+        return {owners[key][1] for key in subscribed_keys if key in owners and owners[key][0] is self}
+
+    def update(self):
+        self.shared_server.server.update()
+
+    def __str__(self):
+        return f'Following parameters are served with prefix "{self.prefix}":\n' + '\n'.join(self.parameter_db.keys())
+
+
+class VA_Scheduler:
+    """
+    Tracks several virtual accelerators in one thread. The virtual accelerator whose update is due first is tracked
+    next, and ties go to the one tracked least recently. A virtual accelerator that falls behind is not tracked
+    several times in a row to catch up, so a slow one can't starve the others.
+    """
+
+    def __init__(self):
+        self.instances: List[Tuple[str, VirtualAccelerator]] = []
+        self.order = itertools.count()
+
+    def add_instance(self, name: str, va: VirtualAccelerator):
+        self.instances.append((name, va))
+
+    def run(self, keep_running: Callable[[], bool] = not_ctrlc):
+        start_time = monotonic()
+        queue = [(start_time, next(self.order), index) for index in range(len(self.instances))]
+        heapq.heapify(queue)
+        while queue and keep_running():
+            due_time, _, index = heapq.heappop(queue)
+            wait_time = due_time - monotonic()
+            if wait_time > 0 and CtrlC.event.wait(wait_time):
+                break
+            name, va = self.instances[index]
+
+            now = datetime.now() if va.sync_time else None
+            va.track(timestamp=now)
+            va.server.update()
+
+            finish_time = monotonic()
+            next_time = due_time + va.update_period
+            if next_time < finish_time:
+                print(f'Warning: Update of {name} took longer than its refresh rate.')
+                next_time = finish_time
+            heapq.heappush(queue, (next_time, next(self.order), index))
+
+
+def build_instance(shared_server: Shared_Server, site: str, prefix: str, argv: List[str]) -> VirtualAccelerator:
+    """Builds the virtual accelerator of a site from its command line arguments, served by the shared server with the
+    prefix."""
+
+    if site not in sites:
+        raise ValueError(f'Unknown site "{site}". Known sites are {", ".join(sites.keys())}.')
+    module_name, build_function = sites[site]
+    builder = getattr(import_module(module_name), build_function)(argv=argv)
+    builder.server = shared_server.create_view(prefix)
+    return builder.build()
+
+
+def supervisor_arguments(argv: List[str] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(
+        description='Run several virtual accelerators in one process, served by one shared EPICS server. Version '
+                    + version('virtaccl'),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('instances', nargs='+', type=str,
+                        help="One quoted string per virtual accelerator: the site (" + ", ".join(sites.keys()) +
+                             "), the prefix put in front of its PVs, then its own arguments. For example "
+                             "'sns SNS1: --refresh_rate 2'.")
+    parser.add_argument('--ca_proc', default=0.1, type=float,
+                        help='Number (in seconds) that determine some delay parameter in the server. Not exactly '
+                             'sure how it works, so use at your own risk.')
+    parser.add_argument('--ca_process', action='store_true',
+                        help='Run the CA server in its own process, exchanging values through shared memory.')
+    parser.add_argument('--pva', action='store_true',
+                        help='Serve the PVs over PV Access (p4p) instead of Channel Access.')
+    return vars(parser.parse_args(argv))
+
+
+def main():
+    from virtaccl.EPICS_Server.ca_server import build_epics_server
+
+    kwargs = supervisor_arguments()
+    shared_server = Shared_Server(build_epics_server(**kwargs))
+    scheduler = VA_Scheduler()
+    vas = []
+    for instance in kwargs['instances']:
+        arguments = shlex.split(instance)
+        if len(arguments) < 2:
+            raise ValueError(f'"{instance}" needs at least a site and a prefix.')
+        site, prefix, argv = arguments[0], arguments[1], arguments[2:]
+        va = build_instance(shared_server, site, prefix, argv)
+        if va.on_read:
+            print(f'Warning: {prefix}{site} is tracked at its refresh rate, --on_read is not supported by the '
+                  f'supervisor.')
+        scheduler.add_instance(prefix + site, va)
+        vas.append(va)
+
+    stop_on_terminate()
+    shared_server.start()
+    print(f'Server started with {len(vas)} virtual accelerators.')
+    for va in vas:
+        if va.gateway is not None:
+            va.gateway.start()
+            print(f"HTTP gateway started on {va.gateway.host}:{va.gateway.port}.")
+
+    scheduler.run()
+
+    for va in vas:
+        if va.gateway is not None:
+            va.gateway.stop()
+    shared_server.stop()
+    print('Exiting. Thank you for using our virtual accelerator!')
+
+
+if __name__ == '__main__':
+    main()
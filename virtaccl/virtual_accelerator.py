@@ -1,12 +1,13 @@
 import sys
 import time
 import argparse
+from threading import Condition
 from datetime import datetime
 from importlib.metadata import version
-from typing import Dict, Any, List, TypeVar, Generic
+from typing import Dict, Any, List, Optional, TypeVar, Generic
 
-from virtaccl.server import Server, not_ctrlc
-from virtaccl.beam_line import BeamLine
+from virtaccl.server import Server, CtrlC, not_ctrlc, stop_on_terminate
+from virtaccl.beam_line import BeamLine, VAStatusDevice
 from virtaccl.model import Model
 
 
@@ -89,7 +90,7 @@ class VA_Parser:
         arguments = self.__find_argument_dict__(name)
         arguments[name]['optional']['help'] = new_help
 
-    def initialize_arguments(self) -> Dict[str, Any]:
+    def initialize_arguments(self, argv: List[str] = None) -> Dict[str, Any]:
         va_parser = argparse.ArgumentParser(
             description=self.description + ' Version ' + self.version,
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -97,7 +98,8 @@ class VA_Parser:
         for group_key, argument_group in self.__all_arguments__.items():
             for argument_name, argument_dict in argument_group.items():
                 va_parser.add_argument(*argument_dict['positional'], **argument_dict['optional'])
-        return vars(va_parser.parse_args())
+        # Arguments are taken from the command line unless a list is given.
+        return vars(va_parser.parse_args(argv))
 
 
 def add_va_arguments(va_parser: VA_Parser) -> VA_Parser:
@@ -107,6 +109,33 @@ def add_va_arguments(va_parser: VA_Parser) -> VA_Parser:
     va_parser.add_va_argument('--sync_time', dest='sync_time', action='store_true',
                               help="Synchronize timestamps for server parameters.")
 
+    # Which diagnostics need to be computed. Tracking past the last needed diagnostic is deferred until it is needed.
+    va_parser.add_va_argument('--watch', nargs='+', default=None,
+                              help='Names of the devices whose measurements are kept up to date. Tracking stops after '
+                                   'the last of them.')
+    va_parser.add_va_argument('--on_demand', dest='on_demand', action='store_true',
+                              help="Only keep measurements up to date for devices that clients are subscribed to "
+                                   "(plus any --watch devices). Tracking stops after the last of them.")
+    va_parser.add_va_argument('--lazy', dest='lazy', action='store_true',
+                              help="Skip expensive measurements (images, profiles, Twiss) that no client is "
+                                   "monitoring or has recently read.")
+    va_parser.add_va_argument('--eager', dest='lazy', action='store_false',
+                              help="Compute all measurements every update, whether or not they are watched.")
+    va_parser.add_va_argument('--on_read', dest='on_read', action='store_true',
+                              help="Do not track periodically. A client reading a measurement that is out of date "
+                                   "with the settings starts one track that includes all earlier writes. Socket "
+                                   "clients wait for it, EPICS clients get the current value and the new one as a "
+                                   "monitor update. Monitors only update after such a read.")
+    va_parser.add_va_argument('--read_timeout', default=10.0, type=float,
+                              help='Longest time (in seconds) a socket read waits for the track in --on_read mode.')
+    va_parser.add_va_argument('--refine_deadline', default=0.5, type=float,
+                              help='Longest time (in seconds) a quick result of the model waits to be refined. Once '
+                                   'it has passed, new settings are tracked at full fidelity with the refinement.')
+
+    va_parser.add_va_argument('--http', default=None, type=str,
+                              help="Address ('host:port') of an HTTP and WebSocket endpoint for dashboards. None "
+                                   "means no endpoint.")
+
     # Desired amount of output.
     va_parser.add_va_argument('--debug', dest='debug', action='store_true',
                               help="Some debug info will be printed.")
@@ -153,6 +182,10 @@ class VirtualAccelerator(Generic[ModelType, ServerType]):
         if not kwargs:
             kwargs = VA_Parser().initialize_arguments()
 
+        # Cycle counter and settled state PVs for clients that step with the virtual accelerator.
+        self.status_device = VAStatusDevice('Virac:Status')
+        beam_line.add_device(self.status_device)
+
         if kwargs['print_settings']:
             for key in beam_line.get_setting_keys():
                 print(key)
@@ -173,6 +206,56 @@ class VirtualAccelerator(Generic[ModelType, ServerType]):
         sever_parameters = beam_line.get_server_parameter_definitions()
         server.add_parameters(sever_parameters)
         beam_line.reset_devices()
+        generation_param = self.status_device.get_parameter(VAStatusDevice.settings_generation_pv)
+        server.set_generation_key(generation_param.get_server_key())
+        # Client writes are checked (and clamped to limits) by the devices as they arrive, against the values on the
+        # server.
+        beam_line.set_server_getter(server.get_parameter)
+        server.set_write_validator(beam_line.validate_setting)
+
+        # Settings changed during a long track are given to the model while it tracks, and diagnostics the beam has
+        # already passed are published before the track finishes.
+        model.set_tracking_callback(self.apply_new_settings)
+        model.set_streaming_callback(self.publish_partial_measurements)
+
+        # Model names of the devices whose measurements always need to be kept up to date.
+        self.lazy = kwargs.get('lazy', False)
+        self.on_demand = kwargs.get('on_demand', False)
+        self.watched_elements = None
+        if kwargs.get('watch'):
+            self.watched_elements = set()
+            for device_name in kwargs['watch']:
+                if device_name in beam_line.get_devices():
+                    self.watched_elements |= set(beam_line.get_device(device_name).model_names)
+                else:
+                    print(f'Warning: Watched device "{device_name}" not found.')
+            model.set_needed_elements(self.watched_elements)
+
+        # Counts the update cycles. Partial measurements published during a cycle use the timestamp of that cycle.
+        self.cycle = 0
+        self.cycle_timestamp = None
+        # Server settings generation included in the last track. A quick result of the model is refined by the next
+        # cycle without new settings. If settings keep arriving, they are tracked with the refinement once the quick
+        # result is older than the deadline.
+        self.applied_generation = 0
+        self.refine_generation: Optional[int] = None
+        self.refine_deadline = kwargs.get('refine_deadline', 0.5)
+        self.refine_since: Optional[float] = None
+
+        # In measure on read mode, reads of out of date measurements request a track and wait for it.
+        self.on_read = kwargs.get('on_read', False)
+        self.read_timeout = kwargs.get('read_timeout', 10.0)
+        self.track_condition = Condition()
+        self.track_requested = False
+        self.measured_keys = set(beam_line.get_measurement_keys()) | set(beam_line.get_readback_keys())
+        if self.on_read:
+            server.set_read_callback(self.request_track)
+
+        # Optional HTTP and WebSocket endpoint next to the server.
+        self.gateway = None
+        if kwargs.get('http'):
+            from virtaccl.HTTP_Gateway.http_gateway import HTTP_Gateway
+            self.gateway = HTTP_Gateway(server, kwargs['http'])
 
         if kwargs['debug']:
             print(server)
@@ -189,11 +272,11 @@ class VirtualAccelerator(Generic[ModelType, ServerType]):
         return self.server
 
     def set_value(self, server_key: str, new_value):
-        self.server.set_parameter(server_key, new_value)
+        self.server.apply_transaction({server_key: new_value})
         self.track()
 
     def set_values(self, new_settings: Dict[str, Any]):
-        self.server.set_parameters(new_settings)
+        self.server.apply_transaction(new_settings)
         self.track()
 
     def get_value(self, *server_key: str):
@@ -212,26 +295,152 @@ class VirtualAccelerator(Generic[ModelType, ServerType]):
         return return_dict
 
     def track(self, timestamp: datetime = None):
-        server_parameters = self.server.get_parameters()
-        self.beam_line.update_settings_from_server(server_parameters)
-        new_optics = self.beam_line.get_model_optics()
+        self.cycle += 1
+        self.cycle_timestamp = timestamp
+        self.server.set_cycle(self.cycle)
+        with self.server.settings_lock:
+            generation = self.server.settings_generation
+            if self.cycle == 1:
+                # The first track starts from every value on the server, later tracks only from the new writes.
+                self.server.get_writes()
+                new_settings = self.server.get_parameters()
+            else:
+                new_settings = self.get_new_settings()
+        refine_overdue = self.refine_since is not None and time.time() - self.refine_since >= self.refine_deadline
+        refining = self.refine_generation is not None and (not new_settings or refine_overdue)
+        self.refine_generation = None
+        self.publish_status(busy=True, timestamp=timestamp)
+
+        if refining:
+            # No settings arrived since the quick result of the last cycle, or it waited past the deadline, so this
+            # cycle refines it along with any new settings. Otherwise newer settings are tracked (quickly again).
+            if new_settings:
+                self.beam_line.update_settings_from_server(new_settings)
+                self.model.update_optics(self.beam_line.get_model_optics())
+            self.update_observed()
+            self.model.refine()
+        else:
+            self.beam_line.update_settings_from_server(new_settings)
+            new_optics = self.beam_line.get_model_optics()
+
+            self.model.update_optics(new_optics)
+            self.update_observed()
+            self.model.track()
+        self.publish_measurements(timestamp)
+
+        if self.model.refinement_pending():
+            self.refine_generation = generation
+            if self.refine_since is None:
+                self.refine_since = time.time()
+        else:
+            self.refine_since = None
+
+        with self.track_condition:
+            self.applied_generation = generation
+            self.track_condition.notify_all()
+        self.publish_status(busy=False, timestamp=timestamp)
 
-        self.model.update_optics(new_optics)
-        self.model.track()
+    def publish_status(self, busy: bool, timestamp: datetime = None):
+        self.status_device.update_status(self.cycle, self.server.settings_generation, self.applied_generation, busy)
+        new_server_values = self.beam_line.get_parameters_for_server()
+        self.server.set_parameters(new_server_values, timestamp=timestamp)
+        if busy:
+            self.server.update()
+
+    def request_track(self, server_key: str):
+        """Called by the server before a client reads a parameter. If the parameter is a measurement that is out of
+        date with the settings, this asks for a track, and waits until it is done if the server allows it."""
+
+        if server_key not in self.measured_keys:
+            return
+        with self.track_condition:
+            target_generation = self.server.settings_generation
+            if self.applied_generation >= target_generation:
+                return
+            self.track_requested = True
+            self.track_condition.notify_all()
+            if not self.server.wait_on_read:
+                return
+            self.track_condition.wait_for(lambda: self.applied_generation >= target_generation or not not_ctrlc(),
+                                          timeout=self.read_timeout)
+
+    def update_observed(self):
+        subscribed_keys = self.server.get_subscribed_keys()
+        if subscribed_keys is not None and self.gateway is not None:
+            subscribed_keys = subscribed_keys | self.gateway.get_subscribed_keys()
+        subscribed_elements = None
+        if subscribed_keys is not None:
+            subscribed_elements = self.beam_line.get_model_names(subscribed_keys)
+
+        # Watched diagnostics that need particles make models in a fast mode track them. If the server can't tell
+        # what is watched, the model keeps its mode.
+        self.model.require_particles(subscribed_elements or set())
+
+        if self.lazy:
+            self.beam_line.set_observed_keys(subscribed_keys)
+            self.model.set_observed_elements(subscribed_elements)
+
+        if self.on_demand:
+            needed_elements = self.watched_elements
+            if subscribed_elements is not None:
+                needed_elements = subscribed_elements | (self.watched_elements or set())
+            self.model.set_needed_elements(needed_elements)
+
+    def get_new_settings(self) -> Dict[str, Any]:
+        # Later writes to the same key replace earlier ones.
+        return {key: value for key, value, write_time in self.server.get_writes()}
+
+    def apply_new_settings(self):
+        with self.server.settings_lock:
+            new_settings = self.get_new_settings()
+        if not new_settings:
+            return
+        self.beam_line.update_settings_from_server(new_settings)
+        self.model.update_optics(self.beam_line.get_model_optics())
+
+    def publish_measurements(self, timestamp: datetime = None):
         new_measurements = self.model.get_measurements()
 
         self.beam_line.update_measurements_from_model(new_measurements)
+        self.beam_line.update_model_status(self.model.get_model_status())
         self.beam_line.update_readbacks()
         new_server_values = self.beam_line.get_parameters_for_server()
         self.server.set_parameters(new_server_values, timestamp=timestamp)
 
+    def publish_partial_measurements(self, new_measurements: Dict[str, Dict[str, Any]]):
+        # Only the diagnostics the beam has passed are given, so the other devices keep their measurements.
+        self.beam_line.update_partial_measurements_from_model(new_measurements)
+        new_server_values = self.beam_line.get_parameters_for_server()
+        # Partial values carry the cycle they belong to (and its timestamp when time is synchronized), like the values
+        # published at the end of the track.
+        self.server.set_cycle(self.cycle)
+        self.server.set_parameters(new_server_values, timestamp=self.cycle_timestamp)
+        self.server.update()
+
     def start_server(self):
+        stop_on_terminate()
         self.server.start()
         print(f"Server started.")
+        if self.gateway is not None:
+            self.gateway.start()
+            print(f"HTTP gateway started on {self.gateway.host}:{self.gateway.port}.")
         now = None
 
         # Our new data acquisition routine
-        while not_ctrlc():
+        while not_ctrlc() and self.on_read:
+            # Only track when a read asks for it or a quick result needs refining. Several reads waiting at the same
+            # time share one track.
+            with self.track_condition:
+                self.track_condition.wait_for(lambda: self.track_requested, timeout=self.update_period)
+                requested = self.track_requested or self.refine_generation is not None
+                self.track_requested = False
+            if requested:
+                if self.sync_time:
+                    now = datetime.now()
+                self.track(timestamp=now)
+                self.server.update()
+
+        while not_ctrlc() and not self.on_read:
             loop_start_time = time.time()
 
             if self.sync_time:
@@ -239,11 +448,19 @@ class VirtualAccelerator(Generic[ModelType, ServerType]):
             self.track(timestamp=now)
             self.server.update()
 
+            if self.refine_generation is not None:
+                # A quick result is refined by the next cycle without waiting for the rest of the update period.
+                continue
+
             loop_time_taken = time.time() - loop_start_time
             sleep_time = self.update_period - loop_time_taken
             if sleep_time < 0.0:
                 print('Warning: Update took longer than refresh rate.')
             else:
-                time.sleep(sleep_time)
+                # Wakes up as soon as the virtual accelerator is told to stop.
+                CtrlC.event.wait(sleep_time)
 
+        if self.gateway is not None:
+            self.gateway.stop()
+        self.server.stop()
         print('Exiting. Thank you for using our virtual accelerator!')